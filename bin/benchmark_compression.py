@@ -0,0 +1,64 @@
+'''
+Micro-benchmark of deflating a large resource into the zip: zipfile (one
+core) against ckanext.downloadall.streaming.ParallelDeflateWriter. It doesn't
+need CKAN. e.g.
+
+    python bin/benchmark_compression.py --size 500 --workers 8
+'''
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+import zipfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ckanext.downloadall import streaming  # noqa: E402
+
+
+def zipfile_writer(zipf, workers):
+    return zipf.open('data.csv', 'w', force_zip64=True)
+
+
+def parallel_writer(zipf, workers):
+    return streaming.ParallelDeflateWriter(
+        zipf, zipfile.ZipInfo('data.csv'), streaming.get_executor(workers),
+        workers)
+
+
+def run(payload, open_writer, workers):
+    with tempfile.TemporaryFile() as fp:
+        with zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as zipf:
+            start = time.time()
+            with open_writer(zipf, workers) as zf:
+                streaming.copy_stream(io.BytesIO(payload), zf)
+            seconds = time.time() - start
+            compress_size = zipf.getinfo('data.csv').compress_size
+        return seconds, compress_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', type=int, default=200,
+                        help='Size of the resource in MB (default: 200)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Compression threads (default: number of CPUs)')
+    args = parser.parse_args()
+
+    payload = b''.join(
+        b'2017-06-%02d,gold,%d.%04d,"some text in a column"\n'
+        % (i % 30 + 1, i % 1789, i % 9973)
+        for i in range(args.size * 1024 * 1024 // 48))
+
+    for name, open_writer in (('zipfile', zipfile_writer),
+                              ('parallel', parallel_writer)):
+        seconds, compress_size = run(payload, open_writer, args.workers)
+        print('{:<10} {:>8.1f} MB/s  compressed to {:.1%}'.format(
+            name, len(payload) / seconds / 1024 / 1024,
+            compress_size / len(payload)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+'''
+Micro-benchmark of downloading a resource into the zip: the old 128 byte
+iter_content() loop against ckanext.downloadall.streaming.copy_stream().
+
+A local HTTP server stands in for the remote resource host. It doesn't need
+CKAN - just requests. e.g.
+
+    python bin/benchmark_download.py --size 500 --buffer-size 1048576
+'''
+import argparse
+import hashlib
+import http.server
+import os
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ckanext.downloadall import streaming  # noqa: E402
+
+
+def start_server(payload):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+        daemon_threads = True
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:{}/data.csv'.format(server.server_address[1])
+
+
+def iter_content_copy(r, zf, buffer_size):
+    hash_object = hashlib.sha224()
+    size = 0
+    for chunk in r.iter_content(chunk_size=128):
+        zf.write(chunk)
+        hash_object.update(chunk)
+        size += len(chunk)
+    return size
+
+
+def buffered_copy(r, zf, buffer_size):
+    return streaming.copy_stream(
+        streaming.ResponseReader(r.raw), zf, buffer_size, hashlib.sha224())
+
+
+def run(url, copy_function, compress_type, buffer_size):
+    with tempfile.TemporaryFile() as fp:
+        with zipfile.ZipFile(fp, 'w', compress_type, allowZip64=True) as zipf:
+            start = time.time()
+            r = requests.get(url, stream=True, timeout=300)
+            with zipf.open('data.csv', 'w', force_zip64=True) as zf:
+                size = copy_function(r, zf, buffer_size)
+            return size, time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--size', type=int, default=200,
+                        help='Size of the resource in MB (default: 200)')
+    parser.add_argument('--buffer-size', type=int,
+                        default=streaming.DEFAULT_BUFFER_SIZE,
+                        help='Buffer size of the streaming copy in bytes')
+    parser.add_argument('--deflate', action='store_true',
+                        help='Compress the zip member (by default it is '
+                        'stored, to measure just the copying)')
+    args = parser.parse_args()
+
+    line = b'2017-06-01,gold,1234.5678,"some text in a column"\n'
+    payload = line * (args.size * 1024 * 1024 // len(line))
+    url = start_server(payload)
+    compress_type = zipfile.ZIP_DEFLATED if args.deflate \
+        else zipfile.ZIP_STORED
+
+    for name, copy_function in (('iter_content(128)', iter_content_copy),
+                                ('copy_stream', buffered_copy)):
+        size, seconds = run(url, copy_function, compress_type,
+                            args.buffer_size)
+        assert size == len(payload)
+        print('{:<20} {:>8.1f} MB/s'.format(
+            name, size / seconds / 1024 / 1024))
+
+
+if __name__ == '__main__':
+    main()
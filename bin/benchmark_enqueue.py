@@ -0,0 +1,73 @@
+'''
+Micro-benchmark of queuing a dataset's zip update when the queue is already
+deep (e.g. during a harvest): scanning the queued jobs' titles (as the
+job_list action does) against ckanext.downloadall.jobs.QueuedDatasets. It
+uses fakeredis rather than a Redis server, and doesn't need CKAN. e.g.
+
+    python bin/benchmark_enqueue.py --depths 1000 10000 20000
+'''
+import argparse
+import os
+import re
+import sys
+import time
+
+import fakeredis
+from rq import Queue
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from ckanext.downloadall import jobs  # noqa: E402
+
+FUNC = 'ckanext.downloadall.tasks.update_zip'
+TITLE = 'DownloadAll changed "{0}" {0}'
+
+
+def scan_enqueue(queue, queued_datasets, dataset_id):
+    for job in queue.jobs:
+        match = re.match(r'DownloadAll \w+ "[^"]*" ([\w-]+)',
+                         job.description or '')
+        if match and match.groups()[0] == dataset_id:
+            return
+    queue.enqueue(FUNC, dataset_id, description=TITLE.format(dataset_id))
+
+
+def indexed_enqueue(queue, queued_datasets, dataset_id):
+    if queued_datasets.claim(dataset_id):
+        job = queue.enqueue(FUNC, dataset_id,
+                            description=TITLE.format(dataset_id))
+        queued_datasets.set_job(dataset_id, job.id)
+
+
+def run(enqueue, depth, repeats):
+    connection = fakeredis.FakeStrictRedis()
+    queue = Queue('default', connection=connection)
+    queued_datasets = jobs.QueuedDatasets(connection)
+    for i in range(depth):
+        indexed_enqueue(queue, queued_datasets, 'queued-{}'.format(i))
+    start = time.time()
+    for i in range(repeats):
+        # half are new datasets, half are queued already
+        enqueue(queue, queued_datasets, 'dataset-{}'.format(i // 2))
+    return (time.time() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--depths', type=int, nargs='+',
+                        default=[100, 1000, 10000],
+                        help='Numbers of jobs already queued '
+                             '(default: 100 1000 10000)')
+    parser.add_argument('--repeats', type=int, default=10,
+                        help='Enqueues timed at each depth (default: 10)')
+    args = parser.parse_args()
+
+    for depth in args.depths:
+        for name, enqueue in (('scan', scan_enqueue),
+                              ('indexed', indexed_enqueue)):
+            seconds = run(enqueue, depth, args.repeats)
+            print('{:<8} {:>6} queued  {:>10.2f} ms per enqueue'.format(
+                name, depth, seconds * 1000))
+
+
+if __name__ == '__main__':
+    main()
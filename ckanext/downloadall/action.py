@@ -1,6 +1,8 @@
 import ckan.plugins as p
 from ckan import model
 
+from ckanext.downloadall.tasks import get_datastore_changes
+
 
 @p.toolkit.chained_action  # requires CKAN 2.7+
 def datastore_create(original_action, context, data_dict):
@@ -15,7 +17,10 @@ def datastore_create(original_action, context, data_dict):
         res = model.Resource.get(data_dict['resource_id'])
         if res:
             dataset = res.related_packages()[0]
+            # (for sweeps of the changed datasets - see cli.update_all_zips)
+            get_datastore_changes().add(dataset.id)
             plugin.enqueue_update_zip(dataset.name, dataset.id,
-                                      'datastore_create')
+                                      'datastore_create',
+                                      organization=dataset.owner_org)
 
     return result
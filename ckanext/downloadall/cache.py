@@ -0,0 +1,195 @@
+'''
+An on-disk cache of zip members, so that when a zip is rebuilt, resources
+that haven't changed are copied in, rather than downloaded and compressed
+again.
+
+Each cached member is stored as a zip containing just that one file (a
+"member file"), so it can be copied into a new zip as its already compressed
+bytes. Member files are content-addressed - named by the sha224 of the
+resource data - and an index maps each resource (id, URL and validators) to
+the content it had. The least recently used member files are evicted when the
+cache grows beyond its maximum size, which is spotted with a running total of
+their size (in a file), rather than by adding up every file on each add.
+
+This doesn't depend on CKAN, and is safe to share between worker processes.
+'''
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+log = logging.getLogger(__name__)
+
+
+def member_key(resource_id, url, validators):
+    '''Returns the key under which a resource's member file is cached.
+
+    :param validators: dict of values that change when the resource data
+        changes e.g. last_modified, size
+    '''
+    key = json.dumps([resource_id, url, validators], sort_keys=True)
+    return hashlib.sha224(key.encode('utf8')).hexdigest()
+
+
+class MemberCache(object):
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.blob_dir = os.path.join(directory, 'members')
+        self.index_dir = os.path.join(directory, 'index')
+        self.tmp_dir = os.path.join(directory, 'tmp')
+        self.size_path = os.path.join(directory, 'size')
+        for dir_ in (self.blob_dir, self.index_dir, self.tmp_dir):
+            _makedirs(dir_)
+
+    def _index_path(self, key):
+        return os.path.join(self.index_dir, key[:2], key + '.json')
+
+    def _blob_path(self, content_hash):
+        return os.path.join(self.blob_dir, content_hash[:2],
+                            content_hash + '.zip')
+
+    def get_entry(self, key):
+        '''Returns the index entry for a key, or None.'''
+        try:
+            with open(self._index_path(key)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def open(self, key):
+        '''Returns the cached member file for a key, opened for reading, or
+        None if it is not cached.
+        '''
+        entry = self.get_entry(key)
+        if not entry:
+            return None
+        blob_path = self._blob_path(entry['content_hash'])
+        try:
+            member_file = open(blob_path, 'rb')
+        except (IOError, OSError):
+            # evicted
+            return None
+        # record the use, for the least recently used eviction
+        try:
+            os.utime(blob_path, None)
+        except OSError:
+            pass
+        return member_file
+
+    def temporary_file(self):
+        '''Returns a temporary file for writing a member file, on the same
+        file system as the cache, ready to be added with add().
+        '''
+        return tempfile.NamedTemporaryFile(dir=self.tmp_dir, suffix='.zip')
+
+    def add(self, key, content_hash, member_file_path, **entry):
+        '''Adds a member file to the cache. The file is hard-linked (or
+        copied) into the cache, so the caller still owns member_file_path.
+
+        :param content_hash: sha224 of the (uncompressed) resource data
+        :param entry: any other values to store in the index entry
+        '''
+        blob_path = self._blob_path(content_hash)
+        _makedirs(os.path.dirname(blob_path))
+        added_size = 0
+        if not os.path.exists(blob_path):
+            try:
+                os.link(member_file_path, blob_path)
+                added_size = os.path.getsize(blob_path)
+            except OSError:
+                if not os.path.exists(blob_path):
+                    # e.g. the file system doesn't support hard links
+                    self._write_atomically(
+                        blob_path,
+                        lambda f: _copy_file(member_file_path, f))
+                    added_size = os.path.getsize(blob_path)
+        entry['content_hash'] = content_hash
+        self._write_atomically(
+            self._index_path(key),
+            lambda f: f.write(json.dumps(entry).encode('utf8')))
+        if self._update_size(lambda total: total + added_size) > \
+                self.max_size:
+            self.evict()
+
+    def _write_atomically(self, path, write_function):
+        _makedirs(os.path.dirname(path))
+        with tempfile.NamedTemporaryFile(dir=self.tmp_dir,
+                                         delete=False) as f:
+            try:
+                write_function(f)
+            except Exception:
+                os.unlink(f.name)
+                raise
+        os.rename(f.name, path)
+
+    def _update_size(self, update_function):
+        '''Updates the running total of the size of the member files, with
+        update_function(total), under a lock, as other processes share it.
+        If there is no total yet (e.g. a new cache), the member files are
+        counted instead.
+
+        :returns: the new total
+        '''
+        with open(self.size_path, 'a+') as f:
+            # (the lock is released when the file is closed)
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                total = update_function(int(f.read()))
+            except ValueError:
+                total = sum(size for mtime, size, path in self._list_blobs())
+            f.seek(0)
+            f.truncate()
+            f.write(str(total))
+        return total
+
+    def _list_blobs(self):
+        '''Returns (mtime, size, path) of each member file.'''
+        blobs = []
+        for dirpath, dirnames, filenames in os.walk(self.blob_dir):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                blobs.append((stat.st_mtime, stat.st_size, path))
+        return blobs
+
+    def evict(self):
+        '''Deletes the least recently used member files until the cache is
+        no bigger than max_size, and corrects the running total of its size
+        (e.g. if files were deleted by hand). It walks the whole cache, so
+        add() only calls it when the running total is over max_size.
+        '''
+        blobs = sorted(self._list_blobs())
+        total_size = sum(size for mtime, size, path in blobs)
+        for mtime, size, path in blobs:
+            if total_size <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total_size -= size
+            log.debug('Evicted from the member cache: {}'.format(path))
+        self._update_size(lambda total: total_size)
+        # index entries of evicted member files are left - they are treated
+        # as a miss, and are overwritten when the resource is next cached
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _copy_file(path, destination_file):
+    with open(path, 'rb') as f:
+        shutil.copyfileobj(f, destination_file)
@@ -1,11 +1,49 @@
 # encoding: utf-8
+import calendar
+import collections
+import datetime
+import functools
+import time
+
 import click
 
 from ckan.plugins import toolkit
 from ckan import model
-from ckan.lib.jobs import DEFAULT_QUEUE_NAME
+from ckan.lib import jobs as jobs_lib
+from ckan.lib.redis import connect_to_redis
+
+from ckanext.downloadall import compression, jobs, sweep, tasks
+
+# system_info key of the time that the last sweep of changed datasets got to
+SWEEP_MARK_KEY = 'ckanext.downloadall.sweep_mark'
+# datasets fetched at a time when searching for those changed
+SEARCH_ROWS = 1000
+# datasets queued at a time by update-all-zips
+ENQUEUE_BATCH_SIZE = 500
+LAST = 'last'
+
+
+def validate_compression_level(ctx, param, value):
+    try:
+        return tasks.parse_compression_level(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
 
-from ckanext.downloadall import tasks
+def validate_since(ctx, param, value):
+    if value is None or value == LAST:
+        return value
+    try:
+        return sweep.parse_isoformat(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
+compression_level_option = click.option(
+    '--compression-level', callback=validate_compression_level,
+    metavar='[0-9|{}]'.format(compression.AUTO),
+    help='Deflate level, or "auto" to choose it for each file by its size '
+    'and the time left (default: ckanext.downloadall.compression_level)')
 
 
 @click.group(name='downloadall')
@@ -23,7 +61,8 @@ def cli(ctx):
 @click.option('--force', '-f',
               help='Force generation of ZIP file',
               is_flag=True)
-def update_zip(dataset_ref, synchronous, force):
+@compression_level_option
+def update_zip(dataset_ref, synchronous, force, compression_level):
     ''' update-zip <package-name>
 
     Generates zip file for a dataset, downloading its resources.'''
@@ -31,15 +70,20 @@ def update_zip(dataset_ref, synchronous, force):
     if force:
         skip_if_no_changes = False
     if synchronous:
-        tasks.update_zip(dataset_ref, skip_if_no_changes)
+        tasks.update_zip(dataset_ref, skip_if_no_changes, compression_level)
     else:
-        toolkit.enqueue_job(
-            tasks.update_zip, [dataset_ref, skip_if_no_changes],
+        queue, rq_kwargs = tasks.get_job_options(
+            tasks.get_dataset_lane(dataset_ref))
+        job = toolkit.enqueue_job(
+            tasks.update_zip,
+            [dataset_ref, skip_if_no_changes, compression_level],
             title='DownloadAll {operation} "{name}" {id}'.format(
                 operation='cli-requested', name=dataset_ref,
                 id=dataset_ref),
-            queue=DEFAULT_QUEUE_NAME,
-            rq_kwargs={"timeout": 1800})
+            queue=queue,
+            rq_kwargs=rq_kwargs)
+        if rq_kwargs.get('at_front'):
+            jobs.keep_in_arrival_order(job)
     click.secho('update-zip: SUCCESS', fg='green', bold=True)
 
 
@@ -51,27 +95,301 @@ def update_zip(dataset_ref, synchronous, force):
 @click.option('--force', '-f',
               help='Force generation of ZIP file',
               is_flag=True)
-def update_all_zips(synchronous, force):
+@compression_level_option
+@click.option('--workers', '-w', type=click.IntRange(1), default=1,
+              help='With --synchronous, the number of processes to build the '
+              'zips in at once (default: 1)')
+@click.option('--resume', type=click.Path(dir_okay=False),
+              help='With --synchronous, a file listing the datasets done, '
+              'which are skipped, and to which each dataset is added as it '
+              'is done - so an interrupted run can be resumed')
+@click.option('--since', callback=validate_since,
+              metavar='[DATETIME|{}]'.format(LAST),
+              help='Only the datasets changed since this ISO 8601 date/time '
+              '(UTC), or "{}" for since the last run with --since got to '
+              '(or all datasets, the first time)'.format(LAST))
+@click.pass_context
+def update_all_zips(ctx, synchronous, force, compression_level, workers,
+                    resume, since):
     ''' update-all-zips <package-name>
 
-    Generates zip file for all datasets. It is done synchronously.'''
-    context = {'model': model, 'session': model.Session}
-    datasets = toolkit.get_action('package_list')(context, {})
+    Generates zip file for all datasets. They are queued as bulk builds, which
+    interactive ones go ahead of, taking the organizations in turn. With
+    --synchronous they are built by this command, in --workers processes.'''
+    if not synchronous and (workers > 1 or resume):
+        raise click.UsageError('--workers and --resume need --synchronous')
+    high_water_mark = None
+    if since is None:
+        context = {'model': model, 'session': model.Session}
+        datasets = toolkit.get_action('package_list')(context, {})
+        organizations = dict(
+            model.Session.query(model.Package.name, model.Package.owner_org))
+        datasets = jobs.interleave(datasets, key=organizations.get)
+    else:
+        if since == LAST:
+            since = load_sweep_mark()
+        # (changes from now on are for the next sweep)
+        now = datetime.datetime.utcnow()
+        changes = get_datasets_changed_since(since)
+        print('{} datasets changed since {}'.format(
+            len(changes), since.isoformat() if since else 'the start'))
+        datasets = list(changes)
+        high_water_mark = sweep.HighWaterMark(changes, now,
+                                              save=save_sweep_mark)
     skip_if_no_changes = True
     if force:
         skip_if_no_changes = False
-    for i, dataset_name in enumerate(datasets):
-        if synchronous:
-            print('Processing dataset {}/{}'.format(i + 1, len(datasets)))
-            tasks.update_zip(dataset_name, skip_if_no_changes)
+    if synchronous:
+        build_all_zips(ctx, datasets, skip_if_no_changes, compression_level,
+                       workers, resume, high_water_mark)
+    else:
+        enqueue_all_zips(datasets, skip_if_no_changes, compression_level,
+                         high_water_mark)
+
+
+def enqueue_all_zips(datasets, skip_if_no_changes, compression_level,
+                     high_water_mark=None):
+    '''Queues the datasets' zips to be built, as bulk builds, skipping those
+    that are queued already. They are done in batches: for each batch, a query
+    of the datasets, a few round trips to Redis to see which are queued
+    already, and one to queue the rest.
+
+    :param high_water_mark: (optional) sweep.HighWaterMark of the datasets,
+        which is moved on as they are queued
+    '''
+    started = time.time()
+    queued_datasets = tasks.get_queued_datasets()
+    queued = already_queued = missing = 0
+    for batch_start in range(0, len(datasets), ENQUEUE_BATCH_SIZE):
+        batch = datasets[batch_start:batch_start + ENQUEUE_BATCH_SIZE]
+        lanes = tasks.get_dataset_lanes(batch)
+        claimed = set(queued_datasets.claim_many(
+            dataset_id for dataset_id, lane in lanes.values()))
+        missing += len(set(batch) - set(lanes))
+        already_queued += len(lanes) - len(claimed)
+
+        jobs_data = collections.OrderedDict()
+        to_queue = set(claimed)
+        for dataset_name in batch:
+            dataset_id, lane = lanes.get(dataset_name, (None, None))
+            if dataset_id not in to_queue:
+                continue
+            to_queue.remove(dataset_id)
+            queue, rq_kwargs = tasks.get_job_options(lane, jobs.BULK)
+            title = 'DownloadAll {operation} "{name}" {id}'.format(
+                operation='cli-requested', name=dataset_name, id=dataset_id)
+            # (the title is in the meta, as ckan.lib.jobs.enqueue() puts it,
+            # for `ckan jobs list` and job_show)
+            rq_kwargs['meta']['title'] = title
+            jobs_data.setdefault(queue, []).append(dict(
+                func=tasks.update_zip,
+                args=[dataset_id, skip_if_no_changes, compression_level],
+                description=title, **rq_kwargs))
+        try:
+            for queue, queue_jobs_data in jobs_data.items():
+                enqueued = jobs.enqueue_many(jobs_lib.get_queue(queue),
+                                             queue_jobs_data)
+                job_ids = dict((job.args[0], job.id) for job in enqueued)
+                queued_datasets.set_jobs(job_ids)
+                claimed -= set(job_ids)
+                queued += len(job_ids)
+        finally:
+            # (if queuing failed)
+            queued_datasets.release_many(claimed)
+
+        if high_water_mark:
+            for dataset_name in batch:
+                high_water_mark.done(dataset_name)
+        seconds = time.time() - started
+        print('Queued {}/{} datasets ({} already queued) - {:.0f} datasets/s'
+              .format(queued, len(datasets), already_queued,
+                      (batch_start + len(batch)) / seconds if seconds else 0))
+    if high_water_mark:
+        high_water_mark.finish()
+
+    click.secho('update-all-zips: SUCCESS - queued {} datasets ({} already '
+                'queued, {} not found) in {:.1f}s'.format(
+                    queued, already_queued, missing, time.time() - started),
+                fg='green', bold=True)
+
+
+def build_all_zips(ctx, datasets, skip_if_no_changes, compression_level,
+                   workers, resume, high_water_mark=None):
+    '''Builds the datasets' zips in this process, or a pool of them, with the
+    progress, and then a summary of the failures.
+
+    :param high_water_mark: (optional) sweep.HighWaterMark of the datasets,
+        which is moved on as they are built
+    '''
+    checkpoint = sweep.Checkpoint(resume) if resume else None
+    if checkpoint:
+        done = checkpoint.load()
+        if done:
+            print('Resuming: skipping {} datasets done already'
+                  .format(len(done)))
+            datasets = [name for name in datasets if name not in done]
+            if high_water_mark:
+                for dataset_name in done:
+                    high_water_mark.done(dataset_name)
+
+    if workers > 1:
+        # each process opens its own database connections, rather than
+        # sharing (and closing) those inherited from this one
+        model.Session.remove()
+        model.meta.engine.dispose()
+    progress = sweep.Progress(len(datasets))
+    results = sweep.run_in_pool(
+        functools.partial(build_zip, skip_if_no_changes=skip_if_no_changes,
+                          compression_level=compression_level),
+        datasets, workers=workers, initializer=init_build_process,
+        initargs=(ctx.meta.get('flask_app'),))
+    for dataset_name, error in results:
+        progress.update(dataset_name, error)
+        if error:
+            click.secho('Failed dataset {}: {}'.format(dataset_name, progress),
+                        fg='red', err=True)
+            click.echo(error, err=True)
         else:
-            print('Queuing dataset {}/{}'.format(i + 1, len(datasets)))
-            toolkit.enqueue_job(
-                tasks.update_zip, [dataset_name, skip_if_no_changes],
-                title='DownloadAll {operation} "{name}" {id}'.format(
-                    operation='cli-requested', name=dataset_name,
-                    id=dataset_name),
-                queue=DEFAULT_QUEUE_NAME,
-                rq_kwargs={"timeout": 1800})
+            if checkpoint:
+                checkpoint.add(dataset_name)
+            if high_water_mark:
+                high_water_mark.done(dataset_name)
+            print('Processed dataset {}: {}'.format(dataset_name, progress))
+    if high_water_mark:
+        high_water_mark.finish()
 
+    if progress.failures:
+        click.secho('update-all-zips: {} of {} datasets FAILED:'.format(
+            len(progress.failures), progress.total), fg='red', bold=True)
+        for dataset_name, error in progress.failures:
+            click.echo('  {}: {}'.format(
+                dataset_name, error.strip().splitlines()[-1]))
+        ctx.exit(1)
     click.secho('update-all-zips: SUCCESS', fg='green', bold=True)
+
+
+def get_datasets_changed_since(since=None):
+    '''Returns the datasets whose metadata (according to the search index) or
+    DataStore fields (see tasks.get_datastore_changes()) have changed since a
+    time.
+
+    :param since: (optional) datetime (UTC). Defaults to all datasets.
+    :returns: OrderedDict of dataset name: datetime (UTC) it last changed,
+        oldest first
+    '''
+    changes = {}
+    context = {'model': model, 'session': model.Session}
+    # pages start from the time the last one got to, rather than an offset,
+    # so that datasets changed in the meantime (which move to the end) don't
+    # shift the pages
+    cursor, offset = since, 0
+    while True:
+        data_dict = {'q': '*:*', 'sort': 'metadata_modified asc, name asc',
+                     'rows': SEARCH_ROWS, 'start': offset,
+                     'fl': 'name,metadata_modified'}
+        if cursor:
+            data_dict['fq'] = 'metadata_modified:[{} TO *]'.format(
+                solr_datetime(cursor))
+        results = toolkit.get_action('package_search')(
+            context, data_dict)['results']
+        for dataset in results:
+            changes[dataset['name']] = \
+                sweep.parse_isoformat(dataset['metadata_modified'])
+        if len(results) < SEARCH_ROWS:
+            break
+        last = changes[results[-1]['name']]
+        if last == cursor:
+            # a page full of datasets changed at the same time
+            offset += len(results)
+        else:
+            cursor, offset = last, 0
+
+    datastore_changes = tasks.get_datastore_changes().since(
+        calendar.timegm(since.utctimetuple()) if since else 0)
+    if datastore_changes:
+        for dataset_id, name in model.Session.query(
+                model.Package.id, model.Package.name) \
+                .filter(model.Package.id.in_(list(datastore_changes))) \
+                .filter(model.Package.state == 'active') \
+                .filter(model.Package.private == False):  # noqa: E712
+            changed = datetime.datetime.utcfromtimestamp(
+                datastore_changes[dataset_id])
+            changes[name] = max(changed, changes.get(name, changed))
+    return collections.OrderedDict(
+        sorted(changes.items(), key=lambda change: (change[1], change[0])))
+
+
+def solr_datetime(datetime_):
+    '''Returns the datetime (UTC) as Solr formats it, truncated to the
+    millisecond.
+    '''
+    return '{}.{:03d}Z'.format(datetime_.strftime('%Y-%m-%dT%H:%M:%S'),
+                               datetime_.microsecond // 1000)
+
+
+def load_sweep_mark():
+    '''Returns the time (UTC) that the last sweep of the changed datasets got
+    up to, or None if there hasn't been one.
+    '''
+    value = model.get_system_info(SWEEP_MARK_KEY)
+    return sweep.parse_isoformat(value) if value else None
+
+
+def save_sweep_mark(value):
+    model.set_system_info(SWEEP_MARK_KEY, value.isoformat())
+
+
+def init_build_process(flask_app):
+    '''Sets up a process of build_all_zips()'s pool.'''
+    if flask_app is not None:
+        # a CKAN app context of its own, for the actions
+        flask_app.test_request_context().push()
+
+
+def build_zip(dataset_name, skip_if_no_changes, compression_level):
+    try:
+        tasks.update_zip(dataset_name, skip_if_no_changes, compression_level)
+    finally:
+        # don't leave a failed transaction for the next dataset's build
+        model.Session.remove()
+
+
+@cli.command('queue-stats',
+             short_help='Show how long zip builds wait in the queue')
+def queue_stats():
+    ''' queue-stats
+
+    Shows the number of jobs in the queues, and how long recent builds of each
+    priority (interactive edits, bulk sweeps) waited in the queue.'''
+    for queue in tasks.get_queue_names():
+        print('Queue {}: {} jobs'.format(
+            queue, jobs_lib.get_queue(queue).count))
+    wait_stats = tasks.get_wait_stats()
+    for priority in jobs.PRIORITIES:
+        summary = wait_stats.summary(priority)
+        if not summary['count']:
+            print('{}: no builds recorded'.format(priority))
+            continue
+        print('{priority}: {count} builds waited mean {mean:.0f}s, '
+              'median {median:.0f}s, 95th percentile {p95:.0f}s, '
+              'max {max:.0f}s'.format(priority=priority, **summary))
+
+
+@cli.command('scheduler',
+             short_help='Run the scheduler of the deferred builds')
+def scheduler():
+    ''' scheduler
+
+    Runs rq's scheduler for the queues of the builds, which queues the builds
+    that were deferred until their dataset stopped changing (see
+    ckanext.downloadall.debounce_seconds) when it is time. CKAN's job workers
+    don't run it. One is enough - others wait to take over if it stops.'''
+    try:
+        from rq.scheduler import RQScheduler
+    except ImportError:
+        raise click.ClickException('The scheduler needs rq 1.2 or later')
+    queues = [jobs_lib.add_queue_name_prefix(queue)
+              for queue in tasks.get_queue_names()]
+    print('Scheduling the deferred builds of queues: {}'
+          .format(', '.join(queues)))
+    RQScheduler(queues, connection=connect_to_redis()).work()
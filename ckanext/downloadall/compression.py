@@ -0,0 +1,178 @@
+'''
+Chooses how to compress each member of the zip. Data that is already
+compressed (zips, images, gzip etc) is stored as it is, because deflating it
+again costs CPU and saves nothing. Other data is compressed at a level chosen
+by a CompressionPolicy.
+
+This doesn't depend on CKAN.
+'''
+import time
+import zipfile
+import zlib
+
+# how much of the start of the data is inspected
+PROBE_SIZE = 64 * 1024
+# data is stored if deflating the probe saves less than this proportion
+MIN_SAVING = 0.05
+
+# resource formats (i.e. file extensions) that are compressed already
+INCOMPRESSIBLE_FORMATS = {
+    # archives
+    '7z', 'bz2', 'gz', 'gzip', 'kmz', 'rar', 'tgz', 'xz', 'zip', 'zst',
+    # office documents, which are zips
+    'docx', 'odp', 'ods', 'odt', 'pptx', 'xlsx',
+    # images, audio and video
+    'gif', 'jp2', 'jpeg', 'jpg', 'png', 'webp',
+    'avi', 'm4a', 'mkv', 'mov', 'mp3', 'mp4', 'ogg', 'webm',
+    # columnar data
+    'parquet',
+}
+INCOMPRESSIBLE_MIMETYPES = {
+    'application/gzip', 'application/vnd.rar', 'application/x-7z-compressed',
+    'application/x-bzip2', 'application/x-gzip', 'application/x-xz',
+    'application/zip', 'application/x-zip-compressed', 'application/zstd',
+    'application/vnd.google-earth.kmz',
+    'application/vnd.apache.parquet', 'application/x-parquet',
+    'application/vnd.oasis.opendocument.presentation',
+    'application/vnd.oasis.opendocument.spreadsheet',
+    'application/vnd.oasis.opendocument.text',
+    'application/vnd.openxmlformats-officedocument.presentationml'
+    '.presentation',
+    'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'application/vnd.openxmlformats-officedocument.wordprocessingml'
+    '.document',
+}
+INCOMPRESSIBLE_MIMETYPE_PREFIXES = ('image/', 'video/', 'audio/')
+# exceptions to the prefixes
+COMPRESSIBLE_MIMETYPES = {
+    'audio/wav', 'audio/x-wav', 'image/bmp', 'image/svg+xml', 'image/tiff',
+    'image/x-ms-bmp',
+}
+
+AUTO = 'auto'
+LEVELS = tuple(range(10))
+# rough speeds of compression on one core, in bytes per second, for estimating
+# how long a member will take
+DEFLATE_SPEEDS = {1: 90 * 1024 * 1024, 6: 30 * 1024 * 1024,
+                  9: 10 * 1024 * 1024}
+LZMA_SPEED = 3 * 1024 * 1024
+# members this small get the best compression, if there is time
+SMALL_SIZE = 16 * 1024 * 1024
+# members this big get the fastest compression
+LARGE_SIZE = 1024 * 1024 * 1024
+# assumed size of a member whose size isn't known
+UNKNOWN_SIZE = 100 * 1024 * 1024
+# the proportion of the job's remaining time that one member can take
+BUDGET_SHARE = 0.5
+
+# file signatures of compressed data: (offset, bytes, name)
+MAGIC_NUMBERS = (
+    (0, b'PK\x03\x04', 'zip'),
+    (0, b'\x1f\x8b', 'gzip'),
+    (0, b'BZh', 'bzip2'),
+    (0, b'\xfd7zXZ\x00', 'xz'),
+    (0, b'7z\xbc\xaf\x27\x1c', '7z'),
+    (0, b'Rar!\x1a\x07', 'rar'),
+    (0, b'\x28\xb5\x2f\xfd', 'zstd'),
+    (0, b'\x89PNG\r\n\x1a\n', 'png'),
+    (0, b'\xff\xd8\xff', 'jpeg'),
+    (0, b'GIF8', 'gif'),
+    (0, b'PAR1', 'parquet'),
+    (8, b'WEBP', 'webp'),
+    (4, b'ftyp', 'mp4'),
+)
+
+
+def choose_compress_type(format_=None, mimetype=None, head=None):
+    '''Chooses whether to deflate or store a member of the zip.
+
+    :param format_: (optional) the resource's format e.g. 'CSV'
+    :param mimetype: (optional) the resource's MIME type
+    :param head: (optional) the start of the data (see PROBE_SIZE)
+    :returns: (compress_type, reason) where compress_type is
+        zipfile.ZIP_DEFLATED or zipfile.ZIP_STORED and reason is a short
+        explanation, for the log
+    '''
+    format_ = (format_ or '').strip().lower().lstrip('.')
+    if format_ in INCOMPRESSIBLE_FORMATS:
+        return zipfile.ZIP_STORED, 'format is {}'.format(format_)
+
+    mimetype = (mimetype or '').split(';')[0].strip().lower()
+    if mimetype and mimetype not in COMPRESSIBLE_MIMETYPES and (
+            mimetype in INCOMPRESSIBLE_MIMETYPES or
+            mimetype.startswith(INCOMPRESSIBLE_MIMETYPE_PREFIXES)):
+        return zipfile.ZIP_STORED, 'MIME type is {}'.format(mimetype)
+
+    if not head:
+        return zipfile.ZIP_DEFLATED, 'no data to probe'
+
+    for offset, magic, name in MAGIC_NUMBERS:
+        if head[offset:offset + len(magic)] == magic:
+            return zipfile.ZIP_STORED, 'data is {}'.format(name)
+
+    saving = 1 - float(len(zlib.compress(head, 1))) / len(head)
+    if saving < MIN_SAVING:
+        return zipfile.ZIP_STORED, \
+            'probe compressed by only {:.0%}'.format(saving)
+    return zipfile.ZIP_DEFLATED, 'probe compressed by {:.0%}'.format(saving)
+
+
+class CompressionPolicy(object):
+    '''Chooses the compression method and level for each member of a zip
+    that is worth compressing.
+
+    :param level: deflate level (0-9), None for zlib's default, or AUTO to
+        choose each member's level by its size and the time left to build the
+        zip: the best compression for small members, the fastest for huge
+        ones, and faster still if time is running out.
+    :param deadline: (optional) time (as in time.time()) by which the zip
+        must be finished e.g. when the job times out
+    :param workers: number of threads that each large member is deflated with
+    :param allow_lzma: with AUTO, small members may be compressed with LZMA,
+        which is smaller, but can't be opened by every zip program
+    '''
+    def __init__(self, level=None, deadline=None, workers=1,
+                 allow_lzma=False):
+        self.level = level
+        self.deadline = deadline
+        self.workers = workers
+        self.allow_lzma = allow_lzma
+
+    def choose(self, size=None):
+        '''Chooses the compression of a member.
+
+        :param size: (optional) the member's size in bytes
+        :returns: (compress_type, level, reason) where reason is a short
+            explanation, for the log. level is None for zlib's default.
+        '''
+        if self.level != AUTO:
+            return zipfile.ZIP_DEFLATED, self.level, 'level {}'.format(
+                'default' if self.level is None else self.level)
+
+        estimated_size = int(size) if size else UNKNOWN_SIZE
+        # in order of preference
+        candidates = []
+        if size and estimated_size <= SMALL_SIZE:
+            if self.allow_lzma:
+                candidates.append((zipfile.ZIP_LZMA, None, LZMA_SPEED))
+            candidates.append((zipfile.ZIP_DEFLATED, 9, DEFLATE_SPEEDS[9]))
+        if estimated_size < LARGE_SIZE:
+            candidates.append((zipfile.ZIP_DEFLATED, 6, DEFLATE_SPEEDS[6]))
+        candidates.append((zipfile.ZIP_DEFLATED, 1, DEFLATE_SPEEDS[1]))
+
+        seconds_left = self.deadline - time.time() if self.deadline else None
+        for compress_type, level, speed in candidates:
+            if compress_type == zipfile.ZIP_DEFLATED:
+                speed *= self.workers
+            if seconds_left is None or \
+                    float(estimated_size) / speed <= \
+                    seconds_left * BUDGET_SHARE:
+                break
+        reason = 'auto {}'.format(
+            'LZMA' if compress_type == zipfile.ZIP_LZMA
+            else 'level {}'.format(level))
+        if not size:
+            reason += ' for unknown size'
+        if seconds_left is not None:
+            reason += ' with {}s left'.format(int(seconds_left))
+        return compress_type, level, reason
@@ -1,3 +1,6 @@
+from ckan.plugins import toolkit
+
+
 def pop_zip_resource(pkg):
     '''Finds the zip resource in a package's resources, removes it from the
     package and returns it. NB the package doesn't have the zip resource in it
@@ -12,3 +15,14 @@ def pop_zip_resource(pkg):
             non_zip_resources.append(res)
     pkg['resources'] = non_zip_resources
     return zip_res
+
+
+def download_url(pkg, zip_res):
+    '''Returns the URL of the "Download all" button: the streamed download,
+    if ckanext.downloadall.streamed_download is enabled, otherwise the zip
+    resource's (or None if it has not been built yet).
+    '''
+    if toolkit.asbool(toolkit.config.get(
+            'ckanext.downloadall.streamed_download', False)):
+        return toolkit.url_for('downloadall.download_zip', id=pkg['name'])
+    return zip_res['url'] if zip_res else None
@@ -0,0 +1,433 @@
+'''
+Keeps track of the datasets whose zip is queued to be updated, so that a
+dataset that changes again before its job has started isn't queued twice.
+
+Each queued dataset has a Redis key, holding the id of its job, which is
+deleted when the job starts. So checking whether a dataset is queued costs a
+couple of Redis lookups, however many jobs are queued, rather than a scan of
+the whole queue.
+
+Optionally a job that starts while its dataset is still changing is deferred
+until the dataset has stopped changing for a while (see
+QueuedDatasets.quiet_at() and defer()), so that a burst of edits leads to one
+build. It is scheduled to run again, rather than holding a worker waiting.
+
+Jobs have a priority: INTERACTIVE (a dataset was edited) or BULK (e.g. a
+sweep of every dataset). Interactive jobs go ahead of bulk ones - in a queue
+of their own, or, if they share one, in the order they were queued but in
+front of the bulk ones (see keep_in_arrival_order()) - but each
+organization can only have so many interactive jobs a minute (see
+OrganizationRateLimit) - the rest are bulk - so one publisher's mass edits
+don't hold up everyone else. Bulk sweeps take the organizations in turn (see
+interleave()). How long the jobs of each priority wait in the queue is
+recorded (see WaitStats).
+
+Changes to datasets' DataStore fields (which don't change the datasets'
+metadata_modified) are recorded too (see DatastoreChanges), for sweeps of the
+datasets changed since a time.
+
+This doesn't depend on CKAN.
+'''
+import collections
+import datetime
+import math
+import time
+
+import six
+from rq import Queue
+from rq.exceptions import NoSuchJobError
+from rq.job import Job, JobStatus
+
+KEY_PREFIX = 'downloadall:queued:'
+CHANGED_KEY_PREFIX = 'downloadall:changed:'
+RATE_KEY_PREFIX = 'downloadall:rate:'
+WAITS_KEY_PREFIX = 'downloadall:waits:'
+DATASTORE_CHANGES_KEY = 'downloadall:datastore_changes'
+INTERACTIVE_TAIL_KEY_PREFIX = 'downloadall:interactive_tail:'
+
+INTERACTIVE = 'interactive'
+BULK = 'bulk'
+PRIORITIES = (INTERACTIVE, BULK)
+# the number of recent waits kept for each priority
+WAITS_KEPT = 1000
+# how long DataStore changes are remembered for, in seconds
+DATASTORE_CHANGES_TTL = 30 * 24 * 60 * 60
+# the value of a dataset's key while its job is being enqueued
+ENQUEUING = 'enqueuing'
+# how long a key lasts, in case its job is lost without starting (e.g. the
+# worker's machine is lost). Jobs that are deleted from the queue are spotted
+# anyway.
+ENQUEUING_TTL = 60
+QUEUED_TTL = 7 * 24 * 60 * 60
+# (a deferred job is SCHEDULED, which is new in rq 1.2. A job is STARTED
+# briefly before it calls release())
+WAITING_STATUSES = tuple(
+    getattr(JobStatus, status)
+    for status in ('QUEUED', 'DEFERRED', 'SCHEDULED', 'STARTED')
+    if hasattr(JobStatus, status))
+
+
+class QueuedDatasets(object):
+    '''The datasets that have a job queued to update their zip.
+
+    Usage, when a dataset changes::
+
+        if queued_datasets.claim(dataset_id):
+            job = queue.enqueue(...)
+            queued_datasets.set_job(dataset_id, job.id)
+
+    and when the job starts::
+
+        queued_datasets.release(dataset_id)
+
+    To debounce the changes, call touch() after claim() on every change, and
+    when the job starts, if quiet_at() is in the future, defer() it and
+    set_job() the deferred job, rather than release().
+
+    :param connection: Redis connection
+    :param prefix: (optional) prefix of the keys e.g. to separate the sites
+        that share a Redis
+    '''
+    def __init__(self, connection, prefix=''):
+        self.connection = connection
+        self.prefix = prefix + KEY_PREFIX
+        self.changed_prefix = prefix + CHANGED_KEY_PREFIX
+
+    def key(self, dataset_id):
+        return self.prefix + dataset_id
+
+    def changed_key(self, dataset_id):
+        return self.changed_prefix + dataset_id
+
+    def claim(self, dataset_id):
+        '''Returns True if the dataset isn't queued already, in which case it
+        is marked as queued, and the caller should enqueue its job and call
+        set_job() (or release() if that fails).
+        '''
+        key = self.key(dataset_id)
+        if self.connection.set(key, ENQUEUING, nx=True, ex=ENQUEUING_TTL):
+            return True
+        job_id = self.connection.get(key)
+        if job_id is None:
+            # it was released in the meantime
+            return bool(self.connection.set(
+                key, ENQUEUING, nx=True, ex=ENQUEUING_TTL))
+        job_id = six.ensure_text(job_id)
+        if job_id == ENQUEUING or self.is_waiting(job_id):
+            return False
+        # its job has gone without starting (e.g. the queue was emptied)
+        self.connection.set(key, ENQUEUING, ex=ENQUEUING_TTL)
+        return True
+
+    def claim_many(self, dataset_ids):
+        '''Like claim(), for many datasets at once, in a few round trips to
+        Redis, rather than a couple for each. Datasets that appear more than
+        once are claimed once.
+
+        :returns: the ids of the datasets claimed
+        '''
+        dataset_ids = list(dataset_ids)
+        pipe = self.connection.pipeline()
+        for dataset_id in dataset_ids:
+            pipe.set(self.key(dataset_id), ENQUEUING, nx=True,
+                     ex=ENQUEUING_TTL)
+        results = pipe.execute()
+        claimed = [dataset_id for dataset_id, result
+                   in zip(dataset_ids, results) if result]
+        others = [dataset_id for dataset_id, result
+                  in zip(dataset_ids, results) if not result]
+        if not others:
+            return claimed
+
+        # like claim(), check the jobs of those that are queued already
+        job_ids = self.connection.mget([self.key(dataset_id)
+                                        for dataset_id in others])
+        released = []
+        to_check = []
+        for dataset_id, job_id in zip(others, job_ids):
+            if job_id is None:
+                released.append(dataset_id)
+            elif six.ensure_text(job_id) != ENQUEUING:
+                to_check.append((dataset_id, six.ensure_text(job_id)))
+        pipe = self.connection.pipeline()
+        for dataset_id, job_id in to_check:
+            pipe.hget(Job.key_for(job_id), 'status')
+        gone = [dataset_id for (dataset_id, job_id), status
+                in zip(to_check, pipe.execute())
+                if status is None or
+                six.ensure_text(status) not in WAITING_STATUSES]
+
+        pipe = self.connection.pipeline()
+        for dataset_id in released:
+            pipe.set(self.key(dataset_id), ENQUEUING, nx=True,
+                     ex=ENQUEUING_TTL)
+        for dataset_id in gone:
+            pipe.set(self.key(dataset_id), ENQUEUING, ex=ENQUEUING_TTL)
+        results = pipe.execute()
+        claimed.extend(dataset_id for dataset_id, result
+                       in zip(released + gone, results) if result)
+        return claimed
+
+    def set_job(self, dataset_id, job_id):
+        '''Records the job that was enqueued for the dataset.'''
+        self.connection.set(self.key(dataset_id), job_id, ex=QUEUED_TTL)
+
+    def set_jobs(self, job_ids):
+        '''Like set_job(), for many datasets at once.
+
+        :param job_ids: dict of dataset id: job id
+        '''
+        pipe = self.connection.pipeline()
+        for dataset_id, job_id in job_ids.items():
+            pipe.set(self.key(dataset_id), job_id, ex=QUEUED_TTL)
+        pipe.execute()
+
+    def release(self, dataset_id):
+        '''Marks the dataset as no longer queued i.e. its job has started, so
+        any further change to it needs another job.
+        '''
+        self.release_many([dataset_id])
+
+    def release_many(self, dataset_ids):
+        keys = []
+        for dataset_id in dataset_ids:
+            keys.extend((self.key(dataset_id), self.changed_key(dataset_id)))
+        if keys:
+            self.connection.delete(*keys)
+
+    def touch(self, dataset_id, max_delay):
+        '''Records that the dataset has changed (now), which pushes back the
+        build, if its job is deferred (see quiet_at()).
+
+        :param max_delay: how long the record is needed for, in seconds
+        '''
+        key = self.changed_key(dataset_id)
+        now = time.time()
+        pipe = self.connection.pipeline()
+        pipe.hsetnx(key, 'first', now)
+        pipe.hset(key, 'last', now)
+        pipe.expire(key, int(max_delay) + ENQUEUING_TTL)
+        pipe.execute()
+
+    def quiet_at(self, dataset_id, debounce, max_delay):
+        '''Returns when the dataset will have stopped changing (see touch())
+        for debounce seconds, or max_delay seconds after its first change,
+        whichever is sooner - the time its build should not start before.
+
+        :returns: the time (seconds since the epoch), or None if that has
+            passed already
+        '''
+        first, last = self.connection.hmget(
+            self.changed_key(dataset_id), 'first', 'last')
+        if first is None or last is None:
+            return None
+        not_before = min(float(last) + debounce, float(first) + max_delay)
+        if not_before <= time.time():
+            return None
+        return not_before
+
+    def is_waiting(self, job_id):
+        '''Returns whether the job is waiting to start building - queued,
+        or deferred (i.e. it hasn't called release() yet).
+        '''
+        try:
+            job = Job.fetch(job_id, connection=self.connection)
+        except NoSuchJobError:
+            return False
+        return job.get_status() in WAITING_STATUSES
+
+
+def is_scheduler_running(connection, queue_name):
+    '''Returns whether an rq scheduler (rq 1.2+) is enqueuing the scheduled
+    jobs of the queue, i.e. whether a job deferred with defer() will run.
+
+    :param queue_name: the queue's full name, e.g. job.origin
+    '''
+    try:
+        from rq.scheduler import RQScheduler
+    except ImportError:
+        return False
+    return bool(connection.exists(RQScheduler.get_locking_key(queue_name)))
+
+
+# Moves a job that was just pushed onto the front of a queue (KEYS[1]) back
+# to behind the last one that was moved like this (its id is in KEYS[2]),
+# if that is still queued. (Jobs are taken from the front of the queue, so if
+# it isn't queued, neither are the ones before it.)
+KEEP_IN_ARRIVAL_ORDER_SCRIPT = '''
+local previous = redis.call('GET', KEYS[2])
+redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+if not previous or previous == ARGV[1] then
+    return 0
+end
+if redis.call('LREM', KEYS[1], 1, ARGV[1]) == 0 then
+    -- it has been taken already
+    return 0
+end
+if redis.call('LINSERT', KEYS[1], 'AFTER', previous, ARGV[1]) == -1 then
+    redis.call('LPUSH', KEYS[1], ARGV[1])
+end
+return 1
+'''
+
+
+def keep_in_arrival_order(job):
+    '''Moves an interactive job that was enqueued at the front of its queue
+    (at_front), ahead of the bulk jobs that share the queue, back behind the
+    interactive jobs queued before it, so that interactive jobs still run in
+    the order they were queued. It is one Redis round trip, and only looks
+    through the interactive jobs at the front of the queue, however many bulk
+    jobs are behind them.
+    '''
+    queue = Queue(job.origin, connection=job.connection)
+    job.connection.eval(
+        KEEP_IN_ARRIVAL_ORDER_SCRIPT, 2, queue.key,
+        INTERACTIVE_TAIL_KEY_PREFIX + job.origin, job.id, QUEUED_TTL)
+
+
+def defer(job, until, at_front=False):
+    '''Schedules another job like the given one (the same function,
+    arguments, queue, timeout and meta), to run at a later time, for when the
+    given job returns without doing its work. It needs an rq scheduler (see
+    is_scheduler_running()).
+
+    :param until: the time to run it (seconds since the epoch)
+    :param at_front: whether it goes at the front of the queue when it is due
+    :returns: the new job
+    '''
+    queue = Queue(job.origin, connection=job.connection)
+    # (rq schedules to the second, rounding down, which would be too early)
+    until = math.ceil(until)
+    return queue.enqueue_at(
+        datetime.datetime.fromtimestamp(until, datetime.timezone.utc),
+        job.func_name, args=job.args, kwargs=job.kwargs,
+        job_timeout=job.timeout, description=job.description,
+        meta=dict(job.meta), at_front=at_front)
+
+
+def enqueue_many(queue, jobs_data):
+    '''Enqueues jobs in one round trip to Redis, where rq supports it (1.9+),
+    otherwise one at a time.
+
+    :param queue: rq.Queue
+    :param jobs_data: list of dicts of the keyword arguments of
+        Queue.enqueue_call() for each job
+    :returns: list of the jobs
+    '''
+    if not hasattr(queue, 'enqueue_many'):
+        return [queue.enqueue_call(**job_data) for job_data in jobs_data]
+    return queue.enqueue_many(
+        [Queue.prepare_data(**job_data) for job_data in jobs_data])
+
+
+class OrganizationRateLimit(object):
+    '''Limits the number of interactive jobs each organization can have in a
+    period.
+
+    :param connection: Redis connection
+    :param limit: the number of jobs in each period (0 for no limit)
+    :param period: in seconds
+    :param prefix: (optional) prefix of the keys
+    '''
+    def __init__(self, connection, limit, period=60, prefix=''):
+        self.connection = connection
+        self.limit = limit
+        self.period = period
+        self.prefix = prefix + RATE_KEY_PREFIX
+
+    def allow(self, organization):
+        '''Counts a job for the organization, and returns whether it is
+        within the limit.
+        '''
+        if not self.limit:
+            return True
+        key = '{}{}:{}'.format(self.prefix, organization or '',
+                               int(time.time() // self.period))
+        pipe = self.connection.pipeline()
+        pipe.incr(key)
+        pipe.expire(key, self.period * 2)
+        count = pipe.execute()[0]
+        return count <= self.limit
+
+
+class WaitStats(object):
+    '''The time that recent jobs of each priority waited in the queue, from
+    being enqueued to starting.
+
+    :param connection: Redis connection
+    :param prefix: (optional) prefix of the keys
+    '''
+    def __init__(self, connection, prefix=''):
+        self.connection = connection
+        self.prefix = prefix + WAITS_KEY_PREFIX
+
+    def record(self, priority, seconds):
+        key = self.prefix + priority
+        pipe = self.connection.pipeline()
+        pipe.lpush(key, '{:.3f}'.format(seconds))
+        pipe.ltrim(key, 0, WAITS_KEPT - 1)
+        pipe.execute()
+
+    def summary(self, priority):
+        '''Returns a summary of the recent waits of jobs of the priority.
+
+        :returns: dict with keys count, mean, median, p95 and max (seconds),
+            or just count, if it is 0
+        '''
+        waits = sorted(float(wait) for wait in self.connection.lrange(
+            self.prefix + priority, 0, -1))
+        if not waits:
+            return {'count': 0}
+        return {
+            'count': len(waits),
+            'mean': sum(waits) / len(waits),
+            'median': waits[len(waits) // 2],
+            'p95': waits[min(len(waits) - 1, int(len(waits) * 0.95))],
+            'max': waits[-1],
+        }
+
+
+def interleave(items, key):
+    '''Returns the items, taking one from each group (of items with the same
+    key) in turn, so no group goes long without any. The order within a group
+    is kept.
+
+    e.g. interleave(datasets, key=lambda dataset: dataset['owner_org'])
+    '''
+    groups = collections.OrderedDict()
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    interleaved = []
+    for round_ in six.moves.zip_longest(*groups.values()):
+        interleaved.extend(item for item in round_ if item is not None)
+    return interleaved
+
+
+class DatastoreChanges(object):
+    '''When the DataStore fields of each dataset last changed, for the last
+    DATASTORE_CHANGES_TTL.
+
+    :param connection: Redis connection
+    :param prefix: (optional) prefix of the key
+    '''
+    def __init__(self, connection, prefix=''):
+        self.connection = connection
+        self.key = prefix + DATASTORE_CHANGES_KEY
+
+    def add(self, dataset_id):
+        '''Records that the dataset's DataStore fields have changed (now).'''
+        now = time.time()
+        pipe = self.connection.pipeline()
+        pipe.zadd(self.key, {dataset_id: now})
+        pipe.zremrangebyscore(self.key, '-inf', now - DATASTORE_CHANGES_TTL)
+        pipe.execute()
+
+    def since(self, timestamp):
+        '''Returns the datasets changed since the time (as in time.time()).
+
+        :returns: dict of dataset id: time it last changed
+        '''
+        return dict(
+            (six.ensure_text(dataset_id), changed)
+            for dataset_id, changed in self.connection.zrangebyscore(
+                self.key, timestamp, '+inf', withscores=True))
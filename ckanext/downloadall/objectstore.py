@@ -0,0 +1,171 @@
+'''
+Streams the zip into S3-compatible object storage as it is written, as a
+multipart upload, so it is never stored on local disk. The data is held in
+memory a part at a time: the part being filled, and those being uploaded.
+
+boto3 is only needed if this is used.
+
+This doesn't depend on CKAN.
+'''
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# S3's limits on multipart uploads. (The last part can be smaller.)
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+DEFAULT_KEY_TEMPLATE = 'resources/{resource_id}/{filename}'
+
+
+def make_client(endpoint_url=None, region_name=None, aws_access_key_id=None,
+                aws_secret_access_key=None):
+    '''Returns a boto3 S3 client. Credentials that aren't given are found by
+    boto3 as usual (e.g. environment variables or an instance role).
+    '''
+    try:
+        import boto3
+    except ImportError:
+        raise ImportError('boto3 is needed to store the zips in object '
+                          'storage: pip install boto3')
+    return boto3.client(
+        's3', endpoint_url=endpoint_url, region_name=region_name,
+        aws_access_key_id=aws_access_key_id,
+        aws_secret_access_key=aws_secret_access_key)
+
+
+class ObjectStorage(object):
+    '''A bucket that zips are stored in.
+
+    :param client: boto3 S3 client (see make_client())
+    :param key_template: the key of a resource's file, formatted with
+        resource_id and filename. It needs to match where the CKAN's uploader
+        (e.g. ckanext-s3filestore) stores resources.
+    :param part_size: the size of each part of a multipart upload, in bytes
+    :param concurrency: the number of parts uploaded at once
+    '''
+    def __init__(self, client, bucket, key_template=DEFAULT_KEY_TEMPLATE,
+                 part_size=DEFAULT_PART_SIZE, concurrency=2):
+        self.client = client
+        self.bucket = bucket
+        self.key_template = key_template
+        self.part_size = part_size
+        self.concurrency = concurrency
+
+    def key(self, resource_id, filename):
+        return self.key_template.format(resource_id=resource_id,
+                                        filename=filename)
+
+    def open(self, key, content_type='application/zip'):
+        '''Returns a MultipartUploadWriter of the object.'''
+        return MultipartUploadWriter(
+            self.client, self.bucket, key, part_size=self.part_size,
+            concurrency=self.concurrency, content_type=content_type)
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+
+class MultipartUploadWriter(object):
+    '''A file-like object that uploads what is written to it to an object, in
+    parts, as they fill up. It can't seek, which zipfile copes with.
+
+    The object only appears when close() completes the upload (and replaces
+    any existing one at once). If the upload is abandoned, call abort(), or
+    the parts are kept (and charged for) by the object storage.
+    '''
+    def __init__(self, client, bucket, key, part_size=DEFAULT_PART_SIZE,
+                 concurrency=2, content_type='application/zip'):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError('The part size must be at least {} bytes'
+                             .format(MIN_PART_SIZE))
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.name = 's3://{}/{}'.format(bucket, key)
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.buffer = bytearray()
+        self.position = 0
+        self.parts = []
+        # (part number, future) of the parts being uploaded, oldest first
+        self.uploading = collections.deque()
+        self.executor = ThreadPoolExecutor(concurrency)
+        self.closed = False
+        self.upload_id = client.create_multipart_upload(
+            Bucket=bucket, Key=key, ContentType=content_type)['UploadId']
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self.position
+
+    def write(self, data):
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            part = bytes(self.buffer[:self.part_size])
+            del self.buffer[:self.part_size]
+            self._upload_part(part)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _upload_part(self, data):
+        # wait for a part to finish, so no more than concurrency parts are
+        # held in memory
+        while len(self.uploading) >= self.concurrency:
+            self._wait_for_oldest_part()
+        part_number = len(self.parts) + len(self.uploading) + 1
+        if part_number > MAX_PARTS:
+            raise ValueError('The zip is too big for {} parts of {} bytes - '
+                             'increase the part size'
+                             .format(MAX_PARTS, self.part_size))
+        self.uploading.append((part_number, self.executor.submit(
+            self.client.upload_part, Bucket=self.bucket, Key=self.key,
+            UploadId=self.upload_id, PartNumber=part_number, Body=data)))
+
+    def _wait_for_oldest_part(self):
+        part_number, future = self.uploading.popleft()
+        self.parts.append({'PartNumber': part_number,
+                           'ETag': future.result()['ETag']})
+
+    def close(self):
+        '''Uploads the rest, and completes the upload.'''
+        if self.closed:
+            return
+        try:
+            if self.buffer or not (self.parts or self.uploading):
+                self._upload_part(bytes(self.buffer))
+                self.buffer = bytearray()
+            while self.uploading:
+                self._wait_for_oldest_part()
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                MultipartUpload={'Parts': self.parts})
+        except Exception:
+            self.abort()
+            raise
+        self.closed = True
+        self.executor.shutdown()
+
+    def abort(self):
+        '''Abandons the upload, deleting the parts uploaded.'''
+        if self.closed:
+            return
+        self.closed = True
+        for part_number, future in self.uploading:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+        self.client.abort_multipart_upload(
+            Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
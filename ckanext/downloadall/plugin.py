@@ -1,17 +1,21 @@
-import re
+import collections
 import logging
 
+import sqlalchemy as sa
+
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 
-from ckan.lib.jobs import DEFAULT_QUEUE_NAME
 from ckan.lib.plugins import DefaultTranslation
 
 from ckan import model
 
-from ckanext.downloadall import helpers, action
+from ckanext.downloadall import helpers, action, jobs, views
 from ckanext.downloadall.cli import cli
-from ckanext.downloadall.tasks import update_zip
+from ckanext.downloadall.tasks import (
+    update_zip, get_queued_datasets, get_debounce_seconds,
+    get_debounce_max_seconds, get_lane, get_dataset_lane, get_job_options,
+    get_organization_rate_limit)
 
 log = logging.getLogger(__name__)
 
@@ -24,11 +28,16 @@ class DownloadallPlugin(plugins.SingletonPlugin, DefaultTranslation):
     plugins.implements(plugins.IPackageController, inherit=True)
     plugins.implements(plugins.IActions)
     plugins.implements(plugins.IClick)
+    plugins.implements(plugins.IBlueprint)
 
     # IClick
     def get_commands(self):
         return [cli]
 
+    # IBlueprint
+    def get_blueprint(self):
+        return views.get_blueprints()
+
     # IConfigurer
     def update_config(self, config_):
         toolkit.add_template_directory(config_, 'templates')
@@ -56,24 +65,30 @@ class DownloadallPlugin(plugins.SingletonPlugin, DefaultTranslation):
         # 5 if this was just an update of the Download All zip itself
         #   (or you get an infinite loop)
         #
-        # 4 - we're ignoring this for now (ideally new data means a new URL)
+        # 4 - we're ignoring this here (ideally new data means a new URL), but
+        #     update_zip can spot it with ckanext.downloadall.
+        #     check_remote_resources
         # 1&2&3 - will change package.json and notify(res) and possibly
         #         notify(package) too
         # 5 - will cause these notifies but package.json only in limit places
         #
         # SO if package.json (not including Package Zip bits) remains the same
         # then we don't need to regenerate zip.
+        #
+        # The datasets are enqueued once each, after the commit (see
+        # queue_update_zip()).
         if isinstance(entity, model.Package):
             if entity.type == 'dataset':
-                enqueue_update_zip(entity.name, entity.id, operation)
+                queue_update_zip(entity, operation)
         elif isinstance(entity, model.Resource):
             if entity.extras.get('downloadall_metadata_modified'):
                 # this is the zip of all the resources - no need to react to
                 # it being changed
                 log.debug('Ignoring change to zip resource')
                 return
-            dataset = entity.related_packages()[0]
-            enqueue_update_zip(dataset.name, dataset.id, operation)
+            # (the relation is usually loaded already, unlike
+            # related_packages(), which queries every time)
+            queue_update_zip(entity.package, operation)
         else:
             return
 
@@ -81,6 +96,7 @@ class DownloadallPlugin(plugins.SingletonPlugin, DefaultTranslation):
     def get_helpers(self):
         return {
             'downloadall__pop_zip_resource': helpers.pop_zip_resource,
+            'downloadall__download_url': helpers.download_url,
         }
 
     # IPackageController
@@ -106,29 +122,88 @@ class DownloadallPlugin(plugins.SingletonPlugin, DefaultTranslation):
         return actions
 
 
-def enqueue_update_zip(dataset_name, dataset_id, operation):
+SESSION_INFO_KEY = 'downloadall_datasets'
+
+
+def queue_update_zip(dataset, operation):
+    '''Notes that a dataset's zip needs updating, once the session's
+    transaction is committed. However many times a dataset is noted (e.g. for
+    each of its resources), it is enqueued once, with the first operation.
+
+    :param dataset: model.Package
+    '''
+    datasets = model.Session.info.setdefault(
+        SESSION_INFO_KEY, collections.OrderedDict())
+    if dataset.id not in datasets:
+        # (after the commit, the database can't be queried)
+        datasets[dataset.id] = (dataset.name, operation, get_lane(dataset),
+                                dataset.owner_org)
+
+
+@sa.event.listens_for(model.Session, 'after_commit')
+def enqueue_queued_datasets(session):
+    datasets = session.info.pop(SESSION_INFO_KEY, None)
+    for dataset_id, (dataset_name, operation, lane, organization) in \
+            (datasets or {}).items():
+        try:
+            enqueue_update_zip(dataset_name, dataset_id, operation, lane,
+                               organization)
+        except Exception:
+            # the changes are saved, so the request shouldn't fail now
+            log.exception('Could not queue dataset: {} {}'
+                          .format(dataset_name, dataset_id))
+
+
+@sa.event.listens_for(model.Session, 'after_rollback')
+def forget_queued_datasets(session):
+    session.info.pop(SESSION_INFO_KEY, None)
+
+
+def enqueue_update_zip(dataset_name, dataset_id, operation, lane=None,
+                       organization=None, priority=jobs.INTERACTIVE):
+    '''Enqueues a job to update a dataset's zip, unless one is queued
+    already.
+
+    :param lane: (optional) the lane of the build (see tasks.get_lane()).
+        Defaults to estimating it from the dataset.
+    :param organization: (optional) id of the dataset's organization, whose
+        interactive builds are rate limited (see
+        tasks.get_organization_rate_limit())
+    :param priority: jobs.INTERACTIVE (default) or jobs.BULK
+    '''
     # skip task if the dataset is already queued
-    queue = DEFAULT_QUEUE_NAME
-    jobs = toolkit.get_action('job_list')(
-        {'ignore_auth': True}, {'queues': [queue]})
-    if jobs:
-        for job in jobs:
-            if not job['title']:
-                continue
-            match = re.match(
-                r'DownloadAll \w+ "[^"]*" ([\w-]+)', job['title'])
-            if match:
-                queued_dataset_id = match.groups()[0]
-                if dataset_id == queued_dataset_id:
-                    log.info('Already queued dataset: {} {}'
-                             .format(dataset_name, dataset_id))
-                    return
+    queued_datasets = get_queued_datasets()
+    claimed = queued_datasets.claim(dataset_id)
+    if get_debounce_seconds():
+        # push back the build, if it is waiting for changes to stop
+        queued_datasets.touch(dataset_id, get_debounce_max_seconds())
+    if not claimed:
+        log.info('Already queued dataset: {} {}'
+                 .format(dataset_name, dataset_id))
+        return
 
     # add this dataset to the queue
     log.debug('Queuing job update_zip: {} {}' .format(operation, dataset_name))
 
-    toolkit.enqueue_job(
-        update_zip, [dataset_id],
-        title='DownloadAll {} "{}" {}'.format(operation, dataset_name, dataset_id),
-        queue=queue,
-        rq_kwargs={"timeout": 1800})
+    if priority == jobs.INTERACTIVE and organization and \
+            not get_organization_rate_limit().allow(organization):
+        # don't let one organization's mass edits hold up everyone else's
+        log.info('Queuing as bulk, as its organization is over the rate '
+                 'limit: {} {}'.format(organization, dataset_name))
+        priority = jobs.BULK
+
+    try:
+        queue, rq_kwargs = get_job_options(
+            lane or get_dataset_lane(dataset_id), priority)
+        job = toolkit.enqueue_job(
+            update_zip, [dataset_id],
+            title='DownloadAll {} "{}" {}'.format(
+                operation, dataset_name, dataset_id),
+            queue=queue,
+            rq_kwargs=rq_kwargs)
+        if rq_kwargs.get('at_front'):
+            jobs.keep_in_arrival_order(job)
+    except Exception:
+        queued_datasets.release(dataset_id)
+        raise
+    queued_datasets.set_job(dataset_id, job.id)
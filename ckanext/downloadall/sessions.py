@@ -0,0 +1,115 @@
+'''
+A pooled HTTP session for downloading resources, so that connections (and
+their TCP and TLS handshakes) are kept alive and reused, both between the
+resources of a build and between the builds run by a worker process.
+
+This doesn't depend on CKAN.
+'''
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+DEFAULT_POOL_SIZE = 10
+
+_lock = threading.Lock()
+_session = None
+_session_key = None
+
+
+class ConnectionStats(object):
+    '''Counts the HTTP connections opened, and the requests made on them, by
+    the sessions of this process. Requests that didn't need a new connection
+    reused one.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.requests = 0
+
+    def increment(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def snapshot(self):
+        '''Returns the counts so far, as (opened, reused).'''
+        with self._lock:
+            return self.opened, max(self.requests - self.opened, 0)
+
+
+stats = ConnectionStats()
+
+
+class _CountingPoolMixin(object):
+    def _new_conn(self):
+        stats.increment('opened')
+        return super(_CountingPoolMixin, self)._new_conn()
+
+    def _make_request(self, *args, **kwargs):
+        stats.increment('requests')
+        return super(_CountingPoolMixin, self)._make_request(*args, **kwargs)
+
+
+class CountingHTTPConnectionPool(_CountingPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class CountingHTTPSConnectionPool(_CountingPoolMixin, HTTPSConnectionPool):
+    pass
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    '''HTTPAdapter whose connection pools count their connections (see
+    ConnectionStats).
+    '''
+    def init_poolmanager(self, *args, **kwargs):
+        super(PooledHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': CountingHTTPConnectionPool,
+            'https': CountingHTTPSConnectionPool,
+        }
+
+
+def make_session(pool_size=DEFAULT_POOL_SIZE):
+    '''Returns a new session, which keeps up to pool_size connections alive
+    to each host. No more than pool_size requests are made to a host at once -
+    any more wait for a connection to be free.
+    '''
+    session = requests.Session()
+    adapter = PooledHTTPAdapter(pool_connections=pool_size,
+                                pool_maxsize=pool_size, pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session(pool_size=DEFAULT_POOL_SIZE):
+    '''Returns this process's session, creating it the first time, or
+    replacing it if pool_size has changed (e.g. a job in the other lane, with
+    more download workers).
+
+    A session inherited from a parent process (i.e. before a fork) is not
+    used, as its connections would be shared with the parent.
+    '''
+    global _session, _session_key
+    with _lock:
+        key = (os.getpid(), pool_size)
+        if _session is None or _session_key != key:
+            if _session is not None and _session_key[0] == key[0]:
+                # its idle connections are closed, and the others when they
+                # are released
+                _session.close()
+            _session = make_session(pool_size)
+            _session_key = key
+        return _session
+
+
+def release(response):
+    '''Finishes with a response without a wanted body (e.g. a 304 Not
+    Modified), returning its connection to the pool. (Closing a response
+    whose body is unread closes the connection too.)
+    '''
+    response.content
+    response.close()
@@ -0,0 +1,533 @@
+'''
+Low-level helpers for copying data into the zip.
+
+These don't depend on CKAN, so they can be benchmarked and tested on their
+own.
+'''
+import collections
+import io
+import mmap
+import os
+import struct
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+from six.moves import queue
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+# size of the chunks that a streamed zip is yielded in (see Pipe)
+DEFAULT_CHUNK_SIZE = 64 * 1024
+# size of the blocks that are deflated in parallel
+DEFAULT_BLOCK_SIZE = 1024 * 1024
+# the deflate window - how much of the previous block primes each block
+DICTIONARY_SIZE = 32 * 1024
+
+# zip local file header
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+LOCAL_HEADER_SIZE = 30
+DATA_DESCRIPTOR_SIGNATURE = b'PK\x07\x08'
+# general purpose flag bits
+FLAG_COMPRESSION_OPTIONS = 0x06
+FLAG_DATA_DESCRIPTOR = 0x08
+
+_executor_lock = threading.Lock()
+_executor = None
+_executor_key = None
+
+
+class ResponseReader(object):
+    '''Wraps the raw urllib3 response of a streamed requests download (i.e.
+    `response.raw`) so that it can be read with readinto(), decoding any
+    Content-Encoding (gzip etc) like response.iter_content() does.
+    '''
+    def __init__(self, raw):
+        self.raw = raw
+        self.raw.decode_content = True
+
+    def readinto(self, buffer_):
+        while True:
+            length = self.raw.readinto(buffer_)
+            # when decoding, urllib3 can return nothing before the end of the
+            # stream, if the decoder is still waiting for more data
+            if length or self.raw.closed:
+                return length
+
+
+class PrefixedStream(object):
+    '''A stream whose start has already been read (by read_head()) - it
+    returns that first, then the rest of the stream.
+    '''
+    def __init__(self, head, source):
+        self.head = memoryview(head)
+        self.source = source
+
+    def readinto(self, buffer_):
+        if self.head:
+            length = min(len(buffer_), len(self.head))
+            buffer_[:length] = self.head[:length]
+            self.head = self.head[length:]
+            return length
+        return _readinto(self.source, buffer_)
+
+
+def _readinto(source, buffer_):
+    readinto = getattr(source, 'readinto', None)
+    if readinto is not None:
+        return readinto(buffer_)
+    chunk = source.read(len(buffer_))
+    buffer_[:len(chunk)] = chunk
+    return len(chunk)
+
+
+def read_head(source, size):
+    '''Reads the start of a stream, so that it can be inspected before it
+    is copied.
+
+    :returns: (head, stream) - the first `size` bytes (or fewer, if the
+        stream is shorter), and a stream to read all the data from,
+        including the head. A local file is simply rewound.
+    '''
+    if is_local_file(source):
+        offset = source.tell()
+        head = source.read(size)
+        source.seek(offset)
+        return head, source
+    buffer_ = bytearray(size)
+    view = memoryview(buffer_)
+    length = 0
+    while length < size:
+        read = _readinto(source, view[length:])
+        if not read:
+            break
+        length += read
+    head = bytes(view[:length])
+    return head, PrefixedStream(head, source)
+
+
+def copy_stream(source, destination, buffer_size=DEFAULT_BUFFER_SIZE,
+                hash_object=None):
+    '''Copies a stream, through a single reusable buffer, optionally also
+    feeding the data into a hash as it passes.
+
+    :param source: file-like object to read from. A local file is
+        memory-mapped, and other streams are read with readinto() where
+        available, to avoid allocating memory for every chunk.
+    :param destination: file-like object to write to
+    :param buffer_size: number of bytes to copy at a time
+    :param hash_object: (optional) hashlib object to update with the data
+    :returns: the number of bytes copied
+    '''
+    if is_local_file(source):
+        size = copy_mapped_file(source, destination, buffer_size,
+                                hash_object)
+        if size is not None:
+            return size
+
+    size = 0
+    readinto = getattr(source, 'readinto', None)
+    if readinto is None:
+        while True:
+            chunk = source.read(buffer_size)
+            if not chunk:
+                return size
+            destination.write(chunk)
+            if hash_object is not None:
+                hash_object.update(chunk)
+            size += len(chunk)
+
+    buffer_ = bytearray(buffer_size)
+    view = memoryview(buffer_)
+    while True:
+        length = readinto(buffer_)
+        if not length:
+            return size
+        chunk = view[:length]
+        destination.write(chunk)
+        if hash_object is not None:
+            hash_object.update(chunk)
+        size += length
+
+
+def is_local_file(source):
+    return isinstance(source, io.BufferedReader) and \
+        isinstance(source.raw, io.FileIO)
+
+
+def get_local_file_size(source):
+    '''Returns the number of bytes left to read of a local file, from the
+    file system, or None if the source isn't a local file.
+    '''
+    if not is_local_file(source):
+        return None
+    return os.fstat(source.fileno()).st_size - source.tell()
+
+
+def copy_mapped_file(source, destination, buffer_size=DEFAULT_BUFFER_SIZE,
+                     hash_object=None):
+    '''Copies the rest of a local file by memory-mapping it, so that the
+    data is passed to the destination (and hash) straight from the page
+    cache, without being copied into a buffer first.
+
+    :returns: the number of bytes copied, or None if the file can't be mapped
+        (e.g. it is empty, or the file system doesn't support it)
+    '''
+    offset = source.tell()
+    try:
+        mapped = mmap.mmap(source.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        return None
+    try:
+        with memoryview(mapped) as view:
+            size = len(view)
+            for start in range(offset, size, buffer_size):
+                chunk = view[start:start + buffer_size]
+                destination.write(chunk)
+                if hash_object is not None:
+                    hash_object.update(chunk)
+                chunk.release()
+    finally:
+        mapped.close()
+    source.seek(size)
+    return max(size - offset, 0)
+
+
+def copy_member(source, zip_info, zipf, filename=None, date_time=None,
+                buffer_size=DEFAULT_BUFFER_SIZE):
+    '''Copies a member of one zip into another, as its compressed bytes, i.e.
+    without decompressing and compressing it again.
+
+    zipfile has no public API for this, so it writes the member the same way
+    as ZipFile.open(name, 'w') does.
+
+    :param source: the source zip file, opened for reading (binary)
+    :param zip_info: ZipInfo of the member in the source zip
+    :param zipf: ZipFile to add the member to. It must not have another
+        member open for writing.
+    :param filename: (optional) name of the member in zipf. Defaults to its
+        name in the source zip.
+    :param date_time: (optional) modified date of the member in zipf.
+        Defaults to its date in the source zip.
+    :returns: the ZipInfo of the member in zipf
+    '''
+    # find the start of the compressed data, after the local header
+    source.seek(zip_info.header_offset)
+    header = source.read(LOCAL_HEADER_SIZE)
+    if header[:4] != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipfile(
+            'Bad local header for {}'.format(zip_info.filename))
+    filename_length, extra_length = struct.unpack('<HH', header[26:30])
+    source.seek(filename_length + extra_length, 1)
+
+    info = zipfile.ZipInfo(filename or zip_info.filename,
+                           date_time or zip_info.date_time)
+    info.compress_type = zip_info.compress_type
+    info.flag_bits = zip_info.flag_bits & FLAG_COMPRESSION_OPTIONS
+    info.external_attr = zip_info.external_attr
+    info.CRC = zip_info.CRC
+    info.compress_size = zip_info.compress_size
+    info.file_size = zip_info.file_size
+
+    zip64 = info.file_size > zipfile.ZIP64_LIMIT or \
+        info.compress_size > zipfile.ZIP64_LIMIT
+    # the sizes and CRC are known up front, so unlike ZipFile.open() there is
+    # no need for a data descriptor after the data, even if zipf.fp can't seek
+    _start_member(zipf, info, zip64)
+    remaining = info.compress_size
+    while remaining:
+        chunk = source.read(min(buffer_size, remaining))
+        if not chunk:
+            raise zipfile.BadZipfile(
+                'Truncated data for {}'.format(zip_info.filename))
+        zipf.fp.write(chunk)
+        remaining -= len(chunk)
+    zipf.start_dir = zipf.fp.tell()
+    _add_member(zipf, info)
+    return info
+
+
+def _start_member(zipf, info, zip64):
+    # writes the local header, the same way as ZipFile.open(name, 'w')
+    if zipf._writing:
+        raise ValueError("Can't write to the zip while another member is "
+                         "open for writing")
+    if not info.external_attr:
+        info.external_attr = 0o600 << 16
+    if zipf._seekable:
+        zipf.fp.seek(zipf.start_dir)
+    info.header_offset = zipf.fp.tell()
+    zipf._writecheck(info)
+    zipf._didModify = True
+    zipf.fp.write(info.FileHeader(zip64))
+
+
+def _add_member(zipf, info):
+    zipf.filelist.append(info)
+    zipf.NameToInfo[info.filename] = info
+
+
+def get_executor(workers):
+    '''Returns this process's pool of compression threads, creating it the
+    first time, or replacing it if the number of workers has changed (e.g.
+    a job in the other lane). (zlib releases the GIL while it compresses, so
+    threads run on separate cores.)
+    '''
+    global _executor, _executor_key
+    with _executor_lock:
+        key = (os.getpid(), workers)
+        if _executor is None or _executor_key != key:
+            if _executor is not None and _executor_key[0] == key[0]:
+                # its threads finish what they were given, then exit
+                _executor.shutdown(wait=False)
+            # (a pool inherited through a fork has no threads, so is left)
+            _executor = ThreadPoolExecutor(max_workers=workers)
+            _executor_key = key
+        return _executor
+
+
+def deflate_block(data, level=zlib.Z_DEFAULT_COMPRESSION, dictionary=None):
+    '''Deflates a block of data so that it can be concatenated with the
+    other blocks into one deflate stream - i.e. it ends on a byte boundary
+    and isn't the final block.
+
+    :param dictionary: (optional) the data before this block, which
+        improves the compression, as the block can refer back to it
+    '''
+    if dictionary:
+        compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL,
+            zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+# an empty final block, which ends the deflate stream
+FINAL_BLOCK = zlib.compressobj(
+    zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -zlib.MAX_WBITS).flush()
+
+
+class ParallelDeflateWriter(object):
+    '''File-like object for writing a member to a zip, like the one returned
+    by ZipFile.open(name, 'w'), except that the data is deflated in
+    independent blocks on several threads, like pigz does. Each block is
+    primed with the end of the previous block, so the compression is nearly
+    as good as deflating the data in one go.
+
+    The blocks are written in order, and the CRC is calculated as the data is
+    written, so the result is a standard deflated member.
+
+    :param zipf: ZipFile to write the member to. It must not have another
+        member open for writing.
+    :param zip_info: ZipInfo of the member
+    :param executor: the pool of threads to deflate the blocks with (see
+        get_executor())
+    :param workers: the number of threads in the executor
+    :param zip64: whether to allow the member to be bigger than 2GB (i.e. if
+        its size isn't known to be smaller)
+    '''
+    def __init__(self, zipf, zip_info, executor, workers,
+                 block_size=DEFAULT_BLOCK_SIZE,
+                 level=zlib.Z_DEFAULT_COMPRESSION, zip64=True):
+        self._zipf = zipf
+        self._info = zip_info
+        self._executor = executor
+        self._block_size = block_size
+        self._level = level
+        self._zip64 = zip64
+        # enough blocks to keep the threads busy, without buffering the lot
+        self._max_pending = workers * 2
+        self._pending = collections.deque()
+        self._block = bytearray()
+        self._previous = None
+        self._crc = 0
+        self._file_size = 0
+        self._compress_size = 0
+        self.closed = False
+
+        zip_info.compress_type = zipfile.ZIP_DEFLATED
+        zip_info.flag_bits = 0
+        if not zipf._seekable:
+            # the CRC and sizes go after the data, as the header can't be
+            # rewritten
+            zip_info.flag_bits |= FLAG_DATA_DESCRIPTOR
+        zip_info.CRC = zip_info.compress_size = zip_info.file_size = 0
+        _start_member(zipf, zip_info, zip64)
+        zipf._writing = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+        self._file_size += len(data)
+        self._block += data
+        while len(self._block) >= self._block_size:
+            self._submit(bytes(self._block[:self._block_size]))
+            del self._block[:self._block_size]
+        return len(data)
+
+    def _submit(self, block):
+        self._pending.append(self._executor.submit(
+            deflate_block, block, self._level, self._previous))
+        self._previous = block[-DICTIONARY_SIZE:]
+        while len(self._pending) > self._max_pending:
+            self._write_compressed(self._pending.popleft().result())
+
+    def _write_compressed(self, compressed):
+        self._zipf.fp.write(compressed)
+        self._compress_size += len(compressed)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            if self._block:
+                self._submit(bytes(self._block))
+                self._block = bytearray()
+            while self._pending:
+                self._write_compressed(self._pending.popleft().result())
+            self._write_compressed(FINAL_BLOCK)
+        finally:
+            self._zipf._writing = False
+        self._finish()
+
+    def _finish(self):
+        # update the header, the same way as ZipFile.open(name, 'w')
+        zipf, info = self._zipf, self._info
+        info.CRC = self._crc
+        info.file_size = self._file_size
+        info.compress_size = self._compress_size
+        if info.flag_bits & FLAG_DATA_DESCRIPTOR:
+            fmt = '<4sLQQ' if self._zip64 else '<4sLLL'
+            zipf.fp.write(struct.pack(
+                fmt, DATA_DESCRIPTOR_SIGNATURE, info.CRC, info.compress_size,
+                info.file_size))
+            zipf.start_dir = zipf.fp.tell()
+        else:
+            if not self._zip64 and (
+                    info.file_size > zipfile.ZIP64_LIMIT or
+                    info.compress_size > zipfile.ZIP64_LIMIT):
+                raise RuntimeError(
+                    'File size unexpectedly exceeded ZIP64 limit')
+            zipf.start_dir = zipf.fp.tell()
+            zipf.fp.seek(info.header_offset)
+            zipf.fp.write(info.FileHeader(self._zip64))
+            zipf.fp.seek(zipf.start_dir)
+        _add_member(zipf, info)
+
+
+class Pipe(object):
+    '''A file-like object that one thread writes to and another iterates
+    over, to stream a zip (e.g. as an HTTP response) while it is written. It
+    can't seek, which zipfile copes with.
+
+    It holds no more than max_chunks chunks, so the writer waits for the
+    reader. If the reader stops (cancel()), the writer's next write raises
+    IOError, so that it stops too. Likewise if more than max_size bytes (if
+    given) are written.
+    '''
+    name = '<pipe>'
+    _end = object()
+
+    def __init__(self, chunk_size=DEFAULT_CHUNK_SIZE, max_chunks=16,
+                 max_size=None):
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.chunks = queue.Queue(max_chunks)
+        self.buffer = bytearray()
+        self.position = 0
+        self.cancelled = False
+
+    def seekable(self):
+        return False
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def write(self, data):
+        if self.max_size is not None and \
+                self.position + len(data) > self.max_size:
+            raise IOError('The stream is bigger than its limit of {} bytes'
+                          .format(self.max_size))
+        self.buffer += data
+        self.position += len(data)
+        while len(self.buffer) >= self.chunk_size:
+            self._put(bytes(self.buffer[:self.chunk_size]))
+            del self.buffer[:self.chunk_size]
+        return len(data)
+
+    def _put(self, item):
+        while True:
+            if self.cancelled:
+                raise IOError('The reader of the pipe has stopped')
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def close(self):
+        '''Called by the writer when it has finished.'''
+        if self.buffer:
+            self._put(bytes(self.buffer))
+            self.buffer = bytearray()
+        self._put(self._end)
+
+    def fail(self, exception):
+        '''Called by the writer if it fails - the reader raises the
+        exception.'''
+        try:
+            self._put(exception)
+        except IOError:
+            # the reader has stopped anyway
+            pass
+
+    def cancel(self):
+        '''Called by the reader if it stops before the end.'''
+        self.cancelled = True
+
+    def __iter__(self):
+        while True:
+            item = self.chunks.get()
+            if item is self._end:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+
+def stream_from_thread(write, chunk_size=DEFAULT_CHUNK_SIZE, max_chunks=16,
+                       max_size=None):
+    '''Calls write(fp) in a new thread, and yields what it writes to fp as
+    it writes it, in chunks of chunk_size (see Pipe). If this generator is
+    closed before the end (e.g. the client has gone), the writing stops.
+
+    :param max_size: (optional) the most bytes that can be written - beyond
+        that, the write fails, and this generator raises the IOError
+    '''
+    pipe = Pipe(chunk_size, max_chunks, max_size)
+
+    def run():
+        try:
+            write(pipe)
+            pipe.close()
+        except Exception as e:
+            pipe.fail(e)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+        for chunk in pipe:
+            yield chunk
+    finally:
+        pipe.cancel()
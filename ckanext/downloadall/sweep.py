@@ -0,0 +1,249 @@
+'''
+Runs a sweep of builds, e.g. of every dataset's zip, in a pool of worker
+processes, with the progress, a summary of the failures and a checkpoint file
+so that an interrupted sweep can be resumed.
+
+A sweep of the datasets changed since a time keeps a high-water mark (see
+HighWaterMark), so that the next sweep starts from where this one got to.
+
+This doesn't depend on CKAN.
+'''
+import collections
+import datetime
+import heapq
+import io
+import multiprocessing
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import six
+
+
+def run_in_pool(func, items, workers=1, initializer=None, initargs=(),
+                max_in_flight=None):
+    '''Calls func(item) for each item, in worker processes, and yields
+    (item, error) as each one finishes (in the order that they finish).
+    error is None if it succeeded, otherwise the traceback. Items are
+    submitted as others finish, so no more than max_in_flight are queued or
+    running at once.
+
+    If a worker process dies (e.g. it is killed for running out of memory),
+    the items in flight fail, and the rest carry on in a new pool.
+
+    func and the items are pickled to send them to the processes, so func
+    must be e.g. a module-level function. The processes are forked, so the
+    initializer needn't be picklable.
+
+    :param workers: number of processes. With 1, func is called in this
+        process, in order, and the initializer isn't called.
+    :param initializer: (optional) called (with initargs) in each process
+        when it starts
+    :param max_in_flight: (optional) default: twice the number of workers
+    '''
+    if workers <= 1:
+        for item in items:
+            yield call(func, item)
+        return
+
+    max_in_flight = max_in_flight or workers * 2
+    items = iter(items)
+    # items to submit again, because the pool broke as they were submitted
+    unsubmitted = collections.deque()
+    exhausted = False
+    # future: (item, the executor it was submitted to)
+    in_flight = {}
+    executor = None
+    try:
+        while True:
+            if executor is None:
+                executor = ProcessPoolExecutor(
+                    workers, mp_context=multiprocessing.get_context('fork'),
+                    initializer=initializer, initargs=initargs)
+            while len(in_flight) < max_in_flight and \
+                    (unsubmitted or not exhausted):
+                if unsubmitted:
+                    item = unsubmitted.popleft()
+                else:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                try:
+                    future = executor.submit(call, func, item)
+                except BrokenProcessPool:
+                    unsubmitted.appendleft(item)
+                    executor.shutdown(wait=True)
+                    executor = None
+                    break
+                in_flight[future] = (item, executor)
+            if not in_flight:
+                if unsubmitted:
+                    continue
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                item, submitted_to = in_flight.pop(future)
+                try:
+                    yield future.result()
+                except BrokenProcessPool:
+                    if submitted_to is executor:
+                        # carry on in a new pool
+                        executor.shutdown(wait=True)
+                        executor = None
+                    yield item, 'A worker process died (e.g. it ran out of ' \
+                        'memory) while this was in progress:\n' + \
+                        traceback.format_exc()
+                except Exception:
+                    # e.g. an exception that call() doesn't catch
+                    yield item, traceback.format_exc()
+        if executor:
+            executor.shutdown(wait=True)
+            executor = None
+    finally:
+        if executor:
+            # the sweep is interrupted, so the builds in progress are
+            # abandoned
+            terminate(executor, in_flight)
+
+
+def terminate(executor, futures):
+    for future in futures:
+        future.cancel()
+    # (ProcessPoolExecutor has no public way to stop the builds in progress)
+    processes = list((getattr(executor, '_processes', None) or {}).values())
+    executor.shutdown(wait=False)
+    for process in processes:
+        process.terminate()
+
+
+def call(func, item):
+    '''Returns (item, error) for func(item) - see run_in_pool().'''
+    try:
+        func(item)
+    except Exception:
+        return item, traceback.format_exc()
+    return item, None
+
+
+class Progress(object):
+    '''Counts the items of a sweep as they finish, and estimates when it will
+    finish.
+
+    :param total: number of items in the sweep
+    '''
+    def __init__(self, total):
+        self.total = total
+        self.finished = 0
+        self.failures = []
+        self.started = time.time()
+
+    def update(self, item, error=None):
+        self.finished += 1
+        if error:
+            self.failures.append((item, error))
+
+    def eta_seconds(self):
+        '''Returns the estimated number of seconds until the sweep finishes,
+        at the rate so far, or None if nothing has finished yet.
+        '''
+        if not self.finished:
+            return None
+        elapsed = time.time() - self.started
+        return elapsed / self.finished * (self.total - self.finished)
+
+    def __str__(self):
+        eta = self.eta_seconds()
+        return '{}/{} ({:.0%}){}, ETA {}'.format(
+            self.finished, self.total,
+            float(self.finished) / self.total if self.total else 1,
+            ', {} failed'.format(len(self.failures)) if self.failures else '',
+            'unknown' if eta is None
+            else datetime.timedelta(seconds=int(eta)))
+
+
+class Checkpoint(object):
+    '''A file listing the items of a sweep that have succeeded, one per line,
+    so that the sweep can be resumed from where it got to.
+
+    :param path: the file, which is created if it doesn't exist
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        '''Returns the set of items that have succeeded.'''
+        if not os.path.exists(self.path):
+            return set()
+        with io.open(self.path, encoding='utf-8') as f:
+            return set(line.strip() for line in f if line.strip())
+
+    def add(self, item):
+        '''Records that the item has succeeded.'''
+        with io.open(self.path, 'a', encoding='utf-8') as f:
+            f.write(six.text_type(item) + u'\n')
+
+
+class HighWaterMark(object):
+    '''The time that a sweep of changes has got up to - i.e. the time of the
+    earliest change not done yet - so that the next sweep can start from
+    there. Items can be done in any order. Items that fail aren't done, so
+    they hold the mark back, and are retried next time.
+
+    :param times: dict of item: time it changed
+    :param end: the mark when every item is done - the time that the sweep
+        looked for changes up to
+    :param save: (optional) function called with the mark, when it moves on
+    :param save_interval: (optional) the least number of seconds between
+        saves, apart from the last one (see finish())
+    '''
+    def __init__(self, times, end, save=None, save_interval=10):
+        self.pending = [(changed, item) for item, changed in times.items()]
+        heapq.heapify(self.pending)
+        self.done_items = set()
+        self.end = end
+        self.save = save
+        self.save_interval = save_interval
+        self.saved = None
+        self.saved_at = time.time()
+
+    def done(self, item):
+        self.done_items.add(item)
+        self.save_if_due()
+
+    @property
+    def value(self):
+        while self.pending and self.pending[0][1] in self.done_items:
+            heapq.heappop(self.pending)
+        if self.pending:
+            return min(self.pending[0][0], self.end)
+        return self.end
+
+    def save_if_due(self):
+        if time.time() - self.saved_at >= self.save_interval:
+            self.finish()
+
+    def finish(self):
+        '''Saves the mark, if it has moved on since it was last saved.'''
+        value = self.value
+        if self.save and value != self.saved:
+            self.save(value)
+            self.saved = value
+        self.saved_at = time.time()
+
+
+def parse_isoformat(value):
+    '''Returns the datetime of an ISO 8601 date or date/time in UTC, e.g. as
+    CKAN and Solr store metadata_modified.
+    '''
+    stripped = value.strip().rstrip('Z')
+    for format_ in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                    '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(stripped, format_)
+        except ValueError:
+            pass
+    raise ValueError('Not an ISO 8601 date/time: {}'.format(value))
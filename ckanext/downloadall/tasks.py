@@ -3,22 +3,38 @@ import zipfile
 import os
 import io
 import csv
+import calendar
 import hashlib
 import math
 import copy
 import logging
 import datetime
+import json
+import time
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+import rq
 import six
+import sqlalchemy as sa
+import urllib3
 import ckanapi
 import ckanapi.datapackage
 
 from ckan import model
+from ckan.lib.jobs import DEFAULT_QUEUE_NAME, add_queue_name_prefix
+from ckan.lib.redis import connect_to_redis
+from ckan.lib.uploader import get_resource_uploader, get_max_resource_size
 from ckan.plugins import toolkit
-from ckan.plugins.toolkit import get_action, config, asbool
+from ckan.plugins.toolkit import get_action, config, asbool, asint
 from werkzeug.datastructures import FileStorage
 
+from ckanext.downloadall import (
+    compression, jobs, objectstore, sessions, streaming)
+from ckanext.downloadall.cache import MemberCache, member_key
+
 log = logging.getLogger(__name__)
 
 DATAPACKAGE_TYPES = {  # map datastore types to datapackage types
@@ -27,8 +43,52 @@ DATAPACKAGE_TYPES = {  # map datastore types to datapackage types
     'timestamp': 'datetime',
 }
 
-
-def update_zip(package_id, skip_if_no_changes=True):
+# member files bigger than this are spooled to disk, rather than kept in
+# memory, while they wait to be added to the zip
+SPOOL_MAX_SIZE = 10 * 1024 * 1024
+
+# name of the resource inside a member file
+MEMBER_FILENAME = 'data'
+
+DEFAULT_CACHE_MAX_SIZE = 10 * 1024 * 1024 * 1024
+
+# resource fields that change when the resource's data changes
+DATA_VALIDATOR_FIELDS = ('last_modified', 'size', 'hash')
+
+DEFAULT_JOB_TIMEOUT = 1800
+
+# Builds are routed to a lane (a queue, with its own settings), by the
+# estimated size of the build
+SMALL_LANE = 'small'
+LARGE_LANE = 'large'
+DEFAULT_LARGE_DATASET_SIZE = 1024 * 1024 * 1024
+DEFAULT_LARGE_BUILD_SECONDS = 300
+# interactive builds that each organization can queue a minute, before the
+# rest are queued as bulk ones
+DEFAULT_ORGANIZATION_RATE_LIMIT = 30
+# streamed downloads that each web server process builds at once
+DEFAULT_STREAMED_DOWNLOAD_MAX_CONCURRENT = 2
+
+# The columns of DataStore tables, with their data dictionary (stored as
+# column comments), straight from the catalog - i.e. without datastore_search
+# querying (and counting) each table
+DATASTORE_FIELDS_SQL = sa.text('''
+    SELECT c.relname, a.attname, t.typname, d.description
+    FROM pg_catalog.pg_class c
+    JOIN pg_catalog.pg_attribute a ON a.attrelid = c.oid
+    JOIN pg_catalog.pg_type t ON t.oid = a.atttypid
+    LEFT JOIN pg_catalog.pg_description d
+        ON d.objoid = c.oid AND d.objsubid = a.attnum
+    WHERE c.relname IN :resource_ids
+        AND c.relkind = 'r'
+        AND pg_catalog.pg_table_is_visible(c.oid)
+        AND a.attnum > 0
+        AND NOT a.attisdropped
+    ORDER BY c.relname, a.attnum
+''').bindparams(sa.bindparam('resource_ids', expanding=True))
+
+
+def update_zip(package_id, skip_if_no_changes=True, compression_level=None):
     '''
     Create/update the a dataset's zip resource, containing the other resources
     and some metadata.
@@ -37,75 +97,720 @@ def update_zip(package_id, skip_if_no_changes=True):
         dataset, it will compare a freshly generated package.json against what
         is in the existing zip, and if there are no changes (ignoring the
         Download All Zip) then it will skip downloading the resources and
-        updating the zip.
+        updating the zip. First it checks the dataset's watermark (see
+        get_watermark()), which is much quicker, and if that hasn't moved
+        since the zip was built, it skips straight away.
+    :param compression_level: (optional) deflate level 0-9, or 'auto'.
+        Defaults to the config option ckanext.downloadall.compression_level
     '''
-    # TODO deal with private datasets - 'ignore_auth': True
-    context = {'model': model, 'session': model.Session}
-    dataset = get_action('package_show')(context, {'id': package_id})
+    started = time.time()
+    job = rq.get_current_job()
+    if job:
+        queued_datasets = get_queued_datasets()
+        if defer_until_quiet(job, package_id, queued_datasets):
+            return
+        record_queue_wait(job)
+        # any change to the dataset from now on needs another job
+        queued_datasets.release(package_id)
+    build_started = time.time()
+
+    check_remote_resources = asbool(
+        config.get('ckanext.downloadall.check_remote_resources', False))
+    watermark, zip_resource_id = get_watermark(package_id)
+    # (with check_remote_resources, the remote resources need checking even
+    # if the dataset is unchanged)
+    if skip_if_no_changes and not check_remote_resources and watermark and \
+            zip_resource_id and \
+            load_watermark(zip_resource_id) == watermark:
+        log.info('Skipping updating the zip - the dataset is unchanged since '
+                 'the zip was built: {}'.format(package_id))
+        return
+
+    compression_policy = get_compression_policy(
+        compression_level, deadline=get_job_deadline(started))
+    build = BuildContext(package_id)
+    dataset = build.dataset
     log.debug('Updating zip: {}'.format(dataset['name']))
 
     datapackage, ckan_and_datapackage_resources, existing_zip_resource = \
-        generate_datapackage_json(package_id)
+        generate_datapackage_json(package_id, build)
+    fingerprints = fingerprint_datapackage(
+        datapackage, ckan_and_datapackage_resources)
 
+    remote_validators = load_remote_validators(existing_zip_resource)
+    remote_data_changed = False
     if skip_if_no_changes and existing_zip_resource and \
             not has_datapackage_changed_significantly(
                 datapackage, ckan_and_datapackage_resources,
-                existing_zip_resource):
-        log.info('Skipping updating the zip - the datapackage.json is not '
-                 'changed sufficiently: {}'.format(dataset['name']))
-        return
-
-    prefix = '{}-'.format(dataset['name'])
-    with tempfile.NamedTemporaryFile(mode='w+b', prefix=prefix, suffix='.zip') as fp:
-        write_zip(fp, datapackage, ckan_and_datapackage_resources)
+                existing_zip_resource, fingerprints=fingerprints):
+        if check_remote_resources and \
+                have_remote_resources_changed(
+                    [res for res, dres in ckan_and_datapackage_resources],
+                    remote_validators):
+            log.info('Updating the zip - the data of a remote resource has '
+                     'changed: {}'.format(dataset['name']))
+            remote_data_changed = True
+        else:
+            log.info('Skipping updating the zip - the datapackage.json is not '
+                     'changed sufficiently: {}'.format(dataset['name']))
+            # so next time the quick check can skip it
+            if watermark:
+                store_watermark(existing_zip_resource['id'], watermark)
+            return
+
+    # With ckanext.downloadall.build_in_storage (and a local filestore), the
+    # zip is built next to where it is stored, and moved there, rather than
+    # built in a temporary directory and then copied into the filestore by
+    # CKAN's uploader. With ckanext.downloadall.s3.bucket, the zip is streamed
+    # into object storage as it is written, so it needs no room on local disk.
+    zip_resource_id = existing_zip_resource['id'] if existing_zip_resource \
+        else six.text_type(uuid.uuid4())
+    object_storage = get_object_storage()
+    storage_path = None
+    if object_storage:
+        directory = None
+    else:
+        if asbool(config.get('ckanext.downloadall.build_in_storage', False)):
+            storage_path = get_storage_path(zip_resource_id)
+        directory = os.path.dirname(storage_path) if storage_path \
+            else tempfile.gettempdir()
+        if storage_path and not os.path.isdir(directory):
+            os.makedirs(directory)
+        check_free_space(directory, [
+            res for res, dres in ckan_and_datapackage_resources])
+
+    # The data of resources whose data fingerprint is unchanged (e.g. only
+    # the metadata has changed) can be copied from the existing zip. And
+    # remote resources that are not modified can be copied from it too.
+    existing_zip = None
+    reusable_members = {}
+    if skip_if_no_changes and existing_zip_resource:
+        existing_zip = open_existing_zip(existing_zip_resource)
+        reusable_members = get_reusable_members(
+            fingerprints, existing_zip_resource)
+        if remote_data_changed:
+            # check the remote ones with their validators
+            reusable_members = dict(
+                (res['id'], reusable_members[res['id']])
+                for res, dres in ckan_and_datapackage_resources
+                if is_uploaded(res) and res['id'] in reusable_members)
+
+    if object_storage:
+        filename = '{}.zip'.format(dataset['name'])
+        object_key = object_storage.key(zip_resource_id, filename)
+        fp = object_storage.open(object_key)
+    else:
+        prefix = '{}-'.format(dataset['name'])
+        fp = tempfile.NamedTemporaryFile(
+            mode='w+b', prefix=prefix, suffix='.zip', dir=directory,
+            delete=False)
+    try:
+        try:
+            write_zip(fp, datapackage, ckan_and_datapackage_resources,
+                      refresh_cache=not skip_if_no_changes,
+                      existing_zip=existing_zip,
+                      reusable_members=reusable_members,
+                      remote_validators=remote_validators,
+                      compression_policy=compression_policy)
+        finally:
+            if existing_zip:
+                existing_zip.close()
 
-        # Upload resource to CKAN as a new/updated resource
-        fp.seek(0)
-        fs = FileStorage(fp, filename=fp.name, name=fp.name, content_type='zip')
         resource = dict(
             package_id=dataset['id'],
-            url='dummy-value',
-            upload=fs,
             name='All resource data',
             format='ZIP',
             downloadall_metadata_modified=dataset['metadata_modified'],
-            downloadall_datapackage_hash=hash_datapackage(datapackage)
+            downloadall_fingerprints=json.dumps(
+                add_members_to_fingerprints(
+                    fingerprints, ckan_and_datapackage_resources)),
+            downloadall_remote_validators=json.dumps(remote_validators),
+            # for routing the next build (see get_lane())
+            downloadall_build_seconds=int(time.time() - build_started),
         )
-        user = toolkit.get_action('get_site_user')({'ignore_auth': True}, ())
-        ctx = context.copy()
+        if object_storage:
+            check_max_resource_size(fp.tell())
+            # completes the upload, replacing the existing zip
+            fp.close()
+            resource.update(uploaded_resource_fields(filename, fp.tell()),
+                            id=zip_resource_id)
+        elif storage_path:
+            resource.update(move_into_storage(fp, storage_path),
+                            id=zip_resource_id)
+        else:
+            # Upload resource to CKAN as a new/updated resource
+            fp.seek(0)
+            resource.update(
+                url='dummy-value',
+                upload=FileStorage(fp, filename=fp.name, name=fp.name,
+                                   content_type='zip'))
+        user = get_action('get_site_user')({'ignore_auth': True}, ())
+        ctx = build.make_context()
         ctx['user'] = user['name']
 
+        # if the dataset changed while the zip was being built, the zip
+        # doesn't include the change, so the watermark isn't moved on past it
+        unchanged_during_build = \
+            watermark is not None and get_watermark(package_id)[0] == watermark
+
         if not existing_zip_resource:
             log.debug('Writing new zip resource - {}'.format(dataset['name']))
-            toolkit.get_action('resource_create')(ctx, resource)
+            try:
+                zip_resource = get_action('resource_create')(ctx, resource)
+            except Exception:
+                # don't leave the file without its resource
+                if object_storage:
+                    object_storage.delete(object_key)
+                elif storage_path:
+                    os.remove(storage_path)
+                raise
         else:
-            # TODO update the existing zip resource (using patch?)
             log.debug('Updating zip resource - {}'.format(dataset['name']))
-            resource['id'] = existing_zip_resource['id']
-            toolkit.get_action('resource_patch')(ctx, resource)
+            # equivalent to resource_patch, but patching the zip resource from
+            # the snapshot, rather than showing the dataset again
+            resource = dict(existing_zip_resource, **resource)
+            for key in ('downloadall_watermark',
+                        # superseded by downloadall_fingerprints
+                        'downloadall_datapackage_hash',
+                        'downloadall_resources_data_hash'):
+                resource.pop(key, None)
+            zip_resource = get_action('resource_update')(ctx, resource)
+            if object_storage:
+                delete_replaced_object(object_storage, existing_zip_resource,
+                                       object_key)
+    finally:
+        if object_storage:
+            # (unless it was completed)
+            fp.abort()
+        else:
+            fp.close()
+            if os.path.exists(fp.name):
+                os.remove(fp.name)
+
+    if watermark:
+        # the watermark the zip was built from - moved on past the update of
+        # the zip resource itself, unless something else has changed since
+        if unchanged_during_build:
+            watermark = advance_watermark(
+                watermark, package_id, zip_resource) or watermark
+        store_watermark(zip_resource['id'], watermark)
+
+
+def stream_zip(package_id, user=None):
+    '''Returns the zip of a dataset's resources and datapackage.json, built as
+    it is streamed (e.g. as the response of a download), rather than stored.
+    It is built as update_zip() builds it, with the members of uploaded
+    resources that are unchanged copied from the existing zip (if any), and
+    remote ones copied from it if their server says they are not modified.
+    With the member cache, the others are copied from the cache.
+
+    The dataset is fetched now, and the zip is written, in another thread, as
+    the generator is iterated, holding only a few chunks of it in memory at
+    a time (see streaming.stream_from_thread()). The generator raises IOError
+    if the zip grows beyond get_streamed_download_max_size().
+
+    :param user: (optional) the name of the user to fetch the dataset as
+        (e.g. the user downloading it, '' if anonymous), so that their access
+        to it is checked
+    :returns: (filename, generator of the zip's data)
+    :raises TooLargeToStreamError: if the dataset is in the large lane (see
+        get_lane()), as it would take too long, or too much of the web
+        server, to build
+    '''
+    build = BuildContext(package_id, user=user)
+    dataset = build.dataset
+    if get_dataset_lane(dataset['id']) == LARGE_LANE:
+        raise TooLargeToStreamError(
+            'The dataset is too large to stream its zip: {}'
+            .format(dataset['name']))
+    datapackage, ckan_and_datapackage_resources, existing_zip_resource = \
+        generate_datapackage_json(package_id, build)
+
+    existing_zip = None
+    reusable_members = {}
+    remote_validators = load_remote_validators(existing_zip_resource)
+    if existing_zip_resource:
+        existing_zip = open_existing_zip(existing_zip_resource)
+        fingerprints = fingerprint_datapackage(
+            datapackage, ckan_and_datapackage_resources)
+        # (remote data might have changed since the zip was built, so those
+        # are checked with their validators)
+        reusable_members = get_reusable_members(
+            fingerprints, existing_zip_resource)
+        reusable_members = dict(
+            (res['id'], reusable_members[res['id']])
+            for res, dres in ckan_and_datapackage_resources
+            if is_uploaded(res) and res['id'] in reusable_members)
+
+    def write(fp):
+        try:
+            write_zip(fp, datapackage, ckan_and_datapackage_resources,
+                      existing_zip=existing_zip,
+                      reusable_members=reusable_members,
+                      remote_validators=remote_validators)
+        finally:
+            if existing_zip:
+                existing_zip.close()
+
+    filename = '{}.zip'.format(dataset['name'])
+    return filename, streaming.stream_from_thread(
+        write, max_size=get_streamed_download_max_size())
 
 
 class DownloadError(Exception):
     pass
 
 
+class InsufficientSpaceError(Exception):
+    pass
+
+
+class TooLargeToStreamError(Exception):
+    pass
+
+
+class BuildContext(object):
+    '''The state shared by the steps of one build of a dataset's zip.
+
+    The dataset is fetched with package_show once, when it is first needed,
+    and the same snapshot of it is used for generating the datapackage,
+    hashing it and updating the zip resource.
+    '''
+    def __init__(self, package_id, user=None):
+        self.package_id = package_id
+        self.user = user
+        self._dataset = None
+
+    def make_context(self):
+        # a fresh one each time, as actions add things to their context
+        # TODO deal with private datasets - 'ignore_auth': True
+        context = {'model': model, 'session': model.Session}
+        if self.user is not None:
+            context['user'] = self.user
+        return context
+
+    @property
+    def dataset(self):
+        if self._dataset is None:
+            self._dataset = get_action('package_show')(
+                self.make_context(), {'id': self.package_id})
+        return self._dataset
+
+
 def has_datapackage_changed_significantly(
-        datapackage, ckan_and_datapackage_resources, existing_zip_resource):
+        datapackage, ckan_and_datapackage_resources, existing_zip_resource,
+        fingerprints=None):
     '''Compare the freshly generated datapackage with the existing one and work
     out if it is changed enough to warrant regenerating the zip.
 
+    :param fingerprints: (optional) the datapackage's fingerprints, if
+        fingerprint_datapackage() has been called already
     :returns bool: True if the data package has really changed and needs
         regenerating
     '''
     assert existing_zip_resource
-    new_hash = hash_datapackage(datapackage)
-    old_hash = existing_zip_resource.get('downloadall_datapackage_hash')
-    return new_hash != old_hash
+    old_fingerprints = load_fingerprints(existing_zip_resource)
+    if old_fingerprints is None:
+        # zip written by an older version of this extension
+        new_hash = hash_datapackage(datapackage)
+        old_hash = existing_zip_resource.get('downloadall_datapackage_hash')
+        return new_hash != old_hash
+
+    if fingerprints is None:
+        fingerprints = fingerprint_datapackage(
+            datapackage, ckan_and_datapackage_resources)
+    if fingerprints['datapackage'] == old_fingerprints.get('datapackage'):
+        return False
+    old_resources = old_fingerprints.get('resources', {})
+    changed = [
+        id_ for id_, resource_fingerprints
+        in fingerprints['resources'].items()
+        if {key: old_resources.get(id_, {}).get(key)
+            for key in resource_fingerprints} != resource_fingerprints]
+    log.debug('Resources changed: {}/{} {}'.format(
+        len(changed), len(fingerprints['resources']), ' '.join(changed)))
+    return True
+
+
+def fingerprint(obj):
+    '''Returns a hash of the canonical JSON encoding of an object (keys
+    sorted, no whitespace), so it is the same between machines and python
+    versions.
+    '''
+    return hashlib.sha224(json.dumps(
+        obj, sort_keys=True, separators=(',', ':')).encode('utf8')
+    ).hexdigest()
+
+
+def fingerprint_datapackage(datapackage, ckan_and_datapackage_resources):
+    '''Returns fingerprints of a freshly generated datapackage, so that it
+    can be compared with the one in the existing zip, without storing the
+    whole of it.
+
+    For each resource there is one of its metadata in the datapackage and
+    one of its data (i.e. its URL and the fields that change when its data
+    changes), so it can be seen which resources have changed. And there is
+    one for the whole datapackage, which changes if any of them change.
+
+    :returns: dict {'datapackage': fingerprint, 'resources': {resource_id:
+        {'metadata': fingerprint, 'data': fingerprint}}}
+    '''
+    resources = {}
+    resources_fingerprints = []
+    for res, dres in ckan_and_datapackage_resources:
+        resources[res['id']] = {
+            'metadata': fingerprint(canonized_datapackage_resource(dres)),
+            'data': fingerprint(
+                [res['url']] +
+                [res.get(key) for key in DATA_VALIDATOR_FIELDS]),
+        }
+        resources_fingerprints.append([resources[res['id']]['metadata'],
+                                       resources[res['id']]['data']])
+    # the resources are in by their fingerprints, so they aren't encoded twice
+    metadata = dict((key, value) for key, value in datapackage.items()
+                    if key != 'resources')
+    return {
+        'datapackage': fingerprint([metadata, resources_fingerprints]),
+        'resources': resources,
+    }
+
+
+def add_members_to_fingerprints(fingerprints, ckan_and_datapackage_resources):
+    '''Records the zip member of each resource in its fingerprints, so that
+    a later build can copy it, if its data is unchanged (see
+    get_reusable_members()).
+
+    :returns: the fingerprints
+    '''
+    for res, dres in ckan_and_datapackage_resources:
+        if dres.get('sources'):
+            # i.e. write_zip() put the resource in the zip
+            fingerprints['resources'][res['id']]['member'] = dres['path']
+    return fingerprints
+
+
+def load_fingerprints(existing_zip_resource):
+    '''Returns the fingerprints stored on the zip resource, or None if it was
+    written by an older version of this extension.
+    '''
+    try:
+        return json.loads(existing_zip_resource['downloadall_fingerprints'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def get_reusable_members(fingerprints, existing_zip_resource):
+    '''Returns the members of the existing zip that can be copied, because
+    their resource's data is unchanged since the zip was written.
+
+    :returns: dict of resource_id: filename of its member in the existing zip
+    '''
+    old_fingerprints = load_fingerprints(existing_zip_resource)
+    if old_fingerprints is None:
+        return {}
+    old_resources = old_fingerprints.get('resources', {})
+    reusable_members = {}
+    for id_, resource_fingerprints in fingerprints['resources'].items():
+        old = old_resources.get(id_, {})
+        if old.get('member') and \
+                old.get('data') == resource_fingerprints['data']:
+            reusable_members[id_] = old['member']
+    return reusable_members
+
+
+def get_watermark(package_id):
+    '''Returns the dataset's watermark - values that change whenever
+    something in its zip might have, but which are much quicker to get than
+    package_show and generating the datapackage. They come straight from the
+    database:
+
+    * metadata_modified of the dataset (changes to its resources update it
+      too)
+    * the latest metadata_modified of its resources
+    * a fingerprint of its DataStore fields (the data dictionary), which can
+      change without the dataset changing
+
+    :returns: (watermark, id of the dataset's zip resource or None) or
+        (None, None) if the dataset doesn't exist
+    '''
+    pkg = model.Package.get(package_id)
+    if pkg is None:
+        return None, None
+    zip_resource_id = None
+    resources = []
+    for res in pkg.resources:
+        if res.extras.get('downloadall_metadata_modified'):
+            zip_resource_id = res.id
+        else:
+            resources.append(res)
+    resources_modified = [res.metadata_modified for res in resources
+                          if getattr(res, 'metadata_modified', None)]
+    datastore_fields = get_datastore_fields(
+        [res.id for res in resources
+         if asbool(res.extras.get('datastore_active', False))])
+    watermark = {
+        'metadata_modified': isoformat(pkg.metadata_modified),
+        'resources_modified': isoformat(max(resources_modified))
+        if resources_modified else None,
+        'datastore_fields': hashlib.sha224(json.dumps(
+            datastore_fields, sort_keys=True).encode('utf8')).hexdigest(),
+    }
+    return watermark, zip_resource_id
+
+
+def advance_watermark(watermark, package_id, zip_resource):
+    '''Returns the dataset's watermark now, if the only change since the
+    given watermark was taken is the update of the zip resource (which moves
+    the dataset's metadata_modified on), otherwise None.
+
+    package_update sets the dataset's metadata_modified before the
+    metadata_modified of the resources it changes, so after the update of the
+    zip resource, the dataset's is no later than the zip resource's - unless
+    the dataset has been changed again since.
+    '''
+    new_watermark = get_watermark(package_id)[0]
+    if not new_watermark or not zip_resource.get('metadata_modified'):
+        return None
+    if dict(new_watermark, metadata_modified=None) != \
+            dict(watermark, metadata_modified=None):
+        return None
+    if new_watermark['metadata_modified'] > zip_resource['metadata_modified']:
+        return None
+    return new_watermark
+
+
+def isoformat(datetime_):
+    return datetime_.isoformat() if datetime_ else None
+
+
+def load_watermark(zip_resource_id):
+    '''Returns the watermark stored on the zip resource, or None.'''
+    extras = model.Session.query(model.Resource.extras) \
+        .filter(model.Resource.id == zip_resource_id).scalar()
+    try:
+        return json.loads((extras or {})['downloadall_watermark'])
+    except (KeyError, ValueError):
+        return None
+
+
+def store_watermark(zip_resource_id, watermark):
+    '''Stores the watermark on the zip resource.
+
+    It is written straight to the database - if the resource was updated with
+    an action (or the ORM), the dataset's metadata_modified would change, and
+    it would trigger another update of the zip.
+    '''
+    query = model.Session.query(model.Resource) \
+        .filter(model.Resource.id == zip_resource_id)
+    extras = query.with_entities(model.Resource.extras).scalar() or {}
+    extras = dict(extras, downloadall_watermark=json.dumps(watermark))
+    query.update({'extras': extras}, synchronize_session=False)
+    model.Session.commit()
+
+
+def load_remote_validators(existing_zip_resource):
+    '''Returns the validators that the servers of remote resources returned
+    when the existing zip was written, as stored by write_zip().
+
+    :returns: dict of resource id to dict with keys: url, member, and any of
+        etag and last_modified
+    '''
+    if not existing_zip_resource:
+        return {}
+    try:
+        return json.loads(
+            existing_zip_resource.get('downloadall_remote_validators') or
+            '{}')
+    except ValueError:
+        return {}
+
+
+def have_remote_resources_changed(resources, remote_validators):
+    '''Asks the servers of the remote resources if their data has been
+    modified since the existing zip was written, using conditional requests,
+    so nothing is transferred if not.
+
+    Only resources whose server returned validators (ETag or Last-Modified)
+    can be checked.
+    '''
+    for res in resources:
+        previous = remote_validators.get(res['id'])
+        if is_uploaded(res) or not previous or \
+                previous.get('url') != res['url']:
+            continue
+        try:
+            r = request_resource(res['url'], get_validators(previous))
+        except DownloadError:
+            continue
+        if r.status_code != 304:
+            # don't download the data just to check it
+            r.close()
+            log.debug('Remote resource has changed: {}'.format(res['url']))
+            return True
+        sessions.release(r)
+    return False
+
+
+def open_existing_zip(existing_zip_resource):
+    '''Opens the file of the existing zip, if it is uploaded to the local
+    filestore.
+
+    :returns: the file, opened for reading, or None
+    '''
+    existing_zip = open_uploaded_file(existing_zip_resource)
+    if not existing_zip:
+        log.warning('Existing zip not found in the filestore: {}'
+                    .format(existing_zip_resource['id']))
+    return existing_zip
+
+
+def open_uploaded_file(res):
+    '''Opens the file of an uploaded resource, straight from the filestore,
+    if it is stored locally (or on a shared file system). This saves
+    requesting it over HTTP from CKAN itself.
+
+    :returns: the file, opened for reading, or None
+    '''
+    if not is_uploaded(res):
+        return None
+    uploader = get_resource_uploader(res)
+    try:
+        path = uploader.get_path(res['id'])
+    except AttributeError:
+        # an uploader that doesn't store files locally e.g. cloud storage
+        return None
+    try:
+        return open(path, 'rb')
+    except (IOError, OSError):
+        return None
+
+
+def get_storage_path(resource_id):
+    '''Returns the path that an uploaded resource's file is stored at, if the
+    filestore is local (or on a shared file system), otherwise None (e.g.
+    cloud storage).
+    '''
+    uploader = get_resource_uploader({'id': resource_id, 'url_type': 'upload'})
+    if not getattr(uploader, 'storage_path', None):
+        return None
+    try:
+        return uploader.get_path(resource_id)
+    except AttributeError:
+        # an uploader that doesn't store files locally
+        return None
+
+
+def move_into_storage(fp, storage_path):
+    '''Moves the built zip, which is in the same directory, to where its
+    resource's file is stored, replacing the existing one in one step.
+
+    :param fp: the zip's temporary file
+    :returns: dict of the resource's fields that CKAN's uploader would set,
+        for a resource_create/update without an upload
+    '''
+    fp.flush()
+    os.fsync(fp.fileno())
+    size = os.fstat(fp.fileno()).st_size
+    check_max_resource_size(size)
+    os.rename(fp.name, storage_path)
+    return uploaded_resource_fields(os.path.basename(fp.name), size)
+
+
+def check_max_resource_size(size):
+    '''Checks the zip is no bigger than CKAN allows an upload to be, as CKAN's
+    uploader does.
+
+    :raises toolkit.ValidationError:
+    '''
+    if size > get_max_resource_size() * 1024 * 1024:
+        raise toolkit.ValidationError({'upload': ['File upload too large']})
+
+
+def uploaded_resource_fields(filename, size):
+    '''Returns dict of the resource's fields that CKAN's uploader would set,
+    for a resource_create/update of a zip that is already stored.
+    '''
+    return dict(
+        url=filename,
+        url_type='upload',
+        size=size,
+        mimetype='application/zip',
+        last_modified=datetime.datetime.utcnow().isoformat(),
+    )
+
+
+def get_object_storage():
+    '''Returns the ObjectStorage that zips are streamed into, or None if
+    ckanext.downloadall.s3.bucket is not configured.
+    '''
+    bucket = config.get('ckanext.downloadall.s3.bucket')
+    if not bucket:
+        return None
+    client = objectstore.make_client(
+        endpoint_url=config.get('ckanext.downloadall.s3.endpoint_url'),
+        region_name=config.get('ckanext.downloadall.s3.region_name'),
+        aws_access_key_id=config.get(
+            'ckanext.downloadall.s3.aws_access_key_id'),
+        aws_secret_access_key=config.get(
+            'ckanext.downloadall.s3.aws_secret_access_key'),
+    )
+    return objectstore.ObjectStorage(
+        client, bucket,
+        key_template=config.get('ckanext.downloadall.s3.key_template',
+                                objectstore.DEFAULT_KEY_TEMPLATE),
+        part_size=asint(config.get('ckanext.downloadall.s3.part_size',
+                                   objectstore.DEFAULT_PART_SIZE)),
+        concurrency=asint(config.get('ckanext.downloadall.s3.concurrency',
+                                     2)),
+    )
+
+
+def delete_replaced_object(object_storage, existing_zip_resource, key):
+    '''Deletes the object of the zip that has been replaced, if it had a
+    different key (e.g. the dataset has been renamed since). Otherwise the
+    new zip has replaced it already.
+    '''
+    if existing_zip_resource.get('url_type') != 'upload':
+        return
+    filename = existing_zip_resource['url'].rsplit('/', 1)[-1]
+    old_key = object_storage.key(existing_zip_resource['id'], filename)
+    if old_key != key:
+        try:
+            object_storage.delete(old_key)
+        except Exception as e:
+            log.warning('Could not delete the replaced zip {}: {}'
+                        .format(old_key, e))
+
+
+def check_free_space(directory, resources):
+    '''Checks there is room in the directory for the zip, before it is built,
+    since it could be far bigger than there is room for. It needs room for the
+    resources (those whose size is known), plus the config option
+    ckanext.downloadall.min_free_space (default: 0 bytes).
+
+    :param resources: the resources to be downloaded into the zip
+    :raises InsufficientSpaceError:
+    '''
+    needed = asint(config.get('ckanext.downloadall.min_free_space', 0))
+    for res in resources:
+        try:
+            needed += int(res.get('size') or 0)
+        except ValueError:
+            pass
+    stat = os.statvfs(directory)
+    free = stat.f_bavail * stat.f_frsize
+    if needed > free:
+        raise InsufficientSpaceError(
+            'Not enough free space for the zip in {}: {} bytes needed, {} '
+            'free'.format(directory, needed, free))
 
 
 def hash_datapackage(datapackage):
     '''Returns a hash of the canonized version of the given datapackage
     (metadata).
+
+    This is how zips written by older versions of this extension were
+    compared - see fingerprint_datapackage().
     '''
     canonized = canonized_datapackage(datapackage)
     m = hashlib.sha224(six.text_type(make_hashable(canonized)).encode('utf8'))
@@ -132,7 +837,6 @@ def canonized_datapackage(datapackage):
     To allow datapackages to be compared, the canonization converts local
     resources to remote ones.
     '''
-    datapackage_ = copy.deepcopy(datapackage)
     # convert resources to remote paths
     # i.e.
     #
@@ -146,22 +850,40 @@ def canonized_datapackage(datapackage):
     # ->
     #
     #   "path": "https://example.com/file.csv",
-    for res in datapackage_.get('resources', []):
-        try:
-            remote_path = res['sources'][0]['path']
-        except KeyError:
-            continue
-        res['path'] = remote_path
-        del res['sources']
+    #
+    # (only what is changed is copied, so don't modify the result)
+    datapackage_ = dict(datapackage)
+    if 'resources' in datapackage:
+        datapackage_['resources'] = [
+            canonized_datapackage_resource(res)
+            for res in datapackage['resources']]
     return datapackage_
 
 
-def generate_datapackage_json(package_id):
+def canonized_datapackage_resource(datapackage_resource):
+    '''Returns the resource of a datapackage with a remote path (see
+    canonized_datapackage()).
+    '''
+    try:
+        remote_path = datapackage_resource['sources'][0]['path']
+    except KeyError:
+        return datapackage_resource
+    res = dict(datapackage_resource, path=remote_path)
+    del res['sources']
+    return res
+
+
+def generate_datapackage_json(package_id, build=None):
     '''Generates the datapackage - metadata that would be saved as
     datapackage.json.
+
+    :param build: (optional) BuildContext, whose dataset is used, rather than
+        fetching it again
     '''
-    context = {'model': model, 'session': model.Session}
-    dataset = get_action('package_show')(context, {'id': package_id})
+    if build is None:
+        build = BuildContext(package_id)
+    # the resources are annotated, so leave the snapshot as it was
+    dataset = copy.deepcopy(build.dataset)
 
     # filter out resources that are not suitable for inclusion in the data
     # package
@@ -178,15 +900,12 @@ def generate_datapackage_json(package_id):
                                          datapackage.get('resources', []))
     # this line is only for backward compatibility with py2 style of zip function
     ckan_and_datapackage_resources = [a for a in ckan_and_datapackage_resources]
+    datastore_fields = get_datastore_fields(
+        [res['id'] for res, datapackage_res in ckan_and_datapackage_resources
+         if res.get('datastore_active')])
     for res, datapackage_res in ckan_and_datapackage_resources:
-        data = {
-            'resource_id': res['id'],
-            'limit': 1,
-            'include_total': True,
-        }
-        if res.get('datastore_active'):
-            ds = toolkit.get_action('datastore_search')(context, data)
-            res['datastore_fields'] = ds['fields']
+        if res['id'] in datastore_fields:
+            res['datastore_fields'] = datastore_fields[res['id']]
 
         populate_schema_from_datastore(res, datapackage_res)
 
@@ -199,6 +918,71 @@ def generate_datapackage_json(package_id):
     return datapackage, ckan_and_datapackage_resources, existing_zip_resource
 
 
+def get_datastore_fields(resource_ids):
+    '''Returns the DataStore fields (data dictionary) of resources, as
+    datastore_search returns them, but for all the resources in one query,
+    and without counting their rows.
+
+    If the DataStore's database can't be queried directly (e.g. another
+    DataStore backend), it falls back to datastore_search for each resource.
+
+    :returns: dict of resource_id: list of fields (dicts with 'id', 'type'
+        and, if it has a data dictionary, 'info'). Resources without a
+        DataStore table are left out.
+    '''
+    if not resource_ids:
+        return {}
+    try:
+        return query_datastore_fields(resource_ids)
+    except (ImportError, KeyError, sa.exc.SQLAlchemyError) as e:
+        log.warning('Could not query the DataStore fields directly, so using '
+                    'datastore_search: {}'.format(e))
+
+    context = {'model': model, 'session': model.Session}
+    datastore_fields = {}
+    for resource_id in resource_ids:
+        try:
+            ds = get_action('datastore_search')(context, {
+                'resource_id': resource_id,
+                'limit': 0,
+                'include_total': False,
+            })
+        except toolkit.ObjectNotFound:
+            continue
+        datastore_fields[resource_id] = ds['fields']
+    return datastore_fields
+
+
+def query_datastore_fields(resource_ids):
+    '''Returns the DataStore fields of resources (see get_datastore_fields),
+    with one query of the DataStore database's catalog.
+    '''
+    # the datastore plugin is optional
+    from ckanext.datastore.backend.postgres import get_read_engine
+
+    with get_read_engine().connect() as connection:
+        rows = connection.execute(
+            DATASTORE_FIELDS_SQL,
+            {'resource_ids': list(resource_ids)}).fetchall()
+    datastore_fields = {}
+    for resource_id, name, type_, description in rows:
+        # like datastore_search, '_id' is first and other internal columns
+        # (e.g. '_full_text') are hidden
+        fields = datastore_fields.setdefault(
+            resource_id, [{'id': '_id', 'type': 'int'}])
+        if name.startswith('_'):
+            continue
+        field = {'id': name, 'type': type_}
+        if description:
+            try:
+                field['info'] = json.loads(description)
+            except ValueError:
+                # not a data dictionary
+                pass
+        fields.append(field)
+    return datastore_fields
+
+
 def populate_schema_from_datastore(res, datapackage_res):
     # convert datastore data dictionary to datapackage schema
     if 'schema' not in datapackage_res and 'datastore_fields' in res:
@@ -220,58 +1004,602 @@ def populate_schema_from_datastore(res, datapackage_res):
         datapackage_res['schema'] = {'fields': fields}
 
 
-def write_zip(fp, datapackage, ckan_and_datapackage_resources):
+def write_zip(fp, datapackage, ckan_and_datapackage_resources,
+              refresh_cache=False, existing_zip=None,
+              reusable_members=None, remote_validators=None,
+              compression_policy=None):
     '''
     Downloads resources and writes the zip file.
 
-    :param fp: Open file that the zip can be written to
+    If ckanext.downloadall.download_workers is more than 1, the resources are
+    downloaded concurrently into member files, and then added to the zip in
+    their original order, so the zip is the same as a sequential build.
+
+    If ckanext.downloadall.cache_dir is configured, member files are cached,
+    so resources that are unchanged since the last build are copied in from
+    the cache, rather than downloaded again.
+
+    Remote resources are requested with the validators (ETag/Last-Modified)
+    their server returned last time, so if they are not modified, they are
+    copied from the existing zip (or the cache) without being transferred
+    again.
+
+    :param fp: Open file that the zip can be written to. It needn't be
+        seekable, e.g. a MultipartUploadWriter.
+    :param refresh_cache: Download every resource, even if it is cached
+    :param existing_zip: (optional) Open file of the dataset's existing zip
+    :param reusable_members: (optional) dict of resource_id: filename of a
+        member of existing_zip, whose data is copied from it, rather than
+        downloaded. This is only correct if the resource's data has not
+        changed since it was written (see get_reusable_members()).
+    :param remote_validators: (optional) dict of the validators returned for
+        remote resources when the existing zip was written (see
+        load_remote_validators()). It is updated with the validators returned
+        this time.
+    :param compression_policy: (optional) CompressionPolicy for the
+        resources. Defaults to the one configured (see
+        get_compression_policy()).
     '''
+    if compression_policy is None:
+        compression_policy = get_compression_policy()
     include_dd = asbool(
         config.get('ckanext.downloadall.include_data_dictionary', False))
-    with zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zipf:
-        i = 0
-        for res, dres in ckan_and_datapackage_resources:
-            i += 1
+    cache = get_member_cache()
+    if remote_validators is None:
+        remote_validators = {}
+    existing_members = {}
+    if existing_zip:
+        existing_members = get_existing_members(
+            existing_zip, ckan_and_datapackage_resources,
+            reusable_members or {}, remote_validators)
+    new_remote_validators = {}
+    connections_before = sessions.stats.snapshot()
+    workers = get_download_workers()
+    executor = None
+    member_files = []
+    if workers > 1 and len(ckan_and_datapackage_resources) > 1:
+        executor = ThreadPoolExecutor(max_workers=workers)
+        for i, (res, dres) in enumerate(ckan_and_datapackage_resources):
+            member, validators = existing_members.get(i, (None, {}))
+            if member and validators is None:
+                # no need to download it
+                member_files.append(None)
+                continue
+            member_files.append(executor.submit(
+                get_member_file, res, cache, refresh_cache, validators,
+                compression_policy))
+        log.debug('Downloading {} resources with {} workers'
+                  .format(len([f for f in member_files if f]), workers))
+    try:
+        with zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zipf:
+            i = 0
+            for res, dres in ckan_and_datapackage_resources:
+                i += 1
 
-            log.debug('Downloading resource {}/{}: {}'
-                      .format(i, len(ckan_and_datapackage_resources), res['url']))
-            try:
-                filename = ckanapi.datapackage.resource_filename(dres)
-            except KeyError:
-                filename = dres['name']
+                log.debug('Downloading resource {}/{}: {}'
+                          .format(i, len(ckan_and_datapackage_resources), res['url']))
+                try:
+                    filename = ckanapi.datapackage.resource_filename(dres)
+                except KeyError:
+                    filename = dres['name']
+
+                existing_member, validators = \
+                    existing_members.get(i - 1, (None, {}))
+                try:
+                    if existing_member and validators is None:
+                        member_file = None
+                    elif executor:
+                        member_file, validators = member_files[i - 1].result()
+                    elif cache or existing_member:
+                        member_file, validators = get_member_file(
+                            res, cache, refresh_cache, validators,
+                            compression_policy)
+                    else:
+                        # stream it straight into the zip
+                        member_file = None
+                        validators = {}
+                        uploaded_file = open_uploaded_file(res)
+                        if uploaded_file:
+                            with uploaded_file:
+                                stream_resource_into_zip(
+                                    uploaded_file, filename, zipf,
+                                    size=res.get('size'),
+                                    format_=res.get('format'),
+                                    mimetype=res.get('mimetype'),
+                                    compression_policy=compression_policy)
+                        else:
+                            r = request_resource(res['url'])
+                            stream_resource_into_zip(
+                                streaming.ResponseReader(r.raw), filename,
+                                zipf, size=res.get('size'),
+                                format_=res.get('format'),
+                                mimetype=get_mimetype(res, r),
+                                compression_policy=compression_policy)
+                            validators = get_validators(r.headers)
+                    if member_file:
+                        with member_file:
+                            copy_member_into_zip(
+                                member_file, MEMBER_FILENAME, filename, zipf)
+                    elif existing_member:
+                        # unchanged
+                        copy_member_into_zip(
+                            existing_zip, existing_member, filename, zipf)
+                except DownloadError:
+                    # The dres['path'] is left as the url - i.e. an 'external
+                    # resource' of the data package.
+                    continue
+
+                # Optionally add a data dictionary CSV for resources with datastore
+                # data. Only after a successful download, so we never leave an
+                # orphaned data dictionary for a resource whose data file is absent.
+                if include_dd and res.get('datastore_fields'):
+                    try:
+                        write_data_dictionary_csv(res, filename, zipf)
+                    except Exception:
+                        # A data dictionary failure must never break the whole zip;
+                        # log.exception keeps the failure visible.
+                        log.exception('Failed to write data dictionary for %s',
+                                      res.get('id'))
+
+                save_local_path_in_datapackage_resource(dres, res, filename)
+
+                if validators is None:
+                    # copied from the existing zip - keep its validators
+                    validators = get_validators(
+                        remote_validators.get(res['id'], {}))
+                if validators and not is_uploaded(res):
+                    new_remote_validators[res['id']] = dict(
+                        validators, url=res['url'], member=filename)
+
+            # Add the datapackage.json
+            write_datapackage_json(datapackage, zipf)
+    finally:
+        if executor:
+            # don't leave member files open if the zip failed part way
+            member_files = [member_file for member_file in member_files
+                            if member_file]
+            for member_file in member_files:
+                member_file.cancel()
+            executor.shutdown(wait=True)
+            for member_file in member_files:
+                if not member_file.cancelled() and \
+                        not member_file.exception() and \
+                        member_file.result()[0]:
+                    member_file.result()[0].close()
+
+    remote_validators.clear()
+    remote_validators.update(new_remote_validators)
+
+    # (fp mightn't be a local file - see objectstore)
+    filesize = fp.tell()
+
+    log.info('Zip created: {} {} bytes'.format(fp.name, filesize))
+    opened, reused = [after - before for before, after in
+                      zip(connections_before, sessions.stats.snapshot())]
+    log.info('HTTP connections: {} opened, {} reused'.format(opened, reused))
+
+    return filesize
+
+
+def get_existing_members(existing_zip, ckan_and_datapackage_resources,
+                         reusable_members, remote_validators):
+    '''Finds the resources' members in the existing zip that might be reused.
+
+    The existing zip's central directory is read once, here, and the members
+    are copied using the ZipInfos returned, rather than reading it again for
+    each member copied.
+
+    :param reusable_members: dict of resource_id: filename of its member,
+        which can be reused as it is, because its data is unchanged
+    :returns: dict of the index of each resource to (ZipInfo of its member,
+        validators). If validators is None, the member can be reused as it is,
+        otherwise only if the server says the resource is not modified since
+        those validators.
+    '''
+    try:
+        with zipfile.ZipFile(existing_zip) as existing_zipf:
+            infos = dict((info.filename, info)
+                         for info in existing_zipf.infolist())
+    except zipfile.BadZipfile as e:
+        log.warning('Could not read existing zip: {}'.format(e))
+        return {}
+
+    existing_members = {}
+    for i, (res, dres) in enumerate(ckan_and_datapackage_resources):
+        member = reusable_members.get(res['id'])
+        if member in infos:
+            existing_members[i] = (infos[member], None)
+            continue
+        previous = remote_validators.get(res['id'])
+        if not is_uploaded(res) and previous and \
+                previous.get('url') == res['url'] and \
+                previous.get('member') in infos:
+            existing_members[i] = (infos[previous['member']],
+                                   get_validators(previous))
+    unchanged = len([validators for member, validators
+                     in existing_members.values() if validators is None])
+    if unchanged:
+        log.info('The data of {}/{} resources is unchanged - copying it from '
+                 'the existing zip'.format(
+                     unchanged, len(ckan_and_datapackage_resources)))
+    return existing_members
+
+
+def is_uploaded(res):
+    return res.get('url_type') == 'upload'
+
+
+def get_validators(headers):
+    '''Returns the validators from the headers of a response, or from stored
+    validators.
+
+    :param headers: dict-like, with keys ETag and Last-Modified (any case)
+    :returns: dict with keys etag and/or last_modified
+    '''
+    validators = {}
+    for key, header in (('etag', 'ETag'), ('last_modified', 'Last-Modified')):
+        value = headers.get(key) or headers.get(header)
+        if value:
+            validators[key] = value
+    return validators
+
+
+def get_member_cache():
+    '''Returns the cache of member files, or None if the config option
+    ckanext.downloadall.cache_dir is not set.
+    '''
+    cache_dir = config.get('ckanext.downloadall.cache_dir')
+    if not cache_dir:
+        return None
+    max_size = asint(config.get('ckanext.downloadall.cache_max_size',
+                                DEFAULT_CACHE_MAX_SIZE))
+    return MemberCache(cache_dir, max_size)
+
+
+def resource_cache_key(res):
+    '''Returns the key that a resource's member file is cached under. It
+    changes when the resource's URL, or the CKAN fields that record a change
+    to its data, change.
+    '''
+    validators = dict((key, res.get(key)) for key in DATA_VALIDATOR_FIELDS)
+    return member_key(res['id'], res['url'], validators)
+
+
+def get_download_buffer_size():
+    '''Returns the number of bytes copied at a time when downloading a
+    resource, from the config option ckanext.downloadall.download_buffer_size
+    (default: 1MB).
+    '''
+    return max(1024, asint(config.get(
+        'ckanext.downloadall.download_buffer_size',
+        streaming.DEFAULT_BUFFER_SIZE)))
+
+
+def get_compression_workers():
+    '''Returns the number of threads to deflate each large resource with,
+    from the config option ckanext.downloadall.compression_workers
+    (default: 1), or for the large lane, large_compression_workers.
+    '''
+    return max(1, asint(get_lane_config('compression_workers', 1)))
+
+
+def get_compression_policy(compression_level=None, deadline=None):
+    '''Returns the CompressionPolicy for a build, as configured by
+    ckanext.downloadall.compression_level and allow_lzma.
 
+    :param compression_level: (optional) overrides the configured level
+    :param deadline: (optional) time by which the build must finish
+    '''
+    if compression_level is None:
+        compression_level = config.get('ckanext.downloadall.compression_level')
+    return compression.CompressionPolicy(
+        level=parse_compression_level(compression_level),
+        deadline=deadline,
+        workers=get_compression_workers(),
+        allow_lzma=asbool(
+            config.get('ckanext.downloadall.allow_lzma', False)))
+
+
+def parse_compression_level(value):
+    '''Returns the compression level for a CompressionPolicy from a config or
+    command-line value: 0-9, 'auto' or None (the default).
+
+    :raises ValueError: if the value is not a level
+    '''
+    if value is None or str(value).strip() == '':
+        return None
+    if str(value).strip().lower() == compression.AUTO:
+        return compression.AUTO
+    try:
+        level = int(value)
+    except ValueError:
+        level = None
+    if level not in compression.LEVELS:
+        raise ValueError('Compression level must be 0-9 or "auto": {}'
+                         .format(value))
+    return level
+
+
+def get_job_timeout(lane=None):
+    '''Returns the timeout of update_zip jobs in seconds, from the config
+    option ckanext.downloadall.job_timeout (default: 1800), or for the large
+    lane, large_job_timeout.
+
+    :param lane: (optional) the lane of the job. Defaults to the lane of the
+        current job.
+    '''
+    return asint(get_lane_config('job_timeout', DEFAULT_JOB_TIMEOUT, lane))
+
+
+def get_lane(pkg):
+    '''Returns the lane that a dataset's build is routed to - LARGE_LANE if
+    its resources add up to ckanext.downloadall.large_dataset_size (default:
+    1GB), or its last build took ckanext.downloadall.large_build_seconds
+    (default: 300), otherwise SMALL_LANE.
+
+    :param pkg: model.Package
+    '''
+    size = 0
+    build_seconds = 0
+    for res in pkg.resources:
+        if res.extras.get('downloadall_metadata_modified'):
             try:
-                download_resource_into_zip(res['url'], filename, zipf)
-            except DownloadError:
-                # The dres['path'] is left as the url - i.e. an 'external
-                # resource' of the data package.
-                continue
+                build_seconds = float(
+                    res.extras.get('downloadall_build_seconds') or 0)
+            except ValueError:
+                pass
+        elif res.size:
+            size += int(res.size)
+    if size >= asint(config.get('ckanext.downloadall.large_dataset_size',
+                                DEFAULT_LARGE_DATASET_SIZE)) or \
+            build_seconds >= asint(config.get(
+                'ckanext.downloadall.large_build_seconds',
+                DEFAULT_LARGE_BUILD_SECONDS)):
+        return LARGE_LANE
+    return SMALL_LANE
+
+
+def get_dataset_lane(dataset_ref):
+    '''Returns the lane of a dataset (see get_lane()), given its id or name.
+    '''
+    pkg = model.Package.get(dataset_ref)
+    return get_lane(pkg) if pkg else SMALL_LANE
 
-            # Optionally add a data dictionary CSV for resources with datastore
-            # data. Only after a successful download, so we never leave an
-            # orphaned data dictionary for a resource whose data file is absent.
-            if include_dd and res.get('datastore_fields'):
-                try:
-                    write_data_dictionary_csv(res, filename, zipf)
-                except Exception:
-                    # A data dictionary failure must never break the whole zip;
-                    # log.exception keeps the failure visible.
-                    log.exception('Failed to write data dictionary for %s',
-                                  res.get('id'))
 
-            save_local_path_in_datapackage_resource(dres, res, filename)
+def get_streamed_download_max_size():
+    '''Returns the largest a streamed download of a zip can be, in bytes,
+    from the config option ckanext.downloadall.streamed_download_max_size
+    (default: large_dataset_size).
+    '''
+    return asint(config.get(
+        'ckanext.downloadall.streamed_download_max_size',
+        config.get('ckanext.downloadall.large_dataset_size',
+                   DEFAULT_LARGE_DATASET_SIZE)))
 
-            # TODO optimize using the file_hash
 
-        # Add the datapackage.json
-        write_datapackage_json(datapackage, zipf)
+def get_streamed_download_max_concurrent():
+    '''Returns the number of streamed downloads that each web server process
+    builds at once, from the config option
+    ckanext.downloadall.streamed_download_max_concurrent (default: 2).
+    '''
+    return max(1, asint(config.get(
+        'ckanext.downloadall.streamed_download_max_concurrent',
+        DEFAULT_STREAMED_DOWNLOAD_MAX_CONCURRENT)))
 
-    statinfo = os.stat(fp.name)
-    filesize = statinfo.st_size
 
-    log.info('Zip created: {} {} bytes'.format(fp.name, filesize))
+def get_dataset_lanes(dataset_names):
+    '''Returns the id and lane (see get_lane()) of each of the datasets, in
+    one query (and one of their resources), rather than one per dataset.
 
-    return filesize
+    :returns: dict of dataset name: (id, lane). Datasets that don't exist are
+        left out.
+    '''
+    pkgs = model.Session.query(model.Package) \
+        .filter(model.Package.name.in_(dataset_names)) \
+        .options(sa.orm.subqueryload(model.Package.resources_all))
+    return dict((pkg.name, (pkg.id, get_lane(pkg))) for pkg in pkgs)
+
+
+def get_lane_queue(lane):
+    '''Returns the queue of a lane, from the config option
+    ckanext.downloadall.small_queue (default: CKAN's default queue) or
+    large_queue (default: the same as small_queue).
+    '''
+    small_queue = config.get('ckanext.downloadall.small_queue',
+                             DEFAULT_QUEUE_NAME)
+    if lane == LARGE_LANE:
+        return config.get('ckanext.downloadall.large_queue', small_queue)
+    return small_queue
+
+
+def get_bulk_queue(lane):
+    '''Returns the queue of bulk builds (e.g. from update-all-zips), from the
+    config option ckanext.downloadall.bulk_queue (default: the lane's queue).
+    '''
+    return config.get('ckanext.downloadall.bulk_queue') or \
+        get_lane_queue(lane)
+
+
+def get_queue_names():
+    '''Returns the names of the queues that builds go in (unprefixed).'''
+    queues = set()
+    for lane in (SMALL_LANE, LARGE_LANE):
+        queues.update((get_lane_queue(lane), get_bulk_queue(lane)))
+    return sorted(queues)
+
+
+def get_job_options(lane, priority=jobs.INTERACTIVE):
+    '''Returns the queue and rq_kwargs to enqueue update_zip with, for a
+    build in the lane.
+
+    :param priority: jobs.INTERACTIVE or jobs.BULK. Bulk builds go in the bulk
+        queue. Interactive builds go to the front of their queue, if bulk
+        builds share it, and the caller should then call
+        jobs.keep_in_arrival_order() on the job, so that they are built in
+        the order they were queued.
+    '''
+    queue = get_lane_queue(lane)
+    rq_kwargs = {
+        'timeout': get_job_timeout(lane),
+        'meta': {'downloadall_lane': lane, 'downloadall_priority': priority},
+    }
+    if priority == jobs.BULK:
+        queue = get_bulk_queue(lane)
+    elif queue == get_bulk_queue(lane):
+        rq_kwargs['at_front'] = True
+    return queue, rq_kwargs
+
+
+def get_current_lane():
+    '''Returns the lane of the current job (SMALL_LANE if not in a job).'''
+    job = rq.get_current_job()
+    if job is None:
+        return SMALL_LANE
+    return job.meta.get('downloadall_lane', SMALL_LANE)
+
+
+def get_lane_config(key, default, lane=None):
+    '''Returns the config option ckanext.downloadall.<key>, or for the large
+    lane, ckanext.downloadall.large_<key> if that is set.
+
+    :param lane: (optional) Defaults to the lane of the current job.
+    '''
+    if (lane or get_current_lane()) == LARGE_LANE:
+        value = config.get('ckanext.downloadall.large_' + key)
+        if value is not None:
+            return value
+    return config.get('ckanext.downloadall.' + key, default)
+
+
+def get_job_deadline(started=None):
+    '''Returns the time by which the current job will time out, or None if
+    not running in a job (or it has no timeout).
+
+    :param started: (optional) time the job started (as in time.time()).
+        Defaults to now.
+    '''
+    job = rq.get_current_job()
+    if job is None or not job.timeout or job.timeout < 0:
+        return None
+    return (started or time.time()) + job.timeout
+
+
+def get_debounce_seconds():
+    '''Returns how long a dataset must stop changing for before its zip is
+    built, from the config option ckanext.downloadall.debounce_seconds
+    (default: 0 i.e. don't wait).
+    '''
+    return max(0, asint(config.get('ckanext.downloadall.debounce_seconds', 0)))
+
+
+def get_debounce_max_seconds():
+    '''Returns the longest a zip's build waits for its dataset to stop
+    changing, after the first change, from the config option
+    ckanext.downloadall.debounce_max_seconds (default: 300).
+    '''
+    return max(0, asint(
+        config.get('ckanext.downloadall.debounce_max_seconds', 300)))
+
+
+def defer_until_quiet(job, package_id, queued_datasets):
+    '''If the dataset is still changing (see get_debounce_seconds()), defers
+    the job - another is scheduled for when the dataset has stopped changing
+    (see jobs.QueuedDatasets.quiet_at()), rather than holding up a worker
+    waiting - and returns True. The dataset stays queued, so further changes
+    push the build back again.
+
+    It needs an rq scheduler for the job's queue (see the scheduler command),
+    otherwise the zip is built straight away.
+    '''
+    debounce_seconds = get_debounce_seconds()
+    if not debounce_seconds:
+        return False
+    quiet_at = queued_datasets.quiet_at(
+        package_id, debounce_seconds, get_debounce_max_seconds())
+    if quiet_at is None:
+        return False
+    if not jobs.is_scheduler_running(job.connection, job.origin):
+        log.warning('Not waiting for the dataset to stop changing - no rq '
+                    'scheduler is running for queue {} (see the "downloadall '
+                    'scheduler" command): {}'.format(job.origin, package_id))
+        return False
+    # (when it is due, an interactive build goes ahead of any bulk ones again)
+    at_front = get_job_options(
+        job.meta.get('downloadall_lane', SMALL_LANE),
+        job.meta.get('downloadall_priority', jobs.INTERACTIVE),
+    )[1].get('at_front', False)
+    deferred_job = jobs.defer(job, quiet_at, at_front=at_front)
+    queued_datasets.set_job(package_id, deferred_job.id)
+    log.info('Deferred the build by {:.0f}s, until the dataset stops '
+             'changing: {}'.format(quiet_at - time.time(), package_id))
+    return True
+
+
+def get_queued_datasets():
+    '''Returns the datasets queued for their zip to be updated (in the Redis
+    that CKAN's jobs use).
+    '''
+    return jobs.QueuedDatasets(connect_to_redis(), add_queue_name_prefix(''))
+
+
+def get_organization_rate_limit():
+    '''Returns the limit on interactive builds that each organization can
+    queue a minute, from the config option
+    ckanext.downloadall.organization_rate_limit (default: 30, 0 for no
+    limit).
+    '''
+    return jobs.OrganizationRateLimit(
+        connect_to_redis(),
+        max(0, asint(config.get('ckanext.downloadall.organization_rate_limit',
+                                DEFAULT_ORGANIZATION_RATE_LIMIT))),
+        prefix=add_queue_name_prefix(''))
+
+
+def get_datastore_changes():
+    '''Returns the record of when datasets' DataStore fields changed.'''
+    return jobs.DatastoreChanges(connect_to_redis(), add_queue_name_prefix(''))
+
+
+def get_wait_stats():
+    '''Returns the record of how long builds waited in the queue.'''
+    return jobs.WaitStats(connect_to_redis(), add_queue_name_prefix(''))
+
+
+def record_queue_wait(job):
+    '''Records (and logs) how long the job waited in the queue, for its
+    priority.
+    '''
+    if not job.enqueued_at:
+        return
+    # (enqueued_at is in UTC - naive in older versions of rq, aware in newer)
+    enqueued_at = calendar.timegm(job.enqueued_at.utctimetuple()) + \
+        job.enqueued_at.microsecond / 1e6
+    seconds = max(0, time.time() - enqueued_at)
+    priority = job.meta.get('downloadall_priority', jobs.INTERACTIVE)
+    log.info('Waited {:.0f}s in the queue ({})'.format(seconds, priority))
+    try:
+        get_wait_stats().record(priority, seconds)
+    except Exception:
+        # the stats aren't worth failing the build for
+        log.exception('Could not record the wait in the queue')
+
+
+def get_http_pool_size():
+    '''Returns the number of connections kept alive to each host, from the
+    config option ckanext.downloadall.http_pool_size (default: 10, or the
+    number of download workers, if more).
+    '''
+    return max(1, asint(config.get(
+        'ckanext.downloadall.http_pool_size',
+        max(sessions.DEFAULT_POOL_SIZE, get_download_workers()))))
+
+
+def get_download_workers():
+    '''Returns the number of resources to download concurrently, from the
+    config option ckanext.downloadall.download_workers (default: 1), or for
+    the large lane, large_download_workers.
+    '''
+    return max(1, asint(get_lane_config('download_workers', 1)))
 
 
 def save_local_path_in_datapackage_resource(datapackage_resource, res,
@@ -285,9 +1613,24 @@ def save_local_path_in_datapackage_resource(datapackage_resource, res,
     datapackage_resource['path'] = filename
 
 
-def download_resource_into_zip(url, filename, zipf):
+def request_resource(url, validators=None):
+    '''Starts the download of a resource.
+
+    :param validators: (optional) validators (see get_validators()) to make
+        the request conditional on, in which case the response may be a 304
+        Not Modified
+    :returns: the streaming response
+    :raises DownloadError: if the resource could not be requested
+    '''
+    headers = {}
+    if validators:
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
     try:
-        r = requests.get(url, stream=True, timeout=300)
+        session = sessions.get_session(get_http_pool_size())
+        r = session.get(url, stream=True, timeout=300, headers=headers)
         r.raise_for_status()
     except requests.ConnectionError:
         log.error('URL {url} refused connection. The resource will not'
@@ -306,34 +1649,226 @@ def download_resource_into_zip(url, filename, zipf):
         log.error('URL {url} download exception: {error}'
                   .format(url=url, error=str(e)))
         raise DownloadError()
+    return r
 
-    hash_object = hashlib.sha224()
-    size = 0
+
+def get_mimetype(res, r):
+    '''Returns the MIME type of a resource, or else the one its server gave
+    (r is the response of request_resource()).
+    '''
+    return res.get('mimetype') or r.headers.get('Content-Type')
+
+
+def make_zip_info(filename):
     # Create a ZipInfo object for setting the file's modified date
     zip_info = zipfile.ZipInfo(filename)
     # Set the modified date
     zip_info.date_time = datetime.datetime.now().timetuple()[:6]
     zip_info.compress_type = zipfile.ZIP_DEFLATED
-    try:
-        # python3 syntax - stream straight into the zip
-        with zipf.open(zip_info, 'w') as zf:
-            for chunk in r.iter_content(chunk_size=128):
-                zf.write(chunk)
-                hash_object.update(chunk)
-                size += len(chunk)
-    except RuntimeError:
-        # python2 syntax - need to save to disk first
-        with tempfile.NamedTemporaryFile() as datafile:
-            for chunk in r.iter_content(chunk_size=128):
-                datafile.write(chunk)
-                hash_object.update(chunk)
-                size += len(chunk)
-            datafile.flush()
-            # .write() streams the file into the zip
-            zipf.write(datafile.name, arcname=filename)
+    return zip_info
+
+
+def stream_resource_into_zip(source, filename, zipf, size=None,
+                             format_=None, mimetype=None,
+                             compression_policy=None):
+    '''Streams a resource's data straight into the zip.
+
+    Data that is compressed already (judging by its format, MIME type and
+    the start of the data) is stored, rather than deflated again.
+
+    :param source: file-like object of the resource's data - either an
+        uploaded file, or a streaming.ResponseReader of the response of
+        request_resource()
+    :param size: (optional) the expected size of the resource in bytes, e.g.
+        from its metadata, for choosing how much to compress it. Unless the
+        source is a local file, whose size is read from the file system, room
+        is left in the zip for it to be bigger than 2GB, since this size may
+        be out of date.
+    :param format_: (optional) the resource's format
+    :param mimetype: (optional) the resource's MIME type
+    :param compression_policy: (optional) CompressionPolicy that chooses how
+        much to compress it, if it is worth compressing
+    :returns: the sha224 of the resource data
+    '''
+    hash_object = hashlib.sha224()
+    zip_info = make_zip_info(filename)
+    buffer_size = get_download_buffer_size()
+    # zipfile has to be told before the data is written whether the member
+    # might need zip64, and fails at the end if the guess was wrong
+    local_file_size = streaming.get_local_file_size(source)
+    if local_file_size is not None:
+        size = local_file_size
+    force_zip64 = local_file_size is None or \
+        local_file_size * 1.05 > zipfile.ZIP64_LIMIT
+    head, source = streaming.read_head(source, compression.PROBE_SIZE)
+    compress_type, reason = compression.choose_compress_type(
+        format_, mimetype, head)
+    level = None
+    if compress_type == zipfile.ZIP_STORED:
+        log.info('Storing {}: {}'.format(filename, reason))
+    else:
+        compress_type, level, policy_reason = \
+            (compression_policy or get_compression_policy()).choose(size)
+        log.info('Compressing {}{}: {}, {}'.format(
+            filename, ' ({})'.format(format_bytes(int(size))) if size else '',
+            reason, policy_reason))
+    zip_info.compress_type = compress_type
+    # (zipfile has no public way to set the level of a member)
+    zip_info._compresslevel = level
+    with open_member_for_writing(zipf, zip_info, size, force_zip64,
+                                 level) as zf:
+        size = streaming.copy_stream(source, zf, buffer_size, hash_object)
     file_hash = hash_object.hexdigest()
     log.debug('Downloaded {}, hash: {}'
               .format(format_bytes(size), file_hash))
+    return file_hash
+
+
+def open_member_for_writing(zipf, zip_info, size=None, force_zip64=False,
+                            level=None):
+    '''Opens a member of the zip for writing. If
+    ckanext.downloadall.compression_workers is more than 1, deflated members
+    bigger than a block (or of unknown size) are deflated on that many
+    cores.
+    '''
+    workers = get_compression_workers()
+    if workers > 1 and zip_info.compress_type == zipfile.ZIP_DEFLATED and \
+            (not size or int(size) > streaming.DEFAULT_BLOCK_SIZE):
+        return streaming.ParallelDeflateWriter(
+            zipf, zip_info, streaming.get_executor(workers), workers,
+            level=zlib.Z_DEFAULT_COMPRESSION if level is None else level,
+            zip64=force_zip64)
+    return zipf.open(zip_info, 'w', force_zip64=force_zip64)
+
+
+def get_member_file(res, cache=None, refresh_cache=False, validators=None,
+                    compression_policy=None):
+    '''Returns a member file for a resource - a zip containing just that
+    resource, compressed, ready to be copied into the zip with
+    copy_member_into_zip(). It comes from the cache if possible,
+    otherwise the resource is downloaded. Remote resources are only cached if
+    their server returned validators, which the cached copy is checked with.
+    It is run in the download workers, so it doesn't touch the zip.
+
+    :param validators: (optional) validators (see get_validators()) to make
+        the request conditional on
+    :returns: (member file, validators returned by the server). The member
+        file is opened for reading, and the caller must close it. It is None
+        if the server said the resource is not modified since the given
+        validators.
+    :raises DownloadError: if the resource could not be downloaded
+    '''
+    r = None
+    if cache:
+        key = resource_cache_key(res)
+        member_file = None if refresh_cache else cache.open(key)
+        if member_file:
+            cached_validators = (cache.get_entry(key) or {}).get('validators')
+            if is_uploaded(res):
+                log.debug('Resource is in the cache: {}'.format(res['url']))
+                return member_file, cached_validators
+            if cached_validators:
+                # check the remote resource is not modified since it was
+                # cached
+                try:
+                    r = request_resource(res['url'], cached_validators)
+                except DownloadError:
+                    member_file.close()
+                    raise
+                if r.status_code == 304:
+                    sessions.release(r)
+                    log.debug('Resource is in the cache and not modified: {}'
+                              .format(res['url']))
+                    return member_file, cached_validators
+            # (else it was cached before remote resources without validators
+            # were left out, so it can't be checked)
+            member_file.close()
+    uploaded_file = None
+    if r is None:
+        uploaded_file = open_uploaded_file(res)
+    if r is None and not uploaded_file:
+        r = request_resource(res['url'], validators)
+        if r.status_code == 304:
+            sessions.release(r)
+            log.debug('Resource not modified: {}'.format(res['url']))
+            return None, validators
+
+    member_file = cache.temporary_file() if cache else \
+        tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        if uploaded_file:
+            with uploaded_file:
+                file_hash = download_resource_into_member_file(
+                    uploaded_file, res['url'], member_file,
+                    size=res.get('size'), format_=res.get('format'),
+                    mimetype=res.get('mimetype'),
+                    compression_policy=compression_policy)
+            new_validators = {}
+        else:
+            file_hash = download_resource_into_member_file(
+                streaming.ResponseReader(r.raw), res['url'], member_file,
+                size=res.get('size'), format_=res.get('format'),
+                mimetype=get_mimetype(res, r),
+                compression_policy=compression_policy)
+            new_validators = get_validators(r.headers)
+        # a remote resource whose server returned no validators can't be
+        # checked, so its data might change without its cache key changing
+        if cache and (is_uploaded(res) or new_validators):
+            cache.add(key, file_hash, member_file.name,
+                      resource_id=res['id'], url=res['url'],
+                      validators=new_validators)
+    except Exception:
+        member_file.close()
+        raise
+    return member_file, new_validators
+
+
+def download_resource_into_member_file(source, url, member_file, size=None,
+                                       format_=None, mimetype=None,
+                                       compression_policy=None):
+    '''Downloads a resource into a member file.
+
+    :param source: file-like object of the resource's data (see
+        stream_resource_into_zip(), as for the other parameters)
+    :returns: the sha224 of the resource data
+    :raises DownloadError: if the resource could not be downloaded
+    '''
+    try:
+        with zipfile.ZipFile(member_file, 'w', zipfile.ZIP_DEFLATED,
+                             allowZip64=True) as member_zipf:
+            file_hash = stream_resource_into_zip(
+                source, MEMBER_FILENAME, member_zipf, size=size,
+                format_=format_, mimetype=mimetype,
+                compression_policy=compression_policy)
+    except (requests.exceptions.RequestException,
+            urllib3.exceptions.HTTPError) as e:
+        # unlike streaming into the zip, nothing has been written to the zip
+        # yet, so the resource can be cleanly left out
+        log.error('URL {url} download exception: {error}'
+                  .format(url=url, error=str(e)))
+        raise DownloadError()
+    member_file.flush()
+    return file_hash
+
+
+def copy_member_into_zip(source, member, filename, zipf):
+    '''Copies a member from another zip file (e.g. a member file) into the
+    zip, without decompressing and compressing it again.
+
+    :param member: the member's name in the source zip, or its ZipInfo, which
+        saves reading the source's central directory (e.g. for each member
+        copied from the existing zip - see get_existing_members())
+    '''
+    if isinstance(member, zipfile.ZipInfo):
+        zip_info = member
+    else:
+        source.seek(0)
+        with zipfile.ZipFile(source) as source_zipf:
+            zip_info = source_zipf.getinfo(member)
+    streaming.copy_member(
+        source, zip_info, zipf, filename=filename,
+        date_time=datetime.datetime.now().timetuple()[:6],
+        buffer_size=get_download_buffer_size())
 
 
 def write_datapackage_json(datapackage, zipf):
@@ -1,7 +1,10 @@
 """Tests for plugin.py."""
+import time
+
 import pytest
 from ckan.tests import factories
 from ckan.tests import helpers
+from ckanext.downloadall.tasks import get_datastore_changes
 from ckanext.downloadall.tests import TestBase
 
 
@@ -20,3 +23,14 @@ class TestDatastoreCreate(TestBase):
         # Check the chained action caused the zip to be queued for update
         assert [job['title'] for job in helpers.call_action('job_list')] == [
             'DownloadAll datastore_create "{}" {}'.format(dataset['name'], dataset['id'])]
+
+    def test_datastore_create_is_recorded_for_sweeps(self):
+        dataset = factories.Dataset(
+            resources=[{'url': 'https://example.com/data.csv', 'format': 'csv'}])
+        before = time.time()
+
+        helpers.call_action('datastore_create',
+                            resource_id=dataset['resources'][0]['id'],
+                            force=True)
+
+        assert list(get_datastore_changes().since(before)) == [dataset['id']]
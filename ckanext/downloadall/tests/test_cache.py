@@ -0,0 +1,110 @@
+"""Tests for cache.py."""
+import os
+import time
+
+import mock
+
+from ckanext.downloadall import cache as cache_module
+from ckanext.downloadall.cache import MemberCache, member_key
+
+
+def write_member_file(tmpdir, name, content):
+    path = str(tmpdir.join(name))
+    with open(path, 'wb') as f:
+        f.write(content)
+    return path
+
+
+class TestMemberKey(object):
+    def test_validators_change_the_key(self):
+        key = member_key('res-id', 'http://example.com/a.csv',
+                         {'last_modified': '2020-01-01T00:00:00', 'size': 5})
+        assert key != member_key(
+            'res-id', 'http://example.com/a.csv',
+            {'last_modified': '2020-01-02T00:00:00', 'size': 5})
+        assert key == member_key(
+            'res-id', 'http://example.com/a.csv',
+            {'size': 5, 'last_modified': '2020-01-01T00:00:00'})
+
+
+class TestMemberCache(object):
+    def test_add_and_open(self, tmpdir):
+        cache = MemberCache(str(tmpdir.join('cache')), max_size=1000)
+        path = write_member_file(tmpdir, 'member.zip', b'member')
+
+        cache.add('key1', 'hash1', path, url='http://example.com/a.csv')
+
+        with cache.open('key1') as f:
+            assert f.read() == b'member'
+        assert cache.get_entry('key1') == {
+            'content_hash': 'hash1', 'url': 'http://example.com/a.csv'}
+        # the caller still owns the original file
+        assert os.path.exists(path)
+
+    def test_miss(self, tmpdir):
+        cache = MemberCache(str(tmpdir.join('cache')), max_size=1000)
+        assert cache.open('key1') is None
+
+    def test_same_content_is_stored_once(self, tmpdir):
+        cache = MemberCache(str(tmpdir.join('cache')), max_size=1000)
+        path = write_member_file(tmpdir, 'member.zip', b'member')
+
+        cache.add('key1', 'hash1', path)
+        cache.add('key2', 'hash1', path)
+
+        blobs = [f for _, _, files in os.walk(cache.blob_dir) for f in files]
+        assert blobs == ['hash1.zip']
+        assert cache.open('key2').read() == b'member'
+
+    def test_least_recently_used_is_evicted(self, tmpdir):
+        cache = MemberCache(str(tmpdir.join('cache')), max_size=25)
+        cache.add('key1', 'hash1',
+                  write_member_file(tmpdir, '1.zip', b'1' * 10))
+        cache.add('key2', 'hash2',
+                  write_member_file(tmpdir, '2.zip', b'2' * 10))
+        # use key1, so that key2 is the least recently used
+        old = time.time() - 100
+        os.utime(cache._blob_path('hash2'), (old, old))
+        cache.open('key1').close()
+
+        cache.add('key3', 'hash3',
+                  write_member_file(tmpdir, '3.zip', b'3' * 10))
+
+        assert cache.open('key1') is not None
+        assert cache.open('key2') is None
+        assert cache.open('key3') is not None
+
+    def test_size_is_a_running_total(self, tmpdir):
+        cache = MemberCache(str(tmpdir.join('cache')), max_size=1000)
+        cache.add('key1', 'hash1',
+                  write_member_file(tmpdir, '1.zip', b'1' * 10))
+
+        with mock.patch.object(cache_module.os, 'walk',
+                               wraps=os.walk) as walk:
+            # (another process, sharing the cache)
+            other_cache = MemberCache(str(tmpdir.join('cache')),
+                                      max_size=1000)
+            other_cache.add('key2', 'hash2',
+                            write_member_file(tmpdir, '2.zip', b'2' * 10))
+            # the same content again
+            cache.add('key3', 'hash2',
+                      write_member_file(tmpdir, '2.zip', b'2' * 10))
+
+        # the cache wasn't walked to add up its size
+        assert walk.call_count == 0
+        with open(cache.size_path) as f:
+            assert f.read() == '20'
+
+    def test_size_is_corrected_by_evict(self, tmpdir):
+        cache = MemberCache(str(tmpdir.join('cache')), max_size=1000)
+        cache.add('key1', 'hash1',
+                  write_member_file(tmpdir, '1.zip', b'1' * 10))
+        cache.add('key2', 'hash2',
+                  write_member_file(tmpdir, '2.zip', b'2' * 10))
+        # e.g. deleted by hand
+        os.unlink(cache._blob_path('hash1'))
+
+        cache.evict()
+
+        with open(cache.size_path) as f:
+            assert f.read() == '10'
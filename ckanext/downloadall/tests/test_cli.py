@@ -0,0 +1,30 @@
+"""Tests for cli.py."""
+from ckan.tests import factories, helpers
+from ckanext.downloadall import cli
+from ckanext.downloadall.tests import TestBase
+
+
+class TestEnqueueAllZips(TestBase):
+    def test_jobs_have_titles(self):
+        dataset = factories.Dataset()
+        helpers.call_action('job_clear')
+
+        cli.enqueue_all_zips([dataset['name']], skip_if_no_changes=True,
+                             compression_level=None)
+
+        jobs = helpers.call_action('job_list', queues=['default'])
+        assert [job['title'] for job in jobs] == [
+            'DownloadAll cli-requested "{}" {}'.format(dataset['name'],
+                                                       dataset['id'])]
+        assert helpers.call_action('job_show', id=jobs[0]['id'])['title'] == \
+            jobs[0]['title']
+
+    def test_queued_datasets_are_skipped(self):
+        dataset = factories.Dataset()
+
+        cli.enqueue_all_zips([dataset['name']], skip_if_no_changes=True,
+                             compression_level=None)
+
+        # only the job queued when it was created
+        assert helpers.call_action(
+            'job_list', queues=['default']) == []
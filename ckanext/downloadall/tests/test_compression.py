@@ -0,0 +1,99 @@
+"""Tests for compression.py."""
+import gzip
+import io
+import os
+import time
+import zipfile
+
+import pytest
+
+from ckanext.downloadall.compression import (
+    choose_compress_type, CompressionPolicy, AUTO)
+
+
+def gzipped(data):
+    fp = io.BytesIO()
+    with gzip.GzipFile(fileobj=fp, mode='wb') as f:
+        f.write(data)
+    return fp.getvalue()
+
+
+CSV = b'2017-06-01,gold,1234.5678,"some text in a column"\n' * 1000
+
+
+class TestChooseCompressType(object):
+    @pytest.mark.parametrize('format_', ['ZIP', 'png', '.gz', 'XLSX'])
+    def test_compressed_format(self, format_):
+        compress_type, reason = choose_compress_type(format_=format_,
+                                                     head=CSV)
+        assert compress_type == zipfile.ZIP_STORED
+        assert reason.startswith('format is ')
+
+    @pytest.mark.parametrize('mimetype', [
+        'application/zip', 'image/jpeg', 'video/mp4',
+        'application/gzip; charset=binary'])
+    def test_compressed_mimetype(self, mimetype):
+        compress_type, reason = choose_compress_type(mimetype=mimetype,
+                                                     head=CSV)
+        assert compress_type == zipfile.ZIP_STORED
+        assert reason.startswith('MIME type is ')
+
+    @pytest.mark.parametrize('mimetype', ['image/svg+xml', 'text/csv'])
+    def test_compressible_mimetype(self, mimetype):
+        compress_type, _ = choose_compress_type(mimetype=mimetype, head=CSV)
+        assert compress_type == zipfile.ZIP_DEFLATED
+
+    def test_compressed_data(self):
+        compress_type, reason = choose_compress_type(
+            format_='CSV', mimetype='text/csv', head=gzipped(CSV))
+        assert compress_type == zipfile.ZIP_STORED
+        assert reason == 'data is gzip'
+
+    def test_random_data(self):
+        compress_type, reason = choose_compress_type(
+            format_='bin', head=os.urandom(64 * 1024))
+        assert compress_type == zipfile.ZIP_STORED
+        assert reason.startswith('probe compressed by only')
+
+    def test_compressible_data(self):
+        compress_type, _ = choose_compress_type(format_='CSV', head=CSV)
+        assert compress_type == zipfile.ZIP_DEFLATED
+
+    def test_no_data(self):
+        compress_type, _ = choose_compress_type(format_='CSV', head=b'')
+        assert compress_type == zipfile.ZIP_DEFLATED
+
+
+MB = 1024 * 1024
+
+
+class TestCompressionPolicy(object):
+    def test_fixed_level(self):
+        assert CompressionPolicy(level=3).choose(10 * MB)[:2] == \
+            (zipfile.ZIP_DEFLATED, 3)
+        assert CompressionPolicy().choose(10 * MB)[:2] == \
+            (zipfile.ZIP_DEFLATED, None)
+
+    @pytest.mark.parametrize('size,level', [
+        (MB, 9), (100 * MB, 6), (None, 6), (2000 * MB, 1)])
+    def test_auto_by_size(self, size, level):
+        assert CompressionPolicy(level=AUTO).choose(size)[:2] == \
+            (zipfile.ZIP_DEFLATED, level)
+
+    def test_auto_lzma_for_small_members(self):
+        policy = CompressionPolicy(level=AUTO, allow_lzma=True)
+        assert policy.choose(MB)[0] == zipfile.ZIP_LZMA
+        assert policy.choose(100 * MB)[:2] == (zipfile.ZIP_DEFLATED, 6)
+
+    def test_auto_is_faster_when_time_is_short(self):
+        deadline = time.time() + 20
+        policy = CompressionPolicy(level=AUTO, deadline=deadline)
+        # at level 6 it would take longer than half the time left
+        compress_type, level, reason = policy.choose(500 * MB)
+        assert level == 1
+        assert reason.endswith('s left')
+
+    def test_auto_counts_the_workers(self):
+        deadline = time.time() + 20
+        policy = CompressionPolicy(level=AUTO, deadline=deadline, workers=8)
+        assert policy.choose(500 * MB)[1] == 6
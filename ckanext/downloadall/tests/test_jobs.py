@@ -0,0 +1,315 @@
+"""Tests for jobs.py."""
+import calendar
+import time
+
+import fakeredis
+import mock
+import pytest
+from rq import Queue
+from rq.registry import ScheduledJobRegistry
+from rq.scheduler import RQScheduler
+
+from ckanext.downloadall import jobs
+
+
+@pytest.fixture
+def connection():
+    return fakeredis.FakeStrictRedis()
+
+
+@pytest.fixture
+def queue(connection):
+    return Queue('test', connection=connection)
+
+
+class FakeClock(object):
+    '''Stands in for the time module, with sleep() moving the time on, and
+    calling a callback, if one is given for the time.
+    '''
+    def __init__(self, callbacks=None):
+        self.now = 1000.0
+        self.slept = []
+        self.callbacks = callbacks or {}
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+        for at in sorted(self.callbacks):
+            if at <= self.now:
+                self.callbacks.pop(at)()
+
+
+class TestQueuedDatasets(object):
+    def enqueue(self, queued_datasets, queue, dataset_id):
+        if not queued_datasets.claim(dataset_id):
+            return None
+        job = queue.enqueue('ckanext.downloadall.tasks.update_zip',
+                            dataset_id)
+        queued_datasets.set_job(dataset_id, job.id)
+        return job
+
+    def test_queued_once(self, connection, queue):
+        queued_datasets = jobs.QueuedDatasets(connection)
+
+        assert self.enqueue(queued_datasets, queue, 'gold')
+        assert not self.enqueue(queued_datasets, queue, 'gold')
+        assert self.enqueue(queued_datasets, queue, 'silver')
+        assert queue.count == 2
+
+    def test_queued_again_when_released(self, connection, queue):
+        queued_datasets = jobs.QueuedDatasets(connection)
+        self.enqueue(queued_datasets, queue, 'gold')
+
+        # i.e. the job has started
+        queued_datasets.release('gold')
+
+        assert self.enqueue(queued_datasets, queue, 'gold')
+        assert queue.count == 2
+
+    def test_queued_again_when_job_is_gone(self, connection, queue):
+        queued_datasets = jobs.QueuedDatasets(connection)
+        job = self.enqueue(queued_datasets, queue, 'gold')
+
+        # e.g. the queue was emptied
+        job.delete()
+
+        assert self.enqueue(queued_datasets, queue, 'gold')
+        assert queue.count == 1
+
+    def test_not_queued_while_being_enqueued(self, connection):
+        queued_datasets = jobs.QueuedDatasets(connection)
+
+        assert queued_datasets.claim('gold')
+        assert not queued_datasets.claim('gold')
+
+    def test_prefix(self, connection):
+        assert jobs.QueuedDatasets(connection, 'ckan:site1:').claim('gold')
+        assert jobs.QueuedDatasets(connection, 'ckan:site2:').claim('gold')
+        assert connection.get('ckan:site1:downloadall:queued:gold') == \
+            jobs.ENQUEUING.encode()
+
+    def test_claim_many(self, connection, queue):
+        queued_datasets = jobs.QueuedDatasets(connection)
+        self.enqueue(queued_datasets, queue, 'gold')
+        self.enqueue(queued_datasets, queue, 'silver').delete()
+        self.enqueue(queued_datasets, queue, 'bronze')
+        queued_datasets.release('bronze')
+        queued_datasets.claim('platinum')
+
+        claimed = queued_datasets.claim_many(
+            ['gold', 'silver', 'bronze', 'platinum', 'copper', 'copper'])
+
+        assert sorted(claimed) == ['bronze', 'copper', 'silver']
+        assert queued_datasets.claim_many(claimed) == []
+
+    def test_set_jobs_and_release_many(self, connection, queue):
+        queued_datasets = jobs.QueuedDatasets(connection)
+        claimed = queued_datasets.claim_many(['gold', 'silver'])
+        jobs_ = jobs.enqueue_many(queue, [
+            dict(func='ckanext.downloadall.tasks.update_zip',
+                 args=[dataset_id], description=dataset_id)
+            for dataset_id in claimed])
+        queued_datasets.set_jobs(dict((job.args[0], job.id) for job in jobs_))
+
+        assert queued_datasets.claim_many(['gold', 'silver']) == []
+
+        queued_datasets.release_many(['gold', 'silver'])
+        assert sorted(queued_datasets.claim_many(['gold', 'silver'])) == \
+            ['gold', 'silver']
+
+
+class TestEnqueueMany(object):
+    def test_enqueue_many(self, queue):
+        jobs_ = jobs.enqueue_many(queue, [
+            dict(func='ckanext.downloadall.tasks.update_zip', args=[name],
+                 description=name, timeout=60, meta={'downloadall_lane': 'x'})
+            for name in ('gold', 'silver')])
+
+        assert queue.job_ids == [job.id for job in jobs_]
+        assert [job.description for job in queue.jobs] == ['gold', 'silver']
+        assert queue.jobs[0].timeout == 60
+        assert queue.jobs[0].meta == {'downloadall_lane': 'x'}
+
+    def test_older_rq(self, queue):
+        with mock.patch.object(jobs.Queue, 'enqueue_many', create=True,
+                               new=property()):
+            # (property() makes hasattr() false)
+            assert not hasattr(queue, 'enqueue_many')
+            jobs.enqueue_many(queue, [
+                dict(func='ckanext.downloadall.tasks.update_zip',
+                     args=[name], description=name)
+                for name in ('gold', 'silver')])
+
+        assert [job.description for job in queue.jobs] == ['gold', 'silver']
+
+
+class TestQuietAt(object):
+    def test_no_changes(self, connection):
+        queued_datasets = jobs.QueuedDatasets(connection)
+        with mock.patch.object(jobs, 'time', FakeClock()):
+            assert queued_datasets.quiet_at('gold', 60, 300) is None
+
+    def test_changes_push_it_back(self, connection):
+        queued_datasets = jobs.QueuedDatasets(connection)
+        clock = FakeClock()
+        with mock.patch.object(jobs, 'time', clock):
+            queued_datasets.touch('gold', 300)
+            assert queued_datasets.quiet_at('gold', 60, 300) == 1060
+            clock.now += 50
+            queued_datasets.touch('gold', 300)
+            assert queued_datasets.quiet_at('gold', 60, 300) == 1110
+            clock.now += 60
+            assert queued_datasets.quiet_at('gold', 60, 300) is None
+
+    def test_max_delay(self, connection):
+        queued_datasets = jobs.QueuedDatasets(connection)
+        clock = FakeClock()
+        with mock.patch.object(jobs, 'time', clock):
+            # a change every 50s
+            for _ in range(6):
+                clock.now += 50
+                queued_datasets.touch('gold', 300)
+            assert queued_datasets.quiet_at('gold', 60, 300) == 1350
+
+    def test_release_forgets_the_changes(self, connection):
+        queued_datasets = jobs.QueuedDatasets(connection)
+        queued_datasets.touch('gold', 300)
+        queued_datasets.release('gold')
+        assert queued_datasets.quiet_at('gold', 60, 300) is None
+
+
+class TestDefer(object):
+    def test_defer(self, connection, queue):
+        job = queue.enqueue('ckanext.downloadall.tasks.update_zip', 'gold',
+                            job_timeout=100, description='Build gold',
+                            meta={'title': 'Build gold'})
+        queued_datasets = jobs.QueuedDatasets(connection)
+
+        deferred_job = jobs.defer(job, time.time() + 60)
+
+        assert deferred_job.id != job.id
+        assert deferred_job.get_status() == 'scheduled'
+        assert deferred_job.func_name == job.func_name
+        assert deferred_job.args == ('gold',)
+        assert deferred_job.timeout == 100
+        assert deferred_job.meta['title'] == 'Build gold'
+        scheduled_time = ScheduledJobRegistry(queue=queue) \
+            .get_scheduled_time(deferred_job)
+        assert abs(calendar.timegm(scheduled_time.utctimetuple()) -
+                   (time.time() + 60)) < 5
+        # it isn't in the queue yet
+        assert queue.job_ids == [job.id]
+        # so the dataset is still queued
+        assert queued_datasets.is_waiting(deferred_job.id)
+
+    def test_is_scheduler_running(self, connection):
+        assert not jobs.is_scheduler_running(connection, 'test')
+
+        connection.set(RQScheduler.get_locking_key('test'), 'scheduler')
+
+        assert jobs.is_scheduler_running(connection, 'test')
+
+
+class TestKeepInArrivalOrder(object):
+    def enqueue(self, queue, name, interactive=True):
+        job = queue.enqueue('ckanext.downloadall.tasks.update_zip', name,
+                            description=name, at_front=interactive)
+        if interactive:
+            jobs.keep_in_arrival_order(job)
+        return job
+
+    def test_interactive_jobs_are_in_order_ahead_of_bulk(self, queue):
+        for name in ('bulk1', 'bulk2'):
+            self.enqueue(queue, name, interactive=False)
+        for name in ('edit1', 'edit2', 'edit3'):
+            self.enqueue(queue, name)
+        self.enqueue(queue, 'bulk3', interactive=False)
+
+        assert [job.description for job in queue.jobs] == [
+            'edit1', 'edit2', 'edit3', 'bulk1', 'bulk2', 'bulk3']
+
+    def test_after_the_earlier_ones_have_started(self, queue):
+        self.enqueue(queue, 'bulk1', interactive=False)
+        self.enqueue(queue, 'edit1')
+        self.enqueue(queue, 'edit2')
+        # a worker takes them
+        queue.remove(queue.jobs[0])
+        queue.remove(queue.jobs[0])
+
+        self.enqueue(queue, 'edit3')
+
+        assert [job.description for job in queue.jobs] == ['edit3', 'bulk1']
+
+
+class TestOrganizationRateLimit(object):
+    def test_limit(self, connection):
+        rate_limit = jobs.OrganizationRateLimit(connection, 2)
+        with mock.patch.object(jobs, 'time', FakeClock()) as clock:
+            assert [rate_limit.allow('org1') for _ in range(3)] == \
+                [True, True, False]
+            assert rate_limit.allow('org2')
+
+            # the next minute
+            clock.now += 60
+            assert rate_limit.allow('org1')
+
+    def test_no_limit(self, connection):
+        rate_limit = jobs.OrganizationRateLimit(connection, 0)
+        assert all(rate_limit.allow('org1') for _ in range(100))
+
+
+class TestWaitStats(object):
+    def test_summary(self, connection):
+        wait_stats = jobs.WaitStats(connection)
+        for seconds in range(1, 101):
+            wait_stats.record(jobs.BULK, seconds)
+        wait_stats.record(jobs.INTERACTIVE, 2)
+
+        assert wait_stats.summary(jobs.BULK) == {
+            'count': 100, 'mean': 50.5, 'median': 51, 'p95': 96, 'max': 100}
+        assert wait_stats.summary(jobs.INTERACTIVE)['max'] == 2
+
+    def test_nothing_recorded(self, connection):
+        assert jobs.WaitStats(connection).summary(jobs.BULK) == {'count': 0}
+
+    def test_recent_waits_are_kept(self, connection):
+        wait_stats = jobs.WaitStats(connection)
+        with mock.patch.object(jobs, 'WAITS_KEPT', 3):
+            for seconds in (100, 1, 2, 3):
+                wait_stats.record(jobs.BULK, seconds)
+
+        assert wait_stats.summary(jobs.BULK)['max'] == 3
+
+
+class TestDatastoreChanges(object):
+    def test_since(self, connection):
+        datastore_changes = jobs.DatastoreChanges(connection)
+        clock = FakeClock()
+        with mock.patch.object(jobs, 'time', clock):
+            datastore_changes.add('gold')
+            clock.now += 10
+            datastore_changes.add('silver')
+            datastore_changes.add('gold')
+
+        assert datastore_changes.since(1005) == {'gold': 1010, 'silver': 1010}
+        assert datastore_changes.since(1011) == {}
+
+    def test_old_changes_are_forgotten(self, connection):
+        datastore_changes = jobs.DatastoreChanges(connection)
+        clock = FakeClock()
+        with mock.patch.object(jobs, 'time', clock):
+            datastore_changes.add('gold')
+            clock.now += jobs.DATASTORE_CHANGES_TTL + 1
+            datastore_changes.add('silver')
+
+        assert datastore_changes.since(0) == {'silver': clock.now}
+
+
+def test_interleave():
+    datasets = [('a', 1), ('a', 2), ('a', 3), ('b', 1), ('c', 1), ('b', 2)]
+
+    assert jobs.interleave(datasets, key=lambda dataset: dataset[0]) == [
+        ('a', 1), ('b', 1), ('c', 1), ('a', 2), ('b', 2), ('a', 3)]
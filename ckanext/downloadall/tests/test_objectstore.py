@@ -0,0 +1,125 @@
+"""Tests for objectstore.py, against moto's S3."""
+import io
+import os
+import zipfile
+
+import mock
+import pytest
+
+from ckanext.downloadall import objectstore
+
+moto = pytest.importorskip('moto')
+# (moto 5 replaced mock_s3 with mock_aws)
+mock_s3 = getattr(moto, 'mock_aws', None) or moto.mock_s3
+
+PART_SIZE = objectstore.MIN_PART_SIZE
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    with mock_s3():
+        client = objectstore.make_client(region_name='us-east-1')
+        client.create_bucket(Bucket='zips')
+        yield client
+
+
+def get_object(client, key):
+    return client.get_object(Bucket='zips', Key=key)['Body'].read()
+
+
+def list_uploads(client):
+    return client.list_multipart_uploads(Bucket='zips').get('Uploads', [])
+
+
+class TestMultipartUploadWriter(object):
+    def test_parts_are_uploaded_as_they_fill(self, s3):
+        data = os.urandom(PART_SIZE * 2 + 1000)
+        writer = objectstore.MultipartUploadWriter(
+            s3, 'zips', 'a.zip', part_size=PART_SIZE)
+
+        writer.write(data[:PART_SIZE - 1])
+        assert not writer.uploading
+        writer.write(data[PART_SIZE - 1:])
+        assert len(writer.parts) + len(writer.uploading) == 2
+        assert len(writer.buffer) == 1000
+        # the object doesn't exist until the upload is completed
+        with pytest.raises(s3.exceptions.NoSuchKey):
+            get_object(s3, 'a.zip')
+
+        writer.close()
+
+        assert len(writer.parts) == 3
+        assert writer.tell() == len(data)
+        assert get_object(s3, 'a.zip') == data
+        assert list_uploads(s3) == []
+
+    def test_parts_in_memory_are_bounded(self, s3):
+        writer = objectstore.MultipartUploadWriter(
+            s3, 'zips', 'a.zip', part_size=PART_SIZE, concurrency=2)
+        with mock.patch.object(writer, 'executor') as executor:
+            for i in range(4):
+                writer.write(b'x' * PART_SIZE)
+                assert len(writer.uploading) <= 2
+        assert executor.submit.call_count == 4
+        writer.abort()
+
+    def test_zip(self, s3):
+        with objectstore.MultipartUploadWriter(
+                s3, 'zips', 'a.zip', part_size=PART_SIZE) as writer:
+            with zipfile.ZipFile(writer, 'w', zipfile.ZIP_STORED) as zipf:
+                zipf.writestr('datapackage.json', b'{}')
+                with zipf.open('data.bin', 'w') as member:
+                    member.write(os.urandom(PART_SIZE + 1))
+
+        with zipfile.ZipFile(io.BytesIO(get_object(s3, 'a.zip'))) as zipf:
+            assert zipf.namelist() == ['datapackage.json', 'data.bin']
+            assert zipf.read('datapackage.json') == b'{}'
+            assert len(zipf.read('data.bin')) == PART_SIZE + 1
+            assert zipf.testzip() is None
+
+    def test_empty(self, s3):
+        objectstore.MultipartUploadWriter(s3, 'zips', 'a.zip').close()
+
+        assert get_object(s3, 'a.zip') == b''
+
+    def test_abort_on_error(self, s3):
+        with pytest.raises(ValueError):
+            with objectstore.MultipartUploadWriter(
+                    s3, 'zips', 'a.zip', part_size=PART_SIZE) as writer:
+                writer.write(b'x' * (PART_SIZE + 1))
+                raise ValueError('Download failed')
+
+        assert list_uploads(s3) == []
+        with pytest.raises(s3.exceptions.NoSuchKey):
+            get_object(s3, 'a.zip')
+
+    def test_existing_object_is_kept_until_completed(self, s3):
+        s3.put_object(Bucket='zips', Key='a.zip', Body=b'old')
+        writer = objectstore.MultipartUploadWriter(s3, 'zips', 'a.zip')
+        writer.write(b'new')
+        assert get_object(s3, 'a.zip') == b'old'
+
+        writer.close()
+        assert get_object(s3, 'a.zip') == b'new'
+
+    def test_part_size_too_small(self, s3):
+        with pytest.raises(ValueError):
+            objectstore.MultipartUploadWriter(s3, 'zips', 'a.zip',
+                                              part_size=1024)
+
+
+class TestObjectStorage(object):
+    def test_key_and_delete(self, s3):
+        storage = objectstore.ObjectStorage(s3, 'zips', part_size=PART_SIZE)
+        key = storage.key('1234', 'gold.zip')
+        assert key == 'resources/1234/gold.zip'
+
+        with storage.open(key) as writer:
+            writer.write(b'zip')
+        assert get_object(s3, key) == b'zip'
+
+        storage.delete(key)
+        with pytest.raises(s3.exceptions.NoSuchKey):
+            get_object(s3, key)
@@ -1,6 +1,11 @@
 """Tests for plugin.py."""
+import mock
+import pytest
+from ckan import model
 from ckan.tests import factories
 from ckan.tests import helpers
+from ckanext.downloadall import jobs, plugin
+from ckanext.downloadall.tasks import get_queued_datasets, SMALL_LANE
 from ckanext.downloadall.tests import TestBase
 
 
@@ -75,6 +80,122 @@ class TestNotify(TestBase):
         assert 'DownloadAll changed "{}" {}'.format(dataset['name'], dataset['id']) in [
             job['title'] for job in helpers.call_action('job_list')]
 
+    def test_dataset_is_queued_once(self):
+        dataset = factories.Dataset(resources=[
+            {'url': 'https://example.com/data.csv', 'format': 'csv'}])
+
+        for notes in ('First change', 'Second change'):
+            dataset['notes'] = notes
+            helpers.call_action('package_update', **dataset)
+
+        # only the job queued when it was created
+        assert [job['title'] for job in helpers.call_action('job_list')] == [
+            'DownloadAll new "{}" {}'.format(dataset['name'], dataset['id'])]
+
+    def test_dataset_is_queued_again_once_its_job_has_started(self):
+        dataset = factories.Dataset(resources=[
+            {'url': 'https://example.com/data.csv', 'format': 'csv'}])
+        get_queued_datasets().release(dataset['id'])
+
+        dataset['notes'] = 'Changed description'
+        helpers.call_action('package_update', **dataset)
+
+        assert [job['title'] for job in helpers.call_action('job_list')] == [
+            'DownloadAll new "{}" {}'.format(dataset['name'], dataset['id']),
+            'DownloadAll changed "{}" {}'.format(dataset['name'],
+                                                 dataset['id'])]
+
+    @pytest.mark.ckan_config('ckanext.downloadall.debounce_seconds', '60')
+    def test_changes_are_recorded_for_debouncing(self):
+        dataset = factories.Dataset(resources=[
+            {'url': 'https://example.com/data.csv', 'format': 'csv'}])
+        queued_datasets = get_queued_datasets()
+        key = queued_datasets.changed_key(dataset['id'])
+        first = queued_datasets.connection.hget(key, 'first')
+
+        dataset['notes'] = 'Changed description'
+        helpers.call_action('package_update', **dataset)
+
+        assert queued_datasets.connection.hget(key, 'first') == first
+        assert float(queued_datasets.connection.hget(key, 'last')) >= \
+            float(first)
+        assert len(helpers.call_action('job_list')) == 1
+
+    def test_dataset_with_many_resources_is_enqueued_once(self):
+        dataset = factories.Dataset(resources=[
+            {'url': 'https://example.com/{}.csv'.format(i), 'format': 'csv'}
+            for i in range(20)])
+        helpers.call_action('job_clear')
+        for res in dataset['resources']:
+            res['format'] = 'CSV'
+
+        with mock.patch('ckanext.downloadall.plugin.enqueue_update_zip',
+                        wraps=plugin.enqueue_update_zip) as enqueue_:
+            helpers.call_action('package_update', **dataset)
+
+        enqueue_.assert_called_once_with(
+            dataset['name'], dataset['id'], 'changed', SMALL_LANE,
+            dataset['owner_org'])
+
+    def test_rolled_back_changes_are_not_enqueued(self):
+        dataset = factories.Dataset()
+        helpers.call_action('job_clear')
+
+        # e.g. saving the dataset failed
+        model.Session.query(model.Package).count()
+        plugin.queue_update_zip(model.Package.get(dataset['id']), 'changed')
+        model.Session.rollback()
+        model.Session.commit()
+
+        assert helpers.call_action('job_list') == []
+
+    @pytest.mark.ckan_config('ckanext.downloadall.large_queue',
+                             'downloadall-large')
+    @pytest.mark.ckan_config('ckanext.downloadall.large_dataset_size', '1000')
+    def test_datasets_are_queued_in_lanes_by_size(self):
+        small = factories.Dataset(resources=[
+            {'url': 'https://example.com/data.csv', 'size': 999}])
+        large = factories.Dataset(resources=[
+            {'url': 'https://example.com/data.csv', 'size': 999},
+            {'url': 'https://example.com/data.csv', 'size': 1}])
+
+        assert [job['title'] for job in helpers.call_action('job_list')] == [
+            'DownloadAll new "{}" {}'.format(small['name'], small['id'])]
+        assert [job['title'] for job in helpers.call_action(
+            'job_list', queues=['downloadall-large'])] == [
+            'DownloadAll new "{}" {}'.format(large['name'], large['id'])]
+
+    def test_edits_go_ahead_of_bulk_builds(self):
+        swept = factories.Dataset()
+        helpers.call_action('job_clear')
+        plugin.enqueue_update_zip(swept['name'], swept['id'], 'cli-requested',
+                                  priority=jobs.BULK)
+
+        edited = factories.Dataset()
+        edited_again = factories.Dataset()
+
+        # (edits are in the order they were made)
+        assert [job['title'] for job in helpers.call_action(
+            'job_list', queues=['default'])] == [
+            'DownloadAll new "{}" {}'.format(edited['name'], edited['id']),
+            'DownloadAll new "{}" {}'.format(edited_again['name'],
+                                             edited_again['id']),
+            'DownloadAll cli-requested "{}" {}'.format(
+                swept['name'], swept['id'])]
+
+    @pytest.mark.ckan_config('ckanext.downloadall.organization_rate_limit',
+                             '1')
+    def test_organization_over_the_rate_limit_is_queued_as_bulk(self):
+        busy_org = factories.Organization()
+        first = factories.Dataset(owner_org=busy_org['id'])
+        second = factories.Dataset(owner_org=busy_org['id'])
+        other = factories.Dataset(owner_org=self.org['id'])
+
+        assert [job['title'] for job in helpers.call_action(
+            'job_list', queues=['default'])] == [
+            'DownloadAll new "{}" {}'.format(dataset['name'], dataset['id'])
+            for dataset in (first, other, second)]
+
     # An end-to-end test is too tricky to write - creating a dataset and seeing
     # the zip file created requires the queue worker to run, but that rips down
     # the existing database session. And if we use the synchronous_enqueue_job
@@ -0,0 +1,84 @@
+"""Tests for sessions.py."""
+import os
+import threading
+
+import pytest
+from six.moves import BaseHTTPServer, socketserver
+
+from ckanext.downloadall import sessions
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.headers.get('If-None-Match') == '"1"':
+            self.send_response(304)
+            self.send_header('ETag', '"1"')
+            self.end_headers()
+            return
+        body = b'a,b,c\n'
+        self.send_response(200)
+        self.send_header('ETag', '"1"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def url():
+    server = Server(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{}/data.csv'.format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+class TestSession(object):
+    def test_connection_is_reused(self, url):
+        session = sessions.make_session()
+        opened, reused = sessions.stats.snapshot()
+
+        for i in range(3):
+            r = session.get(url, stream=True)
+            assert r.raw.read() == b'a,b,c\n'
+
+        assert sessions.stats.snapshot() == (opened + 1, reused + 2)
+
+    def test_not_modified_response_is_released(self, url):
+        session = sessions.make_session()
+        opened, reused = sessions.stats.snapshot()
+
+        for i in range(3):
+            r = session.get(url, stream=True, headers={'If-None-Match': '"1"'})
+            assert r.status_code == 304
+            sessions.release(r)
+
+        assert sessions.stats.snapshot() == (opened + 1, reused + 2)
+
+    def test_get_session_is_per_process(self, monkeypatch):
+        session = sessions.get_session()
+        assert sessions.get_session() is session
+
+        # e.g. in a forked job
+        monkeypatch.setattr(os, 'getpid', lambda: -1)
+        assert sessions.get_session() is not session
+
+    def test_get_session_is_replaced_when_the_pool_size_changes(self):
+        session = sessions.get_session(10)
+
+        new_session = sessions.get_session(20)
+
+        assert new_session is not session
+        assert new_session.get_adapter('https://example.com')._pool_maxsize \
+            == 20
+        assert sessions.get_session(20) is new_session
@@ -0,0 +1,321 @@
+"""Tests for streaming.py."""
+import hashlib
+import io
+import threading
+import zipfile
+
+import mock
+import pytest
+
+from ckanext.downloadall import streaming
+from ckanext.downloadall.streaming import (
+    copy_stream, copy_member, get_executor, get_local_file_size, read_head,
+    stream_from_thread, ParallelDeflateWriter, Pipe)
+
+
+class ReadOnlyStream(object):
+    # a stream without readinto()
+    def __init__(self, data):
+        self.stream = io.BytesIO(data)
+
+    def read(self, size):
+        return self.stream.read(size)
+
+
+class TestCopyStream(object):
+    def test_copy(self):
+        data = b'a,b,c\n' * 1000
+        destination = io.BytesIO()
+        hash_object = hashlib.sha224()
+
+        size = copy_stream(io.BytesIO(data), destination, buffer_size=100,
+                           hash_object=hash_object)
+
+        assert size == len(data)
+        assert destination.getvalue() == data
+        assert hash_object.hexdigest() == hashlib.sha224(data).hexdigest()
+
+    def test_copy_without_readinto(self):
+        data = b'a,b,c\n' * 1000
+        destination = io.BytesIO()
+
+        size = copy_stream(ReadOnlyStream(data), destination, buffer_size=100)
+
+        assert size == len(data)
+        assert destination.getvalue() == data
+
+    def test_empty(self):
+        destination = io.BytesIO()
+        assert copy_stream(io.BytesIO(), destination) == 0
+        assert destination.getvalue() == b''
+
+    def test_copy_local_file(self, tmpdir):
+        data = b'a,b,c\n' * 1000
+        path = tmpdir.join('data.csv')
+        path.write_binary(data)
+        destination = io.BytesIO()
+        hash_object = hashlib.sha224()
+
+        with open(str(path), 'rb') as source:
+            source.read(6)
+            size = copy_stream(source, destination, buffer_size=100,
+                               hash_object=hash_object)
+
+        assert size == len(data) - 6
+        assert destination.getvalue() == data[6:]
+        assert hash_object.hexdigest() == \
+            hashlib.sha224(data[6:]).hexdigest()
+
+    def test_copy_empty_local_file(self, tmpdir):
+        path = tmpdir.join('data.csv')
+        path.write_binary(b'')
+        destination = io.BytesIO()
+
+        with open(str(path), 'rb') as source:
+            assert copy_stream(source, destination) == 0
+
+
+class TestReadHead(object):
+    @pytest.mark.parametrize('source_class', [io.BytesIO, ReadOnlyStream])
+    def test_stream(self, source_class):
+        data = b'a,b,c\n' * 1000
+        destination = io.BytesIO()
+
+        head, source = read_head(source_class(data), 100)
+        copy_stream(source, destination, buffer_size=30)
+
+        assert head == data[:100]
+        assert destination.getvalue() == data
+
+    def test_short_stream(self):
+        head, source = read_head(io.BytesIO(b'a,b'), 100)
+
+        assert head == b'a,b'
+        destination = io.BytesIO()
+        copy_stream(source, destination)
+        assert destination.getvalue() == b'a,b'
+
+    def test_local_file(self, tmpdir):
+        data = b'a,b,c\n' * 1000
+        path = tmpdir.join('data.csv')
+        path.write_binary(data)
+
+        with open(str(path), 'rb') as f:
+            head, source = read_head(f, 100)
+            assert source is f
+            destination = io.BytesIO()
+            copy_stream(source, destination)
+
+        assert head == data[:100]
+        assert destination.getvalue() == data
+
+
+class TestGetLocalFileSize(object):
+    def test_local_file(self, tmpdir):
+        path = tmpdir.join('data.csv')
+        path.write_binary(b'a,b,c\n' * 1000)
+
+        with open(str(path), 'rb') as f:
+            assert get_local_file_size(f) == 6000
+            f.read(100)
+            assert get_local_file_size(f) == 5900
+
+    def test_stream(self):
+        assert get_local_file_size(io.BytesIO(b'a,b,c')) is None
+
+
+class UnseekableStream(object):
+    # a write-only stream, like a socket
+    def __init__(self):
+        self.stream = io.BytesIO()
+
+    def write(self, data):
+        return self.stream.write(data)
+
+    def tell(self):
+        return self.stream.tell()
+
+    def flush(self):
+        pass
+
+
+def csv_data(rows):
+    return b''.join(b'%d,gold,%d.5\n' % (i, i * 7 % 1000)
+                    for i in range(rows))
+
+
+class TestParallelDeflateWriter(object):
+    def write_zip(self, fp, data, block_size=1000):
+        with zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            zipf.writestr('first.txt', b'first')
+            with ParallelDeflateWriter(zipf, zipfile.ZipInfo('data.csv'),
+                                       get_executor(4), 4,
+                                       block_size=block_size) as zf:
+                copy_stream(io.BytesIO(data), zf, buffer_size=300)
+            zipf.writestr('last.txt', b'last')
+
+    def test_write(self):
+        data = csv_data(10000)
+        fp = io.BytesIO()
+
+        self.write_zip(fp, data)
+
+        with zipfile.ZipFile(fp) as zipf:
+            assert zipf.testzip() is None
+            assert zipf.namelist() == ['first.txt', 'data.csv', 'last.txt']
+            assert zipf.read('data.csv') == data
+            info = zipf.getinfo('data.csv')
+            assert info.compress_type == zipfile.ZIP_DEFLATED
+            assert info.file_size == len(data)
+
+    def test_compresses_nearly_as_well_as_zipfile(self):
+        data = csv_data(100000)
+        fp = io.BytesIO()
+        self.write_zip(fp, data, block_size=64 * 1024)
+        fp_sequential = io.BytesIO()
+        with zipfile.ZipFile(fp_sequential, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            zipf.writestr('data.csv', data)
+
+        with zipfile.ZipFile(fp) as zipf, \
+                zipfile.ZipFile(fp_sequential) as zipf_sequential:
+            assert zipf.getinfo('data.csv').compress_size < \
+                zipf_sequential.getinfo('data.csv').compress_size * 1.02
+
+    def test_unseekable(self):
+        data = csv_data(10000)
+        fp = UnseekableStream()
+
+        self.write_zip(fp, data)
+
+        with zipfile.ZipFile(io.BytesIO(fp.stream.getvalue())) as zipf:
+            assert zipf.testzip() is None
+            assert zipf.read('data.csv') == data
+
+    @pytest.mark.parametrize('data', [b'', b'a'])
+    def test_tiny(self, data):
+        fp = io.BytesIO()
+
+        self.write_zip(fp, data)
+
+        with zipfile.ZipFile(fp) as zipf:
+            assert zipf.testzip() is None
+            assert zipf.read('data.csv') == data
+
+
+class TestCopyMember(object):
+    def test_copy(self):
+        source = io.BytesIO()
+        with zipfile.ZipFile(source, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            zipf.writestr('data', b'a,b,c\n' * 1000)
+        destination = io.BytesIO()
+
+        with zipfile.ZipFile(source) as source_zipf:
+            with zipfile.ZipFile(destination, 'w') as zipf:
+                zipf.writestr('first.txt', b'first')
+                copy_member(source, source_zipf.getinfo('data'), zipf,
+                            filename='data.csv',
+                            date_time=(2020, 1, 2, 3, 4, 6))
+                zipf.writestr('last.txt', b'last')
+
+        with zipfile.ZipFile(destination) as zipf:
+            assert zipf.testzip() is None
+            assert zipf.namelist() == ['first.txt', 'data.csv', 'last.txt']
+            assert zipf.read('data.csv') == b'a,b,c\n' * 1000
+            info = zipf.getinfo('data.csv')
+            assert info.compress_type == zipfile.ZIP_DEFLATED
+            assert info.compress_size < info.file_size
+            assert info.date_time == (2020, 1, 2, 3, 4, 6)
+
+
+class TestGetExecutor(object):
+    def test_reused(self):
+        assert get_executor(3) is get_executor(3)
+
+    def test_old_pool_is_shut_down_when_workers_change(self):
+        old = get_executor(3)
+
+        new = get_executor(5)
+
+        assert new is not old
+        with pytest.raises(RuntimeError):
+            old.submit(len, 'data')
+        assert new.submit(len, 'data').result() == 4
+
+    def test_pool_inherited_through_a_fork_is_left(self):
+        old = get_executor(3)
+
+        with mock.patch.object(streaming.os, 'getpid', return_value=-1):
+            new = get_executor(3)
+
+        assert new is not old
+        assert old.submit(len, 'data').result() == 4
+
+
+class TestStreamFromThread(object):
+    def test_zip(self):
+        data = csv_data(10000)
+
+        def write(fp):
+            with zipfile.ZipFile(fp, 'w', zipfile.ZIP_DEFLATED) as zipf:
+                with zipf.open('data.csv', 'w') as member:
+                    copy_stream(io.BytesIO(data), member, buffer_size=300)
+                zipf.writestr('datapackage.json', b'{}')
+
+        chunks = list(stream_from_thread(write, chunk_size=1000))
+
+        assert set(len(chunk) for chunk in chunks[:-1]) == {1000}
+        with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as zipf:
+            assert zipf.testzip() is None
+            assert zipf.namelist() == ['data.csv', 'datapackage.json']
+            assert zipf.read('data.csv') == data
+
+    def test_error_is_raised_by_the_reader(self):
+        def write(fp):
+            fp.write(b'PK')
+            raise ValueError('Download failed')
+
+        with pytest.raises(ValueError):
+            list(stream_from_thread(write, chunk_size=1))
+
+    def test_writer_stops_when_the_reader_does(self):
+        stopped = threading.Event()
+        errors = []
+
+        def write(fp):
+            try:
+                while True:
+                    fp.write(b'x' * 100)
+            except IOError as e:
+                errors.append(e)
+                stopped.set()
+                raise
+
+        chunks = stream_from_thread(write, chunk_size=100, max_chunks=2)
+        next(chunks)
+        chunks.close()
+
+        assert stopped.wait(5)
+        assert len(errors) == 1
+
+
+class TestPipe(object):
+    def test_chunks_held_are_bounded(self):
+        pipe = Pipe(chunk_size=10, max_chunks=2)
+        pipe.write(b'x' * 25)
+        assert pipe.chunks.full()
+        assert pipe.tell() == 25
+
+        pipe.cancel()
+        with pytest.raises(IOError):
+            pipe.write(b'x' * 10)
+
+    def test_max_size(self):
+        def write(fp):
+            for _ in range(10):
+                fp.write(b'x' * 10)
+
+        chunks = stream_from_thread(write, chunk_size=10, max_size=50)
+
+        with pytest.raises(IOError) as e:
+            list(chunks)
+        assert 'limit of 50 bytes' in str(e.value)
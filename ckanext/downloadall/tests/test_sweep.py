@@ -0,0 +1,154 @@
+"""Tests for sweep.py."""
+import datetime
+import os
+import signal
+
+import mock
+import pytest
+
+from ckanext.downloadall import sweep
+
+
+def build(item):
+    if item == 'bad':
+        raise ValueError('Bad dataset')
+    if item == 'killed':
+        # e.g. by the OOM killer
+        os.kill(os.getpid(), signal.SIGKILL)
+    return os.getpid()
+
+
+class TestRunInPool(object):
+    def test_in_this_process(self):
+        results = list(sweep.run_in_pool(build, ['gold', 'bad', 'silver']))
+
+        assert [item for item, error in results] == ['gold', 'bad', 'silver']
+        assert [error for item, error in results if item != 'bad'] == \
+            [None, None]
+        assert 'ValueError: Bad dataset' in dict(results)['bad']
+
+    def test_in_processes(self):
+        items = ['dataset{}'.format(i) for i in range(20)] + ['bad']
+        initialized = []
+
+        results = dict(sweep.run_in_pool(
+            build, items, workers=3, max_in_flight=4,
+            initializer=initialized.append, initargs=('app',)))
+
+        assert set(results) == set(items)
+        assert 'ValueError: Bad dataset' in results.pop('bad')
+        assert set(results.values()) == {None}
+        # (the initializer was called in the worker processes, not this one)
+        assert initialized == []
+
+    def test_in_flight_is_bounded(self):
+        submitted = []
+
+        def items():
+            for i in range(10):
+                submitted.append(i)
+                yield i
+
+        results = sweep.run_in_pool(build, items(), workers=2,
+                                    max_in_flight=3)
+        next(results)
+
+        assert len(submitted) <= 4
+        assert len(list(results)) == 9
+
+    def test_worker_killed(self):
+        items = ['dataset{}'.format(i) for i in range(20)]
+        items.insert(5, 'killed')
+
+        results = dict(sweep.run_in_pool(build, items, workers=2,
+                                         max_in_flight=2))
+
+        # it carried on in a new pool
+        assert set(results) == set(items)
+        assert 'A worker process died' in results['killed']
+        assert list(results.values()).count(None) >= len(items) - 2
+
+
+class TestProgress(object):
+    def test_eta(self):
+        with mock.patch.object(sweep.time, 'time', return_value=1000):
+            progress = sweep.Progress(10)
+        assert str(progress) == '0/10 (0%), ETA unknown'
+
+        progress.update('gold')
+        progress.update('bad', 'Traceback...')
+        with mock.patch.object(sweep.time, 'time', return_value=1060):
+            assert progress.eta_seconds() == 240
+            assert str(progress) == '2/10 (20%), 1 failed, ETA 0:04:00'
+        assert progress.failures == [('bad', 'Traceback...')]
+
+
+class TestCheckpoint(object):
+    def test_resume(self, tmpdir):
+        path = str(tmpdir.join('checkpoint'))
+        checkpoint = sweep.Checkpoint(path)
+        assert checkpoint.load() == set()
+
+        checkpoint.add('gold')
+        checkpoint.add('silver')
+
+        assert sweep.Checkpoint(path).load() == {'gold', 'silver'}
+
+
+class TestHighWaterMark(object):
+    def test_moves_on_as_the_earliest_are_done(self):
+        saved = []
+        mark = sweep.HighWaterMark({'a': 1, 'b': 2, 'c': 3}, end=10,
+                                   save=saved.append, save_interval=0)
+        assert mark.value == 1
+
+        mark.done('b')
+        assert mark.value == 1
+        mark.done('a')
+        assert mark.value == 3
+        mark.done('c')
+        mark.finish()
+
+        assert saved == [1, 3, 10]
+
+    def test_failed_items_hold_it_back(self):
+        saved = []
+        mark = sweep.HighWaterMark({'a': 1, 'bad': 2, 'c': 3}, end=10,
+                                   save=saved.append)
+        mark.done('a')
+        mark.done('c')
+        mark.finish()
+
+        assert saved == [2]
+
+    def test_saves_are_spaced_out(self):
+        saved = []
+        with mock.patch.object(sweep.time, 'time', return_value=1000) as time:
+            mark = sweep.HighWaterMark({'a': 1, 'b': 2, 'c': 3}, end=10,
+                                       save=saved.append, save_interval=10)
+            mark.done('a')
+            time.return_value = 1010
+            mark.done('b')
+            mark.done('c')
+        assert saved == [3]
+
+        mark.finish()
+        assert saved == [3, 10]
+
+
+@pytest.mark.parametrize('value,expected', [
+    ('2024-03-01', datetime.datetime(2024, 3, 1)),
+    ('2024-03-01T10:20', datetime.datetime(2024, 3, 1, 10, 20)),
+    ('2024-03-01T10:20:30', datetime.datetime(2024, 3, 1, 10, 20, 30)),
+    ('2024-03-01T10:20:30.123456',
+     datetime.datetime(2024, 3, 1, 10, 20, 30, 123456)),
+    ('2024-03-01T10:20:30.123Z',
+     datetime.datetime(2024, 3, 1, 10, 20, 30, 123000)),
+])
+def test_parse_isoformat(value, expected):
+    assert sweep.parse_isoformat(value) == expected
+
+
+def test_parse_isoformat_invalid():
+    with pytest.raises(ValueError):
+        sweep.parse_isoformat('yesterday')
@@ -1,22 +1,36 @@
 import builtins
+import io
+import os
 import zipfile
 import json
 import tempfile
 import re
 import copy
 
+import fakeredis
 import mock
 import pytest
+from rq import Queue
+from rq.registry import ScheduledJobRegistry
+from rq.scheduler import RQScheduler
 from pyfakefs import fake_filesystem
 import responses
 import requests
 
+from ckan import model
 from ckan.common import config
+from ckan.plugins import toolkit
 from ckan.tests import factories, helpers
 import ckan.lib.uploader
 from ckanext.downloadall.tasks import (
     update_zip, canonized_datapackage, save_local_path_in_datapackage_resource,
-    hash_datapackage, generate_datapackage_json, populate_schema_from_datastore)
+    hash_datapackage, fingerprint_datapackage, generate_datapackage_json,
+    populate_schema_from_datastore, get_lane, SMALL_LANE, LARGE_LANE,
+    InsufficientSpaceError, defer_until_quiet, get_job_options,
+    get_member_file, MEMBER_FILENAME, stream_resource_into_zip,
+    open_member_for_writing)
+from ckanext.downloadall import jobs
+from ckanext.downloadall.cache import MemberCache
 from ckanext.downloadall.tests import TestBase
 
 
@@ -289,6 +303,260 @@ class TestUpdateZip(TestBase):
                 assert datapackage['resources'][0]['sources'] == [{'path': dataset['resources'][0]['url'],
                                                                    'title': 'Rainfall'}]
 
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    @responses.activate
+    def test_uploaded_resource_is_read_from_the_filestore(self, _):
+        responses.add_passthru(config['solr_url'])
+        # the download URL would give different data, so we can tell it is
+        # not used
+        responses.add(
+            responses.GET,
+            re.compile(r'http://test.ckan.net/dataset/.*/download/.*'),
+            body='Downloaded,csv'
+        )
+        dataset = factories.Dataset()
+        with tempfile.NamedTemporaryFile() as fp:
+            fp.write(b'Uploaded,csv')
+            fp.seek(0)
+            user = helpers.call_action('get_site_user', {'ignore_auth': True})
+            helpers.call_action(
+                'resource_create', context={'user': user['name']},
+                package_id=dataset['id'],
+                url='http://test.ckan.net/dataset/1/download/1',
+                upload=fp, name='Rainfall', format='CSV')
+
+        update_zip(dataset['id'])
+
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        zip_resource = [res for res in dataset['resources']
+                        if res['name'] == 'All resource data'][0]
+        uploader = ckan.lib.uploader.get_resource_uploader(zip_resource)
+        filepath = uploader.get_path(zip_resource['id'])
+        with fake_open(filepath, 'rb') as f:
+            with zipfile.ZipFile(f) as zip_:
+                assert zip_.read('rainfall.csv') == b'Uploaded,csv'
+        assert len(responses.calls) == 0
+
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    @responses.activate
+    def test_dataset_is_shown_once_per_build(self, _):
+        responses.add(responses.GET, 'https://example.com/data.csv',
+                      body='a,b,c')
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(resources=[
+            {'name': 'rainfall', 'url': 'https://example.com/data.csv',
+             'format': 'CSV'}])
+
+        with mock.patch('ckanext.downloadall.tasks.get_action',
+                        wraps=toolkit.get_action) as get_action:
+            update_zip(dataset['id'])
+            assert [call[0][0] for call in get_action.call_args_list] == [
+                'package_show', 'get_site_user', 'resource_create']
+
+            get_action.reset_mock()
+            helpers.call_action('package_patch', id=dataset['id'],
+                                notes='New description')
+            update_zip(dataset['id'])
+            assert [call[0][0] for call in get_action.call_args_list] == [
+                'package_show', 'get_site_user', 'resource_update']
+
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        zip_resources = [res for res in dataset['resources']
+                         if res['name'] == 'All resource data']
+        assert len(zip_resources) == 1
+
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    @responses.activate
+    def test_unchanged_dataset_is_skipped_by_its_watermark(self, _):
+        responses.add(responses.GET, 'https://example.com/data.csv',
+                      body='a,b,c')
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(resources=[
+            {'name': 'rainfall', 'url': 'https://example.com/data.csv',
+             'format': 'CSV'}])
+        helpers.call_action(
+            'datastore_create', resource_id=dataset['resources'][0]['id'],
+            force=True, fields=[{'id': 'a', 'type': 'text'}])
+        update_zip(dataset['id'])
+
+        with mock.patch('ckanext.downloadall.tasks.get_action',
+                        wraps=toolkit.get_action) as get_action:
+            update_zip(dataset['id'])
+            # it didn't need package_show or even to download the resources
+            assert get_action.call_args_list == []
+            assert len(responses.calls) == 1
+
+            # the data dictionary changing doesn't change the dataset, but
+            # moves the watermark on
+            helpers.call_action(
+                'datastore_create',
+                resource_id=dataset['resources'][0]['id'], force=True,
+                fields=[{'id': 'a', 'type': 'text'},
+                        {'id': 'b', 'type': 'text'}])
+            update_zip(dataset['id'])
+            assert [call[0][0] for call in get_action.call_args_list] == [
+                'package_show', 'get_site_user', 'resource_update']
+
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    @responses.activate
+    def test_edit_after_the_zip_resource_is_updated_is_not_skipped(self, _):
+        responses.add(responses.GET, 'https://example.com/data.csv',
+                      body='a,b,c')
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(resources=[
+            {'name': 'rainfall', 'url': 'https://example.com/data.csv',
+             'format': 'CSV'}])
+        update_zip(dataset['id'])
+        helpers.call_action('package_patch', id=dataset['id'],
+                            notes='New description')
+
+        def resource_update_then_edit(context, data_dict):
+            zip_resource = toolkit.get_action('resource_update')(
+                context, data_dict)
+            # a user's edit, committed before the watermark is stored
+            helpers.call_action('package_patch', id=dataset['id'],
+                                notes='Newer description')
+            return zip_resource
+
+        def get_action(name):
+            if name == 'resource_update':
+                return resource_update_then_edit
+            return toolkit.get_action(name)
+
+        with mock.patch('ckanext.downloadall.tasks.get_action',
+                        side_effect=get_action):
+            update_zip(dataset['id'])
+
+        with mock.patch('ckanext.downloadall.tasks.get_action',
+                        wraps=toolkit.get_action) as get_action:
+            update_zip(dataset['id'])
+            # the edit isn't in the zip, so it is built again
+            assert [call[0][0] for call in get_action.call_args_list] == [
+                'package_show', 'get_site_user', 'resource_update']
+
+            get_action.reset_mock()
+            update_zip(dataset['id'])
+            assert get_action.call_args_list == []
+
+    @pytest.mark.ckan_config('ckanext.downloadall.build_in_storage', 'true')
+    @pytest.mark.usefixtures('with_request_context')
+    @responses.activate
+    def test_zip_is_built_in_the_filestore(self, _, ckan_config, monkeypatch,
+                                           tmpdir):
+        monkeypatch.setitem(ckan_config, 'ckan.storage_path', str(tmpdir))
+        responses.add(responses.GET, 'https://example.com/data.csv',
+                      body='a,b,c')
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(resources=[
+            {'url': 'https://example.com/data.csv', 'format': 'csv'}])
+
+        with mock.patch('ckanext.downloadall.tasks.FileStorage') as \
+                file_storage:
+            update_zip(dataset['id'])
+            helpers.call_action('package_patch', id=dataset['id'],
+                                notes='Changed description')
+            update_zip(dataset['id'])
+        # it wasn't uploaded (copied) into the filestore
+        assert not file_storage.called
+
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        zip_resource = [res for res in dataset['resources']
+                        if res['name'] == 'All resource data'][0]
+        assert zip_resource['url_type'] == 'upload'
+        assert zip_resource['url'].endswith('.zip')
+        filepath = ckan.lib.uploader.get_resource_uploader(zip_resource) \
+            .get_path(zip_resource['id'])
+        assert filepath.startswith(str(tmpdir))
+        assert int(zip_resource['size']) == os.path.getsize(filepath)
+        with real_open(filepath, 'rb') as f:
+            with zipfile.ZipFile(f) as zip_:
+                assert json.loads(zip_.read('datapackage.json'))[
+                    'description'] == 'Changed description'
+        # no temporary file is left behind
+        assert os.listdir(os.path.dirname(filepath)) == \
+            [os.path.basename(filepath)]
+
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    def test_zip_is_not_built_without_enough_free_space(self, _):
+        dataset = factories.Dataset(resources=[
+            {'url': 'https://example.com/data.csv', 'format': 'csv',
+             'size': 1000}])
+
+        with mock.patch('ckanext.downloadall.tasks.os.statvfs',
+                        return_value=mock.Mock(f_bavail=999, f_frsize=1)):
+            with pytest.raises(InsufficientSpaceError):
+                update_zip(dataset['id'])
+
+    @pytest.mark.ckan_config('ckanext.downloadall.s3.bucket', 'zips')
+    @pytest.mark.ckan_config('ckanext.downloadall.s3.region_name',
+                             'us-east-1')
+    @pytest.mark.usefixtures('with_request_context')
+    @responses.activate
+    def test_zip_is_streamed_to_object_storage(self, _, monkeypatch):
+        moto = pytest.importorskip('moto')
+        mock_s3 = getattr(moto, 'mock_aws', None) or moto.mock_s3
+        monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+        monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+        responses.add(responses.GET, 'https://example.com/data.csv',
+                      body='a,b,c')
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(resources=[
+            {'url': 'https://example.com/data.csv', 'format': 'csv'}])
+
+        with mock_s3():
+            import boto3
+            s3 = boto3.client('s3', region_name='us-east-1')
+            s3.create_bucket(Bucket='zips')
+            with mock.patch('ckanext.downloadall.tasks.FileStorage') as \
+                    file_storage, \
+                    mock.patch('ckanext.downloadall.tasks.tempfile'
+                               '.NamedTemporaryFile') as temporary_file:
+                update_zip(dataset['id'])
+            # it wasn't written to a local file, nor uploaded by CKAN
+            assert not temporary_file.called
+            assert not file_storage.called
+
+            dataset = helpers.call_action('package_show', id=dataset['id'])
+            zip_resource = [res for res in dataset['resources']
+                            if res['name'] == 'All resource data'][0]
+            assert zip_resource['url_type'] == 'upload'
+            assert zip_resource['url'].endswith(
+                '/{}.zip'.format(dataset['name']))
+            key = 'resources/{}/{}.zip'.format(zip_resource['id'],
+                                               dataset['name'])
+            body = s3.get_object(Bucket='zips', Key=key)['Body'].read()
+            assert int(zip_resource['size']) == len(body)
+            with zipfile.ZipFile(io.BytesIO(body)) as zip_:
+                assert zip_.read('{}.csv'.format(
+                    dataset['resources'][0]['id'])) == b'a,b,c'
+            assert not s3.list_multipart_uploads(Bucket='zips').get('Uploads')
+
+    def test_datastore_fields_are_fetched_without_datastore_search(self, _):
+        dataset = factories.Dataset(resources=[
+            {'name': 'gold', 'url': 'https://example.com/gold.csv',
+             'format': 'CSV'},
+            {'name': 'silver', 'url': 'https://example.com/silver.csv',
+             'format': 'CSV'},
+        ])
+        for res in dataset['resources']:
+            helpers.call_action(
+                'datastore_create', resource_id=res['id'], force=True,
+                fields=[{'id': 'Date', 'type': 'timestamp'},
+                        {'id': 'Price', 'type': 'numeric',
+                         'info': {'label': 'The price'}}])
+
+        with mock.patch('ckanext.downloadall.tasks.get_action',
+                        wraps=toolkit.get_action) as get_action:
+            datapackage = generate_datapackage_json(dataset['id'])[0]
+
+        assert 'datastore_search' not in [
+            call[0][0] for call in get_action.call_args_list]
+        for datapackage_res in datapackage['resources']:
+            assert datapackage_res['schema'] == {'fields': [
+                {'name': 'Date', 'type': 'datetime'},
+                {'name': 'Price', 'type': 'number', 'title': 'The price'},
+            ]}
+
     @mock.patch('ckanext.downloadall.tasks.populate_schema_from_datastore',
                 side_effect=mock_populate_schema_from_datastore)
     @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
@@ -606,6 +874,405 @@ class TestUpdateZip(TestBase):
                 datapackage = json.loads(datapackage_json)
                 assert datapackage['resources'][0]['name'] == 'rainfall'
 
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    @responses.activate
+    def test_compressed_resource_is_stored(self, _):
+        csv_content = b'Date,Price\n' + b'1/6/2017,4.00\n' * 1000
+        responses.add(responses.GET, 'https://example.com/data.csv',
+                      body=csv_content)
+        responses.add(responses.GET, 'https://example.com/data.zip',
+                      body=b'PK\x03\x04' + b'\x00' * 1000)
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(resources=[
+            {'name': 'rainfall', 'format': 'CSV',
+             'url': 'https://example.com/data.csv'},
+            {'name': 'boundaries', 'format': 'SHP',
+             'url': 'https://example.com/data.zip'},
+        ])
+
+        update_zip(dataset['id'])
+
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        zip_resource = [res for res in dataset['resources']
+                        if res['name'] == 'All resource data'][0]
+        uploader = ckan.lib.uploader.get_resource_uploader(zip_resource)
+        filepath = uploader.get_path(zip_resource['id'])
+        with fake_open(filepath, 'rb') as f:
+            with zipfile.ZipFile(f) as zip_:
+                assert zip_.getinfo('rainfall.csv').compress_type == \
+                    zipfile.ZIP_DEFLATED
+                assert zip_.getinfo('boundaries.shp').compress_type == \
+                    zipfile.ZIP_STORED
+                assert zip_.read('rainfall.csv') == csv_content
+
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    @responses.activate
+    def test_compression_level(self, _):
+        csv_content = b'Date,Price\n' + b'1/6/2017,4.00\n' * 1000
+        responses.add(responses.GET, 'https://example.com/data.csv',
+                      body=csv_content)
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(resources=[
+            {'name': 'rainfall', 'format': 'CSV',
+             'url': 'https://example.com/data.csv'},
+        ])
+
+        update_zip(dataset['id'], compression_level=0)
+
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        zip_resource = [res for res in dataset['resources']
+                        if res['name'] == 'All resource data'][0]
+        uploader = ckan.lib.uploader.get_resource_uploader(zip_resource)
+        filepath = uploader.get_path(zip_resource['id'])
+        with fake_open(filepath, 'rb') as f:
+            with zipfile.ZipFile(f) as zip_:
+                info = zip_.getinfo('rainfall.csv')
+                # level 0 doesn't compress at all
+                assert info.compress_size > info.file_size
+                assert zip_.read('rainfall.csv') == csv_content
+
+    @pytest.mark.ckan_config('ckanext.downloadall.download_workers', 4)
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    @responses.activate
+    def test_concurrent_downloads(self, _):
+        responses.add_passthru(config['solr_url'])
+        for name in ('first', 'second', 'third'):
+            responses.add(
+                responses.GET,
+                'https://example.com/{}.csv'.format(name),
+                body='{},data'.format(name)
+            )
+        responses.add(
+            responses.GET,
+            'https://example.com/broken.csv',
+            body=requests.ConnectionError('Some network trouble...')
+        )
+        dataset = factories.Dataset(
+            name='test-dataset-concurrent',
+            title='Test Dataset Concurrent',
+            notes='Just another test dataset.',
+            resources=[
+                {'name': name, 'url': 'https://example.com/{}.csv'.format(name),
+                 'format': 'csv'}
+                for name in ('first', 'broken', 'second', 'third')]
+        )
+
+        update_zip(dataset['id'])
+
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        zip_resources = [res for res in dataset['resources']
+                         if res['name'] == 'All resource data']
+        zip_resource = zip_resources[0]
+        uploader = ckan.lib.uploader.get_resource_uploader(zip_resource)
+        filepath = uploader.get_path(zip_resource['id'])
+        with fake_open(filepath, 'rb') as f:
+            with zipfile.ZipFile(f) as zip_:
+                # in the order of the resources, not the order the downloads
+                # finished, and without the one that failed
+                assert zip_.namelist() == [
+                    'first.csv', 'second.csv', 'third.csv', 'datapackage.json']
+                assert zip_.read('second.csv') == 'second,data'.encode()
+                datapackage = json.loads(zip_.read('datapackage.json'))
+                assert [res['path'] for res in datapackage['resources']] == [
+                    'first.csv', 'https://example.com/broken.csv',
+                    'second.csv', 'third.csv']
+
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    @responses.activate
+    def test_unchanged_resource_comes_from_the_cache(self, _, ckan_config,
+                                                     monkeypatch, tmpdir):
+        monkeypatch.setitem(ckan_config, 'ckanext.downloadall.cache_dir',
+                            str(tmpdir))
+        responses.add(responses.GET, 'https://example.com/data.csv',
+                      body='a,b,c', headers={'ETag': '"v1"'})
+        responses.add(responses.GET, 'https://example.com/data.csv',
+                      status=304)
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(
+            name='test-dataset-cache',
+            title='Test Dataset Cache',
+            notes='Just another test dataset.',
+            resources=[{
+                'url': 'https://example.com/data.csv',
+                'format': 'csv'
+            }]
+        )
+
+        update_zip(dataset['id'])
+        # with no existing zip to copy the data from, the rebuild has to get
+        # it from the cache
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        zip_resource = [res for res in dataset['resources']
+                        if res['name'] == 'All resource data'][0]
+        helpers.call_action('resource_delete', id=zip_resource['id'])
+        helpers.call_action('package_patch', id=dataset['id'],
+                            notes='New notes.')
+        update_zip(dataset['id'])
+
+        # the data was only downloaded for the first zip - the cached copy
+        # was checked with its ETag, and the server said it is not modified
+        calls = [call for call in responses.calls
+                 if call.request.url == 'https://example.com/data.csv']
+        assert len(calls) == 2
+        assert 'If-None-Match' not in calls[0].request.headers
+        assert calls[1].request.headers['If-None-Match'] == '"v1"'
+        assert calls[1].response.status_code == 304
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        zip_resource = [res for res in dataset['resources']
+                        if res['name'] == 'All resource data'][0]
+        uploader = ckan.lib.uploader.get_resource_uploader(zip_resource)
+        filepath = uploader.get_path(zip_resource['id'])
+        csv_filename_in_zip = '{}.csv'.format(dataset['resources'][0]['id'])
+        with fake_open(filepath, 'rb') as f:
+            with zipfile.ZipFile(f) as zip_:
+                assert zip_.namelist() == [csv_filename_in_zip, 'datapackage.json']
+                assert zip_.read(csv_filename_in_zip) == 'a,b,c'.encode()
+                datapackage = json.loads(zip_.read('datapackage.json'))
+                assert datapackage['description'] == 'New notes.'
+
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    @responses.activate
+    def test_metadata_change_copies_data_from_existing_zip(self, _):
+        responses.add(
+            responses.GET,
+            'https://example.com/data.csv',
+            body='a,b,c'
+        )
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(
+            name='test-dataset-metadata-only',
+            title='Test Dataset Metadata Only',
+            notes='Just another test dataset.',
+            resources=[{
+                'url': 'https://example.com/data.csv',
+                'format': 'csv'
+            }]
+        )
+
+        update_zip(dataset['id'])
+        helpers.call_action('package_patch', id=dataset['id'],
+                            title='New title')
+        update_zip(dataset['id'])
+
+        # the data was only downloaded for the first zip
+        assert len([call for call in responses.calls
+                    if call.request.url == 'https://example.com/data.csv']) == 1
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        zip_resources = [res for res in dataset['resources']
+                         if res['name'] == 'All resource data']
+        zip_resource = zip_resources[0]
+        uploader = ckan.lib.uploader.get_resource_uploader(zip_resource)
+        filepath = uploader.get_path(zip_resource['id'])
+        csv_filename_in_zip = '{}.csv'.format(dataset['resources'][0]['id'])
+        with fake_open(filepath, 'rb') as f:
+            with zipfile.ZipFile(f) as zip_:
+                assert zip_.namelist() == [csv_filename_in_zip, 'datapackage.json']
+                assert zip_.read(csv_filename_in_zip) == 'a,b,c'.encode()
+                datapackage = json.loads(zip_.read('datapackage.json'))
+                assert datapackage['title'] == 'New title'
+                assert datapackage['resources'][0]['path'] == csv_filename_in_zip
+
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    @responses.activate
+    def test_existing_zip_is_read_once_for_all_its_members(self, _):
+        for name in ('gold', 'silver', 'bronze'):
+            responses.add(responses.GET,
+                          'https://example.com/{}.csv'.format(name),
+                          body=name)
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(resources=[
+            {'url': 'https://example.com/{}.csv'.format(name),
+             'format': 'csv'} for name in ('gold', 'silver', 'bronze')])
+        update_zip(dataset['id'])
+        helpers.call_action('package_patch', id=dataset['id'],
+                            title='New title')
+
+        with mock.patch.object(zipfile, 'ZipFile',
+                               wraps=zipfile.ZipFile) as zip_file:
+            update_zip(dataset['id'])
+
+        # the existing zip's central directory is read once, not per member
+        reads = [call for call in zip_file.call_args_list
+                 if len(call[0]) < 2 and 'mode' not in call[1]]
+        assert len(reads) == 1
+        assert len(responses.calls) == 3
+
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    @responses.activate
+    def test_data_change_is_downloaded(self, _):
+        responses.add(
+            responses.GET,
+            'https://example.com/data.csv',
+            body='a,b,c'
+        )
+        responses.add(
+            responses.GET,
+            'https://example.com/new-data.csv',
+            body='d,e,f'
+        )
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(
+            name='test-dataset-data-change',
+            title='Test Dataset Data Change',
+            notes='Just another test dataset.',
+            resources=[{
+                'url': 'https://example.com/data.csv',
+                'format': 'csv'
+            }]
+        )
+
+        update_zip(dataset['id'])
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        helpers.call_action('resource_patch', id=dataset['resources'][0]['id'],
+                            url='https://example.com/new-data.csv')
+        update_zip(dataset['id'])
+
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        zip_resources = [res for res in dataset['resources']
+                         if res['name'] == 'All resource data']
+        zip_resource = zip_resources[0]
+        uploader = ckan.lib.uploader.get_resource_uploader(zip_resource)
+        filepath = uploader.get_path(zip_resource['id'])
+        csv_filename_in_zip = '{}.csv'.format(dataset['resources'][0]['id'])
+        with fake_open(filepath, 'rb') as f:
+            with zipfile.ZipFile(f) as zip_:
+                assert zip_.read(csv_filename_in_zip) == 'd,e,f'.encode()
+
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    @responses.activate
+    def test_only_the_changed_resource_is_downloaded(self, _):
+        for name in ('gold', 'silver', 'new-silver'):
+            responses.add(responses.GET,
+                          'https://example.com/{}.csv'.format(name),
+                          body=name)
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(resources=[
+            {'url': 'https://example.com/gold.csv', 'format': 'csv'},
+            {'url': 'https://example.com/silver.csv', 'format': 'csv'},
+        ])
+
+        update_zip(dataset['id'])
+        helpers.call_action('resource_patch', id=dataset['resources'][1]['id'],
+                            url='https://example.com/new-silver.csv')
+        update_zip(dataset['id'])
+
+        assert [call.request.url for call in responses.calls
+                if 'example.com' in call.request.url] == [
+            'https://example.com/gold.csv', 'https://example.com/silver.csv',
+            'https://example.com/new-silver.csv']
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        zip_resource = [res for res in dataset['resources']
+                        if res['name'] == 'All resource data'][0]
+        uploader = ckan.lib.uploader.get_resource_uploader(zip_resource)
+        filepath = uploader.get_path(zip_resource['id'])
+        with fake_open(filepath, 'rb') as f:
+            with zipfile.ZipFile(f) as zip_:
+                assert [zip_.read('{}.csv'.format(res['id']))
+                        for res in dataset['resources'][:2]] == \
+                    [b'gold', b'new-silver']
+
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    @responses.activate
+    def test_not_modified_remote_resource_is_copied_from_existing_zip(self, _):
+        requests_headers = []
+
+        def etag_callback(request):
+            requests_headers.append(dict(request.headers))
+            if request.headers.get('If-None-Match') == '"v1"':
+                return (304, {'ETag': '"v1"'}, '')
+            return (200, {'ETag': '"v1"'}, 'a,b,c')
+        responses.add_callback(
+            responses.GET, 'https://example.com/data.csv',
+            callback=etag_callback)
+        responses.add(
+            responses.GET,
+            'https://example.com/other.csv',
+            body='d,e,f'
+        )
+        responses.add(
+            responses.GET,
+            'https://example.com/new-other.csv',
+            body='g,h,i'
+        )
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(
+            name='test-dataset-etag',
+            title='Test Dataset ETag',
+            notes='Just another test dataset.',
+            resources=[
+                {'name': 'data', 'url': 'https://example.com/data.csv',
+                 'format': 'csv'},
+                {'name': 'other', 'url': 'https://example.com/other.csv',
+                 'format': 'csv'},
+            ]
+        )
+
+        update_zip(dataset['id'])
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        helpers.call_action('resource_patch', id=dataset['resources'][1]['id'],
+                            url='https://example.com/new-other.csv')
+        update_zip(dataset['id'])
+
+        assert len(requests_headers) == 2
+        assert 'If-None-Match' not in requests_headers[0]
+        assert requests_headers[1]['If-None-Match'] == '"v1"'
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        zip_resources = [res for res in dataset['resources']
+                         if res['name'] == 'All resource data']
+        zip_resource = zip_resources[0]
+        assert json.loads(zip_resource['downloadall_remote_validators'])[
+            dataset['resources'][0]['id']]['etag'] == '"v1"'
+        uploader = ckan.lib.uploader.get_resource_uploader(zip_resource)
+        filepath = uploader.get_path(zip_resource['id'])
+        with fake_open(filepath, 'rb') as f:
+            with zipfile.ZipFile(f) as zip_:
+                assert zip_.namelist() == ['data.csv', 'other.csv', 'datapackage.json']
+                assert zip_.read('data.csv') == 'a,b,c'.encode()
+                assert zip_.read('other.csv') == 'g,h,i'.encode()
+
+    @pytest.mark.ckan_config('ckanext.downloadall.check_remote_resources',
+                             True)
+    @pytest.mark.ckan_config('ckan.storage_path', '/doesnt_exist')
+    @responses.activate
+    def test_check_remote_resources(self, _):
+        version = ['"v1"']
+
+        def etag_callback(request):
+            if request.headers.get('If-None-Match') == version[0]:
+                return (304, {'ETag': version[0]}, '')
+            return (200, {'ETag': version[0]}, version[0])
+        responses.add_callback(
+            responses.GET, 'https://example.com/data.csv',
+            callback=etag_callback)
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(
+            name='test-dataset-check-remote',
+            title='Test Dataset Check Remote',
+            notes='Just another test dataset.',
+            resources=[
+                {'name': 'data', 'url': 'https://example.com/data.csv',
+                 'format': 'csv'},
+            ]
+        )
+
+        update_zip(dataset['id'])
+        with mock.patch('ckanext.downloadall.tasks.write_zip') as write_zip_:
+            update_zip(dataset['id'])
+            # the remote data is not modified, so it is skipped
+            assert not write_zip_.called
+        version[0] = '"v2"'
+        update_zip(dataset['id'])
+
+        dataset = helpers.call_action('package_show', id=dataset['id'])
+        zip_resources = [res for res in dataset['resources']
+                         if res['name'] == 'All resource data']
+        zip_resource = zip_resources[0]
+        uploader = ckan.lib.uploader.get_resource_uploader(zip_resource)
+        filepath = uploader.get_path(zip_resource['id'])
+        with fake_open(filepath, 'rb') as f:
+            with zipfile.ZipFile(f) as zip_:
+                assert zip_.read('data.csv') == '"v2"'.encode()
+
 
 local_datapackage = {
     'license': {
@@ -749,6 +1416,188 @@ class TestHashDataPackage(object):
             {'resources': [{'name': 'a', 'format': 'CSV'}]})
 
 
+class TestFingerprintDatapackage(object):
+    resources = [{'id': 'annual', 'url': 'https://sample.com/annual.csv'},
+                 {'id': 'monthly', 'url': 'https://sample.com/annual.csv'}]
+
+    def fingerprint(self, datapackage, resources=None):
+        return fingerprint_datapackage(
+            datapackage,
+            list(zip(resources or self.resources, datapackage['resources'])))
+
+    def test_repeatability(self):
+        fingerprints = self.fingerprint(remote_datapackage)
+        assert fingerprints['datapackage'] == \
+            '1034cd6d5cbc2917f75ab6209f743360b96870f1dfabd5b11a0ce9ae'
+        assert sorted(fingerprints['resources']) == ['annual', 'monthly']
+
+    def test_local_and_remote_are_the_same(self):
+        assert self.fingerprint(local_datapackage) == \
+            self.fingerprint(remote_datapackage)
+
+    def test_changed_resource(self):
+        datapackage = copy.deepcopy(remote_datapackage)
+        datapackage['resources'][1]['title'] = 'New title'
+        resources = copy.deepcopy(self.resources)
+        resources[0]['size'] = 100
+
+        old = self.fingerprint(remote_datapackage)
+        new = self.fingerprint(datapackage, resources)
+
+        assert new['datapackage'] != old['datapackage']
+        assert new['resources']['annual']['metadata'] == \
+            old['resources']['annual']['metadata']
+        assert new['resources']['annual']['data'] != \
+            old['resources']['annual']['data']
+        assert new['resources']['monthly']['metadata'] != \
+            old['resources']['monthly']['metadata']
+        assert new['resources']['monthly']['data'] == \
+            old['resources']['monthly']['data']
+
+
+class TestGetLane(TestBase):
+    def test_small(self):
+        dataset = factories.Dataset(resources=[
+            {'url': 'https://example.com/data.csv', 'size': 1000}])
+        assert get_lane(model.Package.get(dataset['id'])) == SMALL_LANE
+
+    @pytest.mark.ckan_config('ckanext.downloadall.large_dataset_size', '1000')
+    def test_large_size(self):
+        dataset = factories.Dataset(resources=[
+            {'url': 'https://example.com/data.csv', 'size': 1000}])
+        assert get_lane(model.Package.get(dataset['id'])) == LARGE_LANE
+
+    def test_slow_last_build(self):
+        dataset = factories.Dataset(resources=[
+            {'url': 'https://example.com/data.csv', 'size': 1000}])
+        helpers.call_action(
+            'resource_create', package_id=dataset['id'],
+            name='All resource data',
+            downloadall_metadata_modified=dataset['metadata_modified'],
+            downloadall_build_seconds=600)
+        assert get_lane(model.Package.get(dataset['id'])) == LARGE_LANE
+
+
+class TestGetMemberFile(object):
+    def read(self, member_file):
+        with member_file, zipfile.ZipFile(member_file) as zipf:
+            return zipf.read(MEMBER_FILENAME)
+
+    @responses.activate
+    def test_remote_resource_is_cached_with_its_validators(self, tmpdir):
+        responses.add(responses.GET, 'https://example.com/data.csv',
+                      body='old', headers={'ETag': '"v1"'})
+        responses.add(responses.GET, 'https://example.com/data.csv',
+                      status=304)
+        cache = MemberCache(str(tmpdir), 10 ** 9)
+        res = {'id': 'res1', 'url': 'https://example.com/data.csv'}
+
+        for _ in range(2):
+            member_file, validators = get_member_file(res, cache)
+            assert self.read(member_file) == b'old'
+            assert validators == {'etag': '"v1"'}
+
+        assert responses.calls[1].request.headers['If-None-Match'] == '"v1"'
+
+    @responses.activate
+    def test_remote_resource_without_validators_is_not_cached(self, tmpdir):
+        # the data changes, but the URL doesn't
+        responses.add(responses.GET, 'https://example.com/data.csv',
+                      body='old')
+        responses.add(responses.GET, 'https://example.com/data.csv',
+                      body='new')
+        cache = MemberCache(str(tmpdir), 10 ** 9)
+        res = {'id': 'res1', 'url': 'https://example.com/data.csv'}
+
+        assert self.read(get_member_file(res, cache)[0]) == b'old'
+        assert self.read(get_member_file(res, cache)[0]) == b'new'
+
+
+class TestStreamResourceIntoZip(object):
+    def force_zip64(self, source, size):
+        zip_file = io.BytesIO()
+        with mock.patch('ckanext.downloadall.tasks.open_member_for_writing',
+                        wraps=open_member_for_writing) as open_member:
+            with zipfile.ZipFile(zip_file, 'w') as zipf:
+                stream_resource_into_zip(source, 'data.csv', zipf, size=size)
+        with zipfile.ZipFile(zip_file) as zipf:
+            assert zipf.read('data.csv') == b'a,b,c\n' * 100
+        return open_member.call_args[0][3]
+
+    def test_size_from_the_metadata_is_not_relied_on(self):
+        # (it might be out of date)
+        assert self.force_zip64(io.BytesIO(b'a,b,c\n' * 100), size='6')
+
+    def test_size_of_a_local_file_is_relied_on(self, tmpdir):
+        path = tmpdir.join('data.csv')
+        path.write_binary(b'a,b,c\n' * 100)
+        with real_open(str(path), 'rb') as f:
+            assert not self.force_zip64(f, size=None)
+
+
+class TestGetJobOptions(object):
+    def test_interactive(self):
+        queue, rq_kwargs = get_job_options(SMALL_LANE)
+        assert queue == 'default'
+        # ahead of bulk builds, as they share the queue
+        assert rq_kwargs['at_front']
+
+    def test_bulk(self):
+        queue, rq_kwargs = get_job_options(SMALL_LANE, jobs.BULK)
+        assert queue == 'default'
+        assert 'at_front' not in rq_kwargs
+        assert rq_kwargs['meta']['downloadall_priority'] == jobs.BULK
+
+    @pytest.mark.ckan_config('ckanext.downloadall.large_queue',
+                             'downloadall-large')
+    def test_bulk_in_the_large_lane(self):
+        assert get_job_options(LARGE_LANE, jobs.BULK)[0] == \
+            'downloadall-large'
+
+    @pytest.mark.ckan_config('ckanext.downloadall.bulk_queue',
+                             'downloadall-bulk')
+    def test_bulk_queue_configured(self):
+        assert get_job_options(LARGE_LANE, jobs.BULK)[0] == 'downloadall-bulk'
+        assert 'at_front' not in get_job_options(LARGE_LANE)[1]
+
+
+@pytest.mark.ckan_config('ckanext.downloadall.debounce_seconds', '60')
+class TestDeferUntilQuiet(object):
+    def setup_method(self):
+        self.connection = fakeredis.FakeStrictRedis()
+        self.queue = Queue('test', connection=self.connection)
+        self.queued_datasets = jobs.QueuedDatasets(self.connection)
+        self.queued_datasets.claim('gold')
+        self.queued_datasets.touch('gold', 300)
+        self.job = self.queue.enqueue('ckanext.downloadall.tasks.update_zip',
+                                      'gold')
+        self.queued_datasets.set_job('gold', self.job.id)
+
+    def test_changing_dataset_is_deferred(self):
+        self.connection.set(RQScheduler.get_locking_key('test'), 'scheduler')
+
+        assert defer_until_quiet(self.job, 'gold', self.queued_datasets)
+
+        deferred_job_ids = ScheduledJobRegistry(
+            queue=self.queue).get_job_ids()
+        assert len(deferred_job_ids) == 1
+        # the dataset is queued on the deferred job
+        assert self.queued_datasets.is_waiting(deferred_job_ids[0])
+        assert self.connection.get(self.queued_datasets.key('gold')) == \
+            deferred_job_ids[0].encode()
+
+    def test_not_deferred_without_a_scheduler(self):
+        assert not defer_until_quiet(self.job, 'gold', self.queued_datasets)
+
+        assert ScheduledJobRegistry(queue=self.queue).get_job_ids() == []
+
+    @pytest.mark.ckan_config('ckanext.downloadall.debounce_seconds', '0')
+    def test_not_deferred_without_debounce(self):
+        self.connection.set(RQScheduler.get_locking_key('test'), 'scheduler')
+
+        assert not defer_until_quiet(self.job, 'gold', self.queued_datasets)
+
+
 class TestGenerateDatapackageJson(TestBase):
     def test_simple(self):
         dataset = factories.Dataset(
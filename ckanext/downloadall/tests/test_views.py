@@ -0,0 +1,112 @@
+"""Tests for views.py."""
+import io
+import json
+import zipfile
+
+import mock
+import pytest
+import responses
+
+from ckan.common import config
+from ckan.tests import factories, helpers
+from ckanext.downloadall import views
+from ckanext.downloadall.tests import TestBase
+
+
+@pytest.mark.ckan_config('ckanext.downloadall.streamed_download', 'true')
+class TestDownloadZip(TestBase):
+    @pytest.fixture(autouse=True)
+    def reset_streams(self, monkeypatch):
+        # (the test client doesn't always close the responses, which is when
+        # a stream's place is freed)
+        monkeypatch.setattr(views, '_streams', None)
+
+    @responses.activate
+    def test_zip_is_streamed(self, app):
+        responses.add(responses.GET, 'https://example.com/data.csv',
+                      body='a,b,c')
+        responses.add_passthru(config['solr_url'])
+        dataset = factories.Dataset(notes='Streamed', resources=[
+            {'url': 'https://example.com/data.csv', 'format': 'csv'}])
+
+        response = app.get(
+            '/dataset/{}/downloadall.zip'.format(dataset['name']))
+
+        assert response.headers['Content-Type'] == 'application/zip'
+        assert response.headers['Content-Disposition'] == \
+            'attachment; filename="{}.zip"'.format(dataset['name'])
+        with zipfile.ZipFile(io.BytesIO(response.data)) as zip_:
+            csv_filename = '{}.csv'.format(dataset['resources'][0]['id'])
+            assert zip_.namelist() == [csv_filename, 'datapackage.json']
+            assert zip_.read(csv_filename) == b'a,b,c'
+            assert json.loads(zip_.read('datapackage.json'))[
+                'description'] == 'Streamed'
+
+    def test_private_dataset(self, app):
+        dataset = factories.Dataset(private=True, owner_org=self.org['id'])
+
+        app.get('/dataset/{}/downloadall.zip'.format(dataset['name']),
+                status=403)
+
+    def test_dataset_not_found(self, app):
+        app.get('/dataset/doesnt-exist/downloadall.zip', status=404)
+
+    def test_dataset_is_shown_as_the_user(self, app):
+        dataset = factories.Dataset()
+
+        with mock.patch.object(views, 'stream_zip',
+                               wraps=views.stream_zip) as stream_zip:
+            app.get('/dataset/{}/downloadall.zip'.format(dataset['name']))
+
+        # (anonymous)
+        stream_zip.assert_called_once_with(dataset['name'], user='')
+
+    @pytest.mark.ckan_config(
+        'ckanext.downloadall.streamed_download_max_concurrent', '1')
+    def test_too_many_at_once_is_unavailable(self, app):
+        dataset = factories.Dataset()
+        assert views.get_streams().acquire(False)
+        try:
+            response = app.get(
+                '/dataset/{}/downloadall.zip'.format(dataset['name']),
+                status=503)
+        finally:
+            views.get_streams().release()
+
+        assert response.headers['Retry-After'] == '60'
+        # it is available again, once the other one has finished
+        app.get('/dataset/{}/downloadall.zip'.format(dataset['name']),
+                status=200)
+
+    @pytest.mark.ckan_config('ckanext.downloadall.large_dataset_size', '1000')
+    def test_large_dataset_redirects_to_the_stored_zip(self, app):
+        dataset = factories.Dataset(resources=[
+            {'url': 'https://example.com/data.csv', 'size': 1000}])
+        helpers.call_action(
+            'resource_create', package_id=dataset['id'],
+            url='https://example.com/stored.zip', name='All resource data',
+            downloadall_metadata_modified=dataset['metadata_modified'])
+
+        response = app.get(
+            '/dataset/{}/downloadall.zip'.format(dataset['name']),
+            status=302, follow_redirects=False)
+
+        assert response.headers['Location'] == \
+            'https://example.com/stored.zip'
+
+    def test_download_all_button_points_at_it(self, app):
+        dataset = factories.Dataset(resources=[
+            {'url': 'https://example.com/data.csv', 'format': 'csv'}])
+
+        response = app.get('/dataset/{}'.format(dataset['name']))
+
+        assert '/dataset/{}/downloadall.zip'.format(dataset['name']) in \
+            response.body
+
+
+class TestDownloadZipDisabled(TestBase):
+    def test_not_served_by_default(self, app):
+        dataset = factories.Dataset()
+
+        app.get('/dataset/{}/downloadall.zip'.format(dataset['name']),
+                status=404)
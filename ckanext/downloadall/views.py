@@ -0,0 +1,118 @@
+import logging
+import threading
+
+from flask import Blueprint, Response
+
+from ckan.plugins import toolkit
+
+from ckanext.downloadall.helpers import pop_zip_resource
+from ckanext.downloadall.tasks import (
+    stream_zip, get_streamed_download_max_concurrent, TooLargeToStreamError)
+
+log = logging.getLogger(__name__)
+
+downloadall = Blueprint('downloadall', __name__)
+
+# (seconds, for the Retry-After of a download that can't be served now)
+RETRY_AFTER = 60
+
+_streams_lock = threading.Lock()
+_streams = None
+
+
+def get_streams():
+    '''Returns the semaphore that limits the number of zips this process
+    streams at once (see tasks.get_streamed_download_max_concurrent()), as
+    each one downloads and compresses every resource of its dataset.
+    '''
+    global _streams
+    with _streams_lock:
+        if _streams is None:
+            _streams = threading.BoundedSemaphore(
+                get_streamed_download_max_concurrent())
+        return _streams
+
+
+def download_zip(id):
+    '''Streams the zip of the dataset's resources, built as it is downloaded
+    (see tasks.stream_zip()), rather than the stored zip resource. If this
+    process is streaming as many as it can already, or the dataset is too
+    large, it redirects to the stored zip instead.
+    '''
+    streams = get_streams()
+    if not streams.acquire(False):
+        log.info('Not streaming the zip, as too many are being streamed '
+                 'already: {}'.format(id))
+        return stored_zip(id)
+    try:
+        response = stream_response(id)
+    except BaseException:
+        streams.release()
+        raise
+    # (when the download has finished, or the client has gone)
+    response.call_on_close(streams.release)
+    return response
+
+
+def get_user():
+    '''Returns the name of the user making the request ('' if anonymous), to
+    pass explicitly to the actions, so that their access is checked.
+    '''
+    return getattr(toolkit.g, 'user', None) or ''
+
+
+def stream_response(id):
+    try:
+        filename, chunks = stream_zip(id, user=get_user())
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._('Dataset not found'))
+    except toolkit.NotAuthorized:
+        return toolkit.abort(403, toolkit._('Unauthorized to read dataset'))
+    except TooLargeToStreamError as e:
+        log.info(str(e))
+        return stored_zip(id)
+    log.debug('Streaming the zip: {}'.format(filename))
+
+    # (there is no Content-Length, as the size isn't known until the end)
+    response = Response(chunks, mimetype='application/zip')
+    response.headers['Content-Disposition'] = \
+        'attachment; filename="{}"'.format(filename)
+    # so that nginx doesn't buffer the whole zip before sending it on
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def stored_zip(id):
+    '''Redirects to the dataset's stored zip resource, or if it hasn't been
+    built yet, responds that the download is unavailable for now.
+    '''
+    try:
+        dataset = toolkit.get_action('package_show')(
+            {'user': get_user()}, {'id': id})
+    except toolkit.ObjectNotFound:
+        return toolkit.abort(404, toolkit._('Dataset not found'))
+    except toolkit.NotAuthorized:
+        return toolkit.abort(403, toolkit._('Unauthorized to read dataset'))
+    zip_res = pop_zip_resource(dataset)
+    if zip_res:
+        return toolkit.redirect_to(zip_res['url'])
+    response = Response(
+        toolkit._('The zip of this dataset is not available right now - '
+                  'please try again later'),
+        status=503, mimetype='text/plain')
+    response.headers['Retry-After'] = str(RETRY_AFTER)
+    return response
+
+
+downloadall.add_url_rule('/dataset/<id>/downloadall.zip',
+                         view_func=download_zip)
+
+
+def get_blueprints():
+    '''Returns the blueprints to register - the streamed download is only
+    served if ckanext.downloadall.streamed_download is enabled.
+    '''
+    if not toolkit.asbool(toolkit.config.get(
+            'ckanext.downloadall.streamed_download', False)):
+        return []
+    return [downloadall]